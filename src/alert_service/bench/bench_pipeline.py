@@ -0,0 +1,313 @@
+'''
+Benchmark and soak-test the alert service.
+
+Runs an AlertService in this process against stub SMS and email
+sinks that take a configurable time per message and fail at a
+configurable rate, and reports:
+
+  * throughput, in alerts delivered per second;
+  * end-to-end latency percentiles, from when an alert's file was
+    written to when a sink accepted it (the time is carried in the
+    message, so these are exact, not histogram buckets);
+  * CPU time used, and peak and current resident set size.
+
+There are two modes.
+
+  burst   Write --alerts alerts into the staging directory, --batch per
+          file (1 for single-alert files), start the service and time
+          how long it takes to deliver them all. Use it to size the
+          worker pools: try --sms-workers against a --latency like the
+          provider's.
+
+  soak    Start the service, then write alerts at --rate per second
+          for --duration seconds, printing a line every --report
+          seconds with the interval's throughput and latency, RSS,
+          threads and open files. Steady growth in RSS, threads or
+          files over hours is a leak; a growing backlog means the
+          service cannot keep up with the rate.
+
+Run from src/, eg
+
+    python -m alert_service.bench.bench_pipeline burst --alerts 20000 --batch 500 \\
+        --latency 0.2 --sms-workers 16
+    python -m alert_service.bench.bench_pipeline soak --rate 200 --duration 14400 \\
+        --failure-rate 0.01 --retry
+'''
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+from alert_service.service.alert_svc import makeAlertName
+from alert_service.service.daemon import AlertService
+
+class StubSink:
+    '''
+    An alerter that takes `latency` seconds (plus up to `jitter`
+    more) per message, and fails a `failureRate` fraction of them,
+    half by returning False and half by raising. It records the
+    end-to-end latency of each message it accepts.
+    '''
+
+    def __init__(self,latency=0.0,jitter=0.0,failureRate=0.0,seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.delivered = 0
+        self.failed = 0
+
+    def __call__(self,message,**kwargs):
+        with self.lock:
+            delay = self.latency + self.random.uniform(0,self.jitter)
+            fail = self.random.random() < self.failureRate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            with self.lock:
+                self.failed += 1
+                raising = self.failed % 2 == 0
+            if raising:
+                raise OSError('stub failure')
+            return False
+        # Messages are "bench <created>".
+        latency = time.time() - float(message.split()[1])
+        with self.lock:
+            self.delivered += 1
+            self.latencies.append(latency)
+        return True
+
+    def drain(self):
+        ''' Take the latencies recorded so far. '''
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+        return latencies
+
+def makeAlert(emailFraction,rnd):
+    alert = dict(message='bench {:.6f}'.format(time.time()),neid=rnd.randrange(1000),
+            user_id=rnd.randrange(100000))
+    if rnd.random() < emailFraction:
+        alert.update(channel='email',email='vol{}@example.com'.format(alert['user_id']),
+                subject='Volunteers needed')
+    else:
+        alert.update(channel='sms',phone='+1555{:07d}'.format(alert['user_id']))
+    return alert
+
+def writeAlerts(stagingDir,count,batch=1,emailFraction=0.5,rnd=None):
+    ''' Write count alerts into stagingDir, batch per file, the way the web service does. '''
+    if rnd is None:
+        rnd = random.Random()
+    written = 0
+    while written < count:
+        n = min(batch,count - written)
+        name = makeAlertName()
+        tmp = os.path.join(stagingDir,'.' + name + '.tmp')
+        with open(tmp,'w') as outf:
+            for i in range(n):
+                outf.write(json.dumps(makeAlert(emailFraction,rnd)))
+                outf.write('\n')
+        os.rename(tmp,os.path.join(stagingDir,name))
+        written += n
+    return written
+
+def percentile(values,fraction):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1,int(fraction * len(values)))]
+
+def rssBytes():
+    ''' Current resident set size, from /proc where there is one. '''
+    try:
+        with open('/proc/self/statm') as inf:
+            return int(inf.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError):
+        return None
+
+def peakRssBytes():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+def openFiles():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+def cpuSeconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class Bench:
+    ''' A staging directory, stub sinks and an AlertService to run against them. '''
+
+    def __init__(self,latency=0.0,jitter=0.0,failureRate=0.0,smsWorkers=4,emailWorkers=2,
+            retry=False,dname=None,seed=None):
+        self.root = tempfile.mkdtemp(prefix='alert_bench_',dir=dname)
+        self.stagingDir = os.path.join(self.root,'staging')
+        os.mkdir(self.stagingDir)
+        self.sms = StubSink(latency,jitter,failureRate,seed)
+        self.email = StubSink(latency,jitter,failureRate,seed)
+        self.retry = retry
+        self.workers = {'sms':smsWorkers,'email':emailWorkers}
+        self.service = None
+
+    def start(self):
+        retryDir = os.path.join(self.root,'retry') if self.retry else None
+        self.service = AlertService(self.stagingDir,{'sms':self.sms,'email':self.email},
+                workers=self.workers,retryDir=retryDir,
+                retryOptions=dict(baseDelay=0.5,maxDelay=5,budget=1000))
+        self.service.start()
+
+    def sinks(self):
+        return (self.sms,self.email)
+
+    def delivered(self):
+        return sum([s.delivered for s in self.sinks()])
+
+    def failed(self):
+        return sum([s.failed for s in self.sinks()])
+
+    def givenUp(self):
+        ''' Alerts that will not be delivered: failures, or with retries the dead letters. '''
+        if self.retry:
+            return self.service.retries.deadLettered
+        return self.failed()
+
+    def latencies(self):
+        return self.sms.drain() + self.email.drain()
+
+    def stop(self):
+        if self.service is not None:
+            self.service.stop()
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.root,ignore_errors=True)
+
+def burst(alerts=10000,batch=1,emailFraction=0.5,timeout=3600,**kwargs):
+    '''
+    Deliver a pre-written backlog of alerts. Return a dict of results.
+    With retries off, failed alerts count as done.
+    '''
+    bench = Bench(**kwargs)
+    try:
+        writeAlerts(bench.stagingDir,alerts,batch,emailFraction)
+        cpu = cpuSeconds()
+        start = time.time()
+        bench.start()
+        deadline = start + timeout
+        while time.time() < deadline:
+            done = bench.delivered() + bench.givenUp()
+            if done >= alerts:
+                break
+            time.sleep(0.01)
+        elapsed = time.time() - start
+        latencies = bench.latencies()
+        return dict(alerts=alerts,delivered=bench.delivered(),failures=bench.failed(),
+                seconds=round(elapsed,3),
+                alertsPerSecond=round(bench.delivered() / elapsed,1),
+                p50=percentile(latencies,0.5),p99=percentile(latencies,0.99),
+                cpuSeconds=round(cpuSeconds() - cpu,3),
+                peakRss=peakRssBytes(),rss=rssBytes())
+    finally:
+        bench.close()
+
+def soak(rate=100,duration=3600,report=60,batch=1,emailFraction=0.5,out=print,**kwargs):
+    '''
+    Write alerts at rate per second for duration seconds, calling
+    out() with a line of figures every report seconds. Return the
+    list of interval results.
+    '''
+    bench = Bench(**kwargs)
+    results = []
+    rnd = random.Random()
+    try:
+        bench.start()
+        start = time.time()
+        written = 0
+        lastReport = start
+        lastDelivered = 0
+        lastCpu = cpuSeconds()
+        out('{:>8} {:>10} {:>9} {:>8} {:>8} {:>8} {:>10} {:>7} {:>6}'.format(
+            'elapsed','written','backlog','alert/s','p50','p99','rss MB','threads','files'))
+        while time.time() - start < duration:
+            # Keep the number written on schedule for the rate.
+            due = int((time.time() - start) * rate)
+            if due > written:
+                written += writeAlerts(bench.stagingDir,due - written,batch,emailFraction,rnd)
+            now = time.time()
+            if now - lastReport >= report:
+                delivered = bench.delivered()
+                latencies = bench.latencies()
+                cpu = cpuSeconds()
+                result = dict(elapsed=round(now - start,1),written=written,
+                        backlog=written - delivered - bench.givenUp(),
+                        alertsPerSecond=round((delivered - lastDelivered) / (now - lastReport),1),
+                        p50=percentile(latencies,0.5),p99=percentile(latencies,0.99),
+                        cpu=round((cpu - lastCpu) / (now - lastReport),3),
+                        rss=rssBytes(),threads=threading.active_count(),files=openFiles())
+                results.append(result)
+                out(formatSoakLine(result))
+                lastReport = now
+                lastDelivered = delivered
+                lastCpu = cpu
+            time.sleep(min(0.05,max(0.001,1.0 / rate)))
+        return results
+    finally:
+        bench.close()
+
+def formatMs(seconds):
+    return '-' if seconds is None else '{:.1f}ms'.format(seconds * 1000)
+
+def formatSoakLine(r):
+    return '{:>8} {:>10,d} {:>9,d} {:>8} {:>8} {:>8} {:>10} {:>7} {:>6}'.format(
+        r['elapsed'],r['written'],r['backlog'],r['alertsPerSecond'],formatMs(r['p50']),
+        formatMs(r['p99']),'-' if r['rss'] is None else '{:.1f}'.format(r['rss'] / 2**20),
+        r['threads'],'-' if r['files'] is None else r['files'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mode',choices=['burst','soak'])
+    parser.add_argument('--alerts',type=int,default=10000,help='burst: alerts to deliver.')
+    parser.add_argument('--rate',type=float,default=100,help='soak: alerts written per second.')
+    parser.add_argument('--duration',type=float,default=3600,help='soak: seconds to run.')
+    parser.add_argument('--report',type=float,default=60,help='soak: seconds between reports.')
+    parser.add_argument('--batch',type=int,default=1,help='Alerts per file.')
+    parser.add_argument('--email-fraction',type=float,default=0.5)
+    parser.add_argument('--latency',type=float,default=0.0,help='Sink seconds per message.')
+    parser.add_argument('--jitter',type=float,default=0.0,help='Extra random sink seconds, at most.')
+    parser.add_argument('--failure-rate',type=float,default=0.0,help='Fraction of sends that fail.')
+    parser.add_argument('--retry',action='store_true',help='Retry failures (see retry.py).')
+    parser.add_argument('--sms-workers',type=int,default=4)
+    parser.add_argument('--email-workers',type=int,default=2)
+    parser.add_argument('--dir',default=None,help='Where to make the staging directory.')
+    parser.add_argument('--verbose',action='store_true',help="Show the service's log.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    options = dict(batch=args.batch,emailFraction=args.email_fraction,latency=args.latency,
+            jitter=args.jitter,failureRate=args.failure_rate,retry=args.retry,
+            smsWorkers=args.sms_workers,emailWorkers=args.email_workers,dname=args.dir)
+    if args.mode == 'burst':
+        result = burst(alerts=args.alerts,**options)
+        for key in ('alerts','delivered','failures','seconds','alertsPerSecond','cpuSeconds'):
+            print('{:<16} {}'.format(key,result[key]))
+        print('{:<16} {}'.format('p50',formatMs(result['p50'])))
+        print('{:<16} {}'.format('p99',formatMs(result['p99'])))
+        print('{:<16} {:.1f} MB'.format('peak RSS',result['peakRss'] / 2**20))
+    else:
+        soak(rate=args.rate,duration=args.duration,report=args.report,**options)
+
+if __name__ == '__main__':
+    main()
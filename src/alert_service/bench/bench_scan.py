@@ -0,0 +1,66 @@
+'''
+Benchmark staging directory scans on a large backlog.
+
+Creates N empty alert files in a temporary directory, then measures,
+with tracemalloc, the peak memory and the time taken:
+
+  * by the old approach, a list of every Path from Path.glob('*.json');
+  * to get the first batch from scanBatches();
+  * to walk every file with scanFiles(), removing each one as it is
+    seen, the way the daemon claims them.
+
+The scanBatches() peak should stay roughly constant as N grows, while
+the glob peak grows with N. Walking the whole backlog takes one
+directory pass per batch, so a larger --batch trades memory for
+fewer passes. Run from src/ with
+
+    python -m alert_service.bench.bench_scan --files 100000
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from alert_service.service.alert_svc import scanBatches, scanFiles, makeAlertName
+
+def measure(label,fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    current,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<28} {:>10.3f}s {:>12,d} bytes peak   ({})'.format(label,elapsed,peak,result))
+    return peak
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files',type=int,default=100000,help='Number of alert files.')
+    parser.add_argument('--batch',type=int,default=1000,help='scanBatches() batch size.')
+    parser.add_argument('--dir',default=None,help='Where to make the test directory.')
+    args = parser.parse_args(argv)
+
+    dname = tempfile.mkdtemp(prefix='alert_bench_',dir=args.dir)
+    try:
+        print('Creating {:,d} files in {}'.format(args.files,dname))
+        for i in range(args.files):
+            open(os.path.join(dname,makeAlertName()),'w').close()
+
+        measure('glob list',lambda: len(list(Path(dname).glob('*.json'))))
+        measure('scanBatches first batch',lambda: len(next(scanBatches(dname,args.batch))))
+
+        def consume():
+            count = 0
+            for path in scanFiles(dname,args.batch):
+                os.unlink(path)
+                count += 1
+            return count
+        measure('scanFiles, consuming all',consume)
+    finally:
+        shutil.rmtree(dname)
+
+if __name__ == '__main__':
+    main()
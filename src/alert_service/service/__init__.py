@@ -1,4 +1,7 @@
-from alert_service.service.alert_svc import scanDir
-
-__all__ = ['scanDir']
+from alert_service.service.alert_svc import scanDir, scanBatches, scanFiles, makeAlertName
+from alert_service.service.daemon import AlertService, loadAlerter
+from alert_service.service.alertlog import AlertLog, AlertLogReader
+from alert_service.service.supervisor import Supervisor
 
+__all__ = ['scanDir','scanBatches','scanFiles','makeAlertName','AlertService','loadAlerter',
+        'AlertLog','AlertLogReader','Supervisor']
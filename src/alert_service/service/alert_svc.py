@@ -40,15 +40,120 @@ Requirements:
         failedAlertCount: n
     }
 '''
-from pathlib import Path
+import heapq
+import itertools
+import os
+import socket
+import threading
+import time
+
+# Alert files are named so that name order is creation order; see
+# makeAlertName(). Files whose names start with one of these, or that
+# end with TEMP_SUFFIX, are being written and are never claimable.
+TEMP_PREFIXES = ('.','_')
+TEMP_SUFFIX = '.tmp'
+
+# The most file names held in memory by a scan.
+SCAN_BATCH_SIZE = 1000
+
+_nameLock = threading.Lock()
+_nameSeq = itertools.count()
+
+def makeAlertName(suffix='.json'):
+    '''
+    Get a new alert file name that sorts after every name this
+    process made before it, and after names made earlier by other
+    processes (to clock resolution): a zero-padded time_ns() stamp,
+    then the pid and a sequence number to make it unique.
+    '''
+    with _nameLock:
+        seq = next(_nameSeq)
+    return '{:020d}-{}-{:06d}{}'.format(time.time_ns(),os.getpid(),seq,suffix)
+
+def isClaimable(name,suffix='.json'):
+    ''' True if name looks like a complete alert file. '''
+    return name.endswith(suffix) and not name.startswith(TEMP_PREFIXES)
+
+def scanBatches(dname,batchSize=SCAN_BATCH_SIZE,cursor=None,suffix='.json'):
+    '''
+    Yield the alert files in dname in name (creation) order, as lists
+    of at most batchSize paths. Only names after cursor are yielded.
+
+    Each batch is found with one os.scandir() pass that keeps just the
+    batchSize smallest names past the cursor, so memory stays bounded
+    however large the directory is, and the first batch is available
+    after a single pass. The next pass resumes after the last name
+    yielded; files claimed (moved away) in the meantime are not seen
+    again, so a consumer working through a backlog makes each pass
+    shorter than the last.
+    '''
+    while True:
+        try:
+            with os.scandir(dname) as entries:
+                names = (e.name for e in entries
+                        if isClaimable(e.name,suffix) and (cursor is None or e.name > cursor)
+                        and e.is_file(follow_symlinks=False))
+                batch = heapq.nsmallest(batchSize,names)
+        except FileNotFoundError:
+            return
+        if len(batch) == 0:
+            return
+        yield [os.path.join(dname,name) for name in batch]
+        if len(batch) < batchSize:
+            return
+        cursor = batch[-1]
+
+def scanFiles(dname,batchSize=SCAN_BATCH_SIZE,cursor=None,suffix='.json'):
+    ''' Yield alert file paths one at a time, as scanBatches() finds them. '''
+    for batch in scanBatches(dname,batchSize,cursor,suffix):
+        yield from batch
 
 def scanDir(dname):
-    ''' Scan dname and return a list of alert files. '''
-    result = []
-    p = Path(dname)
-    if p.exists() and p.is_dir():
-        files = p.glob('*.json')
-        result = list(map(str,files))
-    return result
+    ''' Scan dname and return a list of alert files, in creation order. '''
+    return list(scanFiles(dname))
+
+#####################
+# Claimed files. A process claims an alert file by renaming it into
+# claimed/ with claimSuffix() appended, naming the host and process
+# that owns it.
+#####################
+def claimSuffix(pid=None):
+    ''' The suffix process pid (by default this one) adds to the files it claims. '''
+    return '.{}.{}'.format(socket.gethostname(),os.getpid() if pid is None else pid)
+
+def claimOwner(name):
+    '''
+    Split a claimed file's name into the alert file's original name
+    and the host name and pid of its owner, which are None if the name
+    has no claim suffix.
+    '''
+    original,sep,suffix = name.partition('.json.')
+    if sep == '':
+        return name,None,None
+    host,_,pid = suffix.rpartition('.')
+    try:
+        return original + '.json',host,int(pid)
+    except ValueError:
+        return original + '.json',None,None
 
+def processAlive(pid):
+    ''' True if process pid is running on this host. '''
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
+def claimAbandoned(name,mtime,cutoff):
+    '''
+    True if the claimed file name, last modified at mtime, was left
+    behind by a process that died: one on this host that is no longer
+    running, or one on another host (or unknown) that claimed it
+    before cutoff.
+    '''
+    original,host,pid = claimOwner(name)
+    if pid is not None and host == socket.gethostname():
+        return pid != os.getpid() and not processAlive(pid)
+    return mtime < cutoff
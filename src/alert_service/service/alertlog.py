@@ -0,0 +1,318 @@
+'''
+The alert activity log.
+
+Every delivery attempt is appended to the log as one JSON object per
+line (JSONL), so other programs can consume it with nothing more than
+a line reader:
+
+  {"ts": 1760000000.123, "neid": 42, "user_id": 7, "channel": "sms",
+   "to": "+19155551234", "ok": true, "latency": 0.84}
+
+The log is split into segments, alerts-<time_ns>-<pid>.jsonl, and a new
+segment is started when the current one reaches maxBytes or is older
+than maxAge seconds. Beside each segment is an index,
+alerts-<time_ns>-<pid>.idx, of fixed-size entries
+
+  (timestamp, neid, user_id, byte offset of the record)
+
+in the order the records were written, so the log can be paged or
+searched by time by seeking, without reading whole segments. When a
+segment is closed its entries are also written sorted by event
+(.evt: neid, user_id, offset) and by recipient (.usr: user_id, neid,
+offset), so "did volunteer X get the alert for event 42" is a binary
+search in each closed segment. Only the open segment's index is
+scanned, and it is bounded by the rotation limits.
+
+A missing neid or user_id is stored in the index as -1.
+
+Several processes (see supervisor.py) may share a log directory; each
+writes its own segments, and only indexes segments left open by a
+process that has gone.
+'''
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from alert_service.service.alert_svc import processAlive
+
+__all__ = ['AlertLog','AlertLogReader']
+
+def getLogger():
+    return logging.getLogger('alert_svc.alertlog')
+
+# Index entries: timestamp, then three 64-bit integers whose meaning
+# depends on the file (see the module docstring).
+ENTRY = struct.Struct('<dqqq')
+NONE = -1
+
+def segmentName(base,ext):
+    return '{}.{}'.format(base,ext)
+
+def orNone(value):
+    return NONE if value is None else int(value)
+
+def writeAtomically(path,data):
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as outf:
+        outf.write(data)
+    os.replace(tmp,path)
+
+def writerAlive(base):
+    ''' True if the segment base belongs to another process that is still running. '''
+    parts = os.path.basename(base).split('-')
+    try:
+        pid = int(parts[2])
+    except (IndexError,ValueError):
+        return False
+    return pid != os.getpid() and processAlive(pid)
+
+def buildSortedIndexes(base):
+    '''
+    Write the .evt and .usr indexes for the segment base from its
+    .idx index. Done once, when the segment is closed.
+    '''
+    with open(segmentName(base,'idx'),'rb') as inf:
+        data = inf.read()
+    entries = [ENTRY.unpack_from(data,i) for i in range(0,len(data) - len(data) % ENTRY.size,ENTRY.size)]
+    byEvent = sorted([(neid,user_id,offset,ts) for ts,neid,user_id,offset in entries])
+    byUser = sorted([(user_id,neid,offset,ts) for ts,neid,user_id,offset in entries])
+    writeAtomically(segmentName(base,'evt'),
+            b''.join([ENTRY.pack(ts,a,b,offset) for a,b,offset,ts in byEvent]))
+    writeAtomically(segmentName(base,'usr'),
+            b''.join([ENTRY.pack(ts,a,b,offset) for a,b,offset,ts in byUser]))
+
+class AlertLog:
+    ''' Appends records to the current segment, rotating as needed. '''
+
+    def __init__(self,dname,maxBytes=64*1024*1024,maxAge=86400):
+        self.dname = dname
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        os.makedirs(dname,exist_ok=True)
+        self.recover()
+        self.openSegment()
+
+    def recover(self):
+        ''' Finish segments left open by a process that stopped without closing them. '''
+        for base in AlertLogReader(self.dname).segments():
+            if not os.path.exists(segmentName(base,'usr')) and not writerAlive(base):
+                getLogger().info('Indexing unclosed log segment {}'.format(base))
+                buildSortedIndexes(base)
+
+    def openSegment(self):
+        self.base = os.path.join(self.dname,'alerts-{:020d}-{}'.format(time.time_ns(),os.getpid()))
+        self.opened = time.time()
+        self.log = open(segmentName(self.base,'jsonl'),'ab')
+        self.idx = open(segmentName(self.base,'idx'),'ab')
+        self.size = self.log.tell()
+
+    def closeSegment(self):
+        self.log.close()
+        self.idx.close()
+        if self.size == 0:
+            # Nothing was written; don't leave an empty segment behind.
+            for ext in ('jsonl','idx'):
+                os.unlink(segmentName(self.base,ext))
+        else:
+            buildSortedIndexes(self.base)
+
+    def write(self,record):
+        '''
+        Append record, a dict, to the log. A "ts" is added if it has none;
+        "neid" and "user_id" are indexed.
+        '''
+        if 'ts' not in record:
+            record = dict(record,ts=time.time())
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        entry = (record['ts'],orNone(record.get('neid')),orNone(record.get('user_id')))
+        with self.lock:
+            if self.size > 0 and (self.size + len(line) > self.maxBytes or \
+                    time.time() - self.opened > self.maxAge):
+                self.closeSegment()
+                self.openSegment()
+            offset = self.size
+            self.log.write(line)
+            self.log.flush()
+            self.idx.write(ENTRY.pack(entry[0],entry[1],entry[2],offset))
+            self.idx.flush()
+            self.size += len(line)
+
+    def close(self):
+        with self.lock:
+            self.closeSegment()
+
+class IndexFile:
+    ''' Read-only, memory-mapped access to an index file's entries. '''
+
+    def __init__(self,path):
+        self.map = None
+        self.count = 0
+        with open(path,'rb') as inf:
+            size = os.fstat(inf.fileno()).st_size
+            self.count = size // ENTRY.size
+            if self.count > 0:
+                self.map = mmap.mmap(inf.fileno(),0,access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return ENTRY.unpack_from(self.map,i * ENTRY.size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+class EntryKeys:
+    '''
+    The keys keyOf(entry) of an IndexFile's entries, as a sequence
+    computed on access, for bisect (whose key argument needs Python
+    3.10).
+    '''
+
+    def __init__(self,idx,keyOf):
+        self.idx = idx
+        self.keyOf = keyOf
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self,i):
+        return self.keyOf(self.idx[i])
+
+class AlertLogReader:
+    '''
+    Page and search the log in dname. Results are newest first.
+    Paging cursors are strings, "<segment>:<entry number>"; pass the
+    cursor returned with one page to get the next (older) one.
+    '''
+
+    def __init__(self,dname):
+        self.dname = dname
+
+    def segments(self):
+        ''' The segments' base paths, oldest first. '''
+        try:
+            names = os.listdir(self.dname)
+        except FileNotFoundError:
+            return []
+        return sorted([os.path.join(self.dname,n[:-len('.jsonl')]) for n in names \
+                if n.startswith('alerts-') and n.endswith('.jsonl')])
+
+    def readRecords(self,base,offsets):
+        ''' Read the records at the given byte offsets of a segment. '''
+        result = []
+        with open(segmentName(base,'jsonl'),'rb') as inf:
+            for offset in offsets:
+                inf.seek(offset)
+                result.append(json.loads(inf.readline().decode('utf-8')))
+        return result
+
+    def parseCursor(self,cursor):
+        ''' The segment and entry number of a cursor. Raise ValueError if it is malformed. '''
+        name,sep,index = str(cursor).rpartition(':')
+        name = os.path.basename(name)
+        if sep == '' or not name.startswith('alerts-'):
+            raise ValueError('Bad alert log cursor {!r}'.format(cursor))
+        return os.path.join(self.dname,name),int(index)
+
+    def page(self,cursor=None,limit=50):
+        '''
+        Get up to limit records, newest first, starting before cursor.
+        Return (records, cursor for the next page or None). Raise
+        ValueError for a malformed cursor.
+        '''
+        segments = self.segments()
+        cursorBase = None
+        if cursor is not None:
+            cursorBase,cursorIndex = self.parseCursor(cursor)
+            segments = [s for s in segments if s <= cursorBase]
+        records = []
+        for i in range(len(segments) - 1,-1,-1):
+            base = segments[i]
+            idx = IndexFile(segmentName(base,'idx'))
+            try:
+                end = len(idx)
+                if base == cursorBase:
+                    end = min(end,cursorIndex)
+                first = max(0,end - (limit - len(records)))
+                offsets = [idx[j][3] for j in range(end - 1,first - 1,-1)]
+            finally:
+                idx.close()
+            records.extend(self.readRecords(base,offsets))
+            if len(records) >= limit:
+                if first > 0:
+                    return records,'{}:{}'.format(os.path.basename(base),first)
+                if i > 0:
+                    return records,'{}:{}'.format(os.path.basename(segments[i-1]),2**62)
+                return records,None
+        return records,None
+
+    def between(self,start,end,limit=1000):
+        ''' Get up to limit records with start <= ts < end, newest first. '''
+        records = []
+        for base in reversed(self.segments()):
+            idx = IndexFile(segmentName(base,'idx'))
+            try:
+                if len(idx) == 0 or idx[0][0] >= end:
+                    continue
+                times = EntryKeys(idx,lambda e: e[0])
+                lo = bisect.bisect_left(times,start)
+                hi = bisect.bisect_left(times,end)
+                offsets = [idx[i][3] for i in range(hi - 1,lo - 1,-1)][:limit - len(records)]
+            finally:
+                idx.close()
+            records.extend(self.readRecords(base,offsets))
+            # Segments written by different processes overlap in time,
+            # so every one is searched.
+            if len(records) >= limit:
+                break
+        return records
+
+    def find(self,neid=None,user_id=None,limit=100):
+        '''
+        Get up to limit records for event neid and/or recipient
+        user_id, newest first.
+        '''
+        if neid is None and user_id is None:
+            return self.page(limit=limit)[0]
+        records = []
+        for base in reversed(self.segments()):
+            offsets = self.findOffsets(base,neid,user_id)
+            offsets.sort(reverse=True)
+            records.extend(self.readRecords(base,offsets[:limit - len(records)]))
+            if len(records) >= limit:
+                break
+        return records
+
+    def findOffsets(self,base,neid,user_id):
+        if not os.path.exists(segmentName(base,'usr')):
+            # The open segment: scan its (bounded) index.
+            idx = IndexFile(segmentName(base,'idx'))
+            try:
+                return [e[3] for e in (idx[i] for i in range(len(idx))) \
+                        if (neid is None or e[1] == neid) and (user_id is None or e[2] == user_id)]
+            finally:
+                idx.close()
+        if neid is not None:
+            ext,key = 'evt',(neid,) if user_id is None else (neid,user_id)
+        else:
+            ext,key = 'usr',(user_id,)
+        idx = IndexFile(segmentName(base,ext))
+        try:
+            keys = EntryKeys(idx,lambda e: e[1:1+len(key)])
+            lo = bisect.bisect_left(keys,key)
+            hi = bisect.bisect_right(keys,key)
+            return [idx[i][3] for i in range(lo,hi)]
+        finally:
+            idx.close()
@@ -0,0 +1,682 @@
+'''
+The alert service daemon.
+
+The web service writes each alert as a JSON file in a temporary
+location and renames it into the staging directory (see
+alert_service.txt). The daemon:
+
+  * watches the staging directory (see watcher.py), so new alerts are
+    picked up as soon as they arrive rather than on the next poll;
+
+  * claims each file by renaming it into the claimed/ subdirectory.
+    rename() is atomic, so when several threads or processes share a
+    staging directory exactly one of them claims each file, and the
+    others see it vanish;
+
+  * reads the alert, or the batch of alerts, one JSON object per line,
+    that the file holds (see unter.controllers.spool);
+
+  * hands each alert to a worker pool for each medium it names
+    ("phone" for SMS, "email" for email), in its priority lane (see
+    lanes.py). When a pool's backlog for a lane is full, claiming that
+    lane's files stops until there is room, so alerts wait in the
+    staging directory rather than piling up in memory. Broadcast files
+    are passed over, and picked up again when the backlog has drained,
+    so transactional alerts are still claimed behind a large broadcast;
+
+  * unlinks the claimed file once every medium has been attempted.
+    With a retry directory, an alert that could not be delivered is
+    first saved there to be tried again later (see retry.py).
+
+A file that is not text, and the lines of a batch that are not alerts
+or name no configured medium, are written to the dead-letter directory
+(deadDir: by default <retryDir>/dead, or <stagingDir>/dead) under the
+file's name. A file that cannot be read for another reason, such as
+running out of file handles, stays claimed and is staged again by the
+next recoverClaims().
+
+With rate limits, each delivery first waits until it is within its
+provider's, sender's and recipient's limits (see ratelimit.py).
+
+Files left in claimed/ by a process that died are moved back into
+the staging directory: at once if it ran on this host, otherwise
+claimTimeout seconds after it claimed them, since another host's
+processes cannot be checked.
+
+Delivery counts, latencies, queue depth and the age of the oldest
+pending alert are published every statusInterval seconds to the
+status file and, optionally, a shared memory segment (see metrics.py).
+
+With a log directory, every delivery attempt is recorded in the
+alert activity log (see alertlog.py), which the web service pages and
+searches for coordinators.
+
+Run it with
+
+    python -m alert_service.service.daemon --staging /path/to/staging \\
+        --sms-alerter mypkg.sendSMS --email-alerter mypkg.sendEmail
+
+and add --processes N to run N worker processes under a supervisor,
+to use more than one core (see supervisor.py).
+'''
+import argparse
+import collections
+import importlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import threading
+import time
+
+from alert_service.service.alert_svc import scanBatches, claimSuffix, claimOwner, claimAbandoned
+from alert_service.service.alertlog import AlertLog
+from alert_service.service.lanes import LaneQueue, laneLimits, laneOf, laneOfName, \
+        TRANSACTIONAL, BROADCAST, RETRY
+from alert_service.service.retry import RetryScheduler
+from alert_service.service.ratelimit import RateLimiter, parseLimitOptions
+from alert_service.service.metrics import Metrics, SnapshotWriter
+from alert_service.service.watcher import makeWatcher
+
+__all__ = ['AlertService','MediumPool','loadAlerter','MEDIA']
+
+def getLogger():
+    return logging.getLogger('alert_svc.daemon')
+
+#####################
+# Alert media. For each medium: the alert field that must be present,
+# and a function turning an alert into the alerter's keyword arguments.
+# The keyword arguments match the web service's alerters in
+# unter.controllers.alerts, so those can be used here unchanged.
+#####################
+MEDIA = {
+    'sms':('phone',lambda alert: dict(message=alert['message'],
+        sourceNumber=alert.get('source'),destNumber=alert['phone'])),
+    'email':('email',lambda alert: dict(message=alert['message'],
+        toAddr=alert['email'],fromAddr=alert.get('from'),subject=alert.get('subject'))),
+    }
+
+# The alerter keyword arguments holding each medium's sender and
+# recipient, for their rate limits (see ratelimit.py).
+ADDRESSES = {'sms':('sourceNumber','destNumber'),'email':('fromAddr','toAddr')}
+
+# Seconds to hold a medium's deliveries after its provider answers
+# 429 Too Many Requests.
+THROTTLED_PAUSE = 5
+
+def loadAlerter(name):
+    ''' Get the callable named by a dotted path, eg "pkg.module.function". '''
+    pkg,method = name.rsplit('.',1)
+    return getattr(importlib.import_module(pkg),method)
+
+class MediumPool:
+    '''
+    A fixed number of worker threads for one medium, taking alerts
+    from a LaneQueue (see lanes.py), so transactional alerts go ahead
+    of broadcasts. hasRoom(lane) is False while `backlog` alerts of
+    that lane are waiting for a worker. With a RateLimiter, each
+    delivery first waits until it is within the medium's limits.
+    '''
+
+    def __init__(self,medium,alerter,workers=2,backlog=None,metrics=None,
+            laneWeights=None,reservedWorkers=1,limiter=None):
+        self.medium = medium
+        self.alerter = alerter
+        self.limiter = limiter
+        if backlog is None:
+            backlog = workers
+        self.backlog = backlog
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.queue = LaneQueue(laneWeights,laneLimits(workers,reservedWorkers))
+        # Enqueue times of submitted alerts not yet finished, oldest first.
+        self.pending = collections.OrderedDict()
+        self.pendingLock = threading.Lock()
+        self.jobIds = itertools.count()
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work,name='alert-{}-{}'.format(medium,i),daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self,kwargs,done,enqueuedAt=None,lane=TRANSACTIONAL):
+        '''
+        Queue a call of the alerter with kwargs in lane, then call
+        done(medium,ok,error), error being what the alerter raised, if
+        anything. enqueuedAt is when the alert was first queued,
+        for the latency metrics.
+        '''
+        if enqueuedAt is None:
+            enqueuedAt = time.time()
+        jobId = next(self.jobIds)
+        with self.pendingLock:
+            self.pending[jobId] = enqueuedAt
+        self.queue.put(lane,(kwargs,done,jobId,enqueuedAt))
+
+    def work(self):
+        while True:
+            got = self.queue.get()
+            if got is None:
+                return
+            lane,(kwargs,done,jobId,enqueuedAt) = got
+            try:
+                self.run(kwargs,done,jobId,enqueuedAt,lane)
+            finally:
+                self.queue.done(lane)
+
+    def run(self,kwargs,done,jobId=None,enqueuedAt=None,lane=TRANSACTIONAL):
+        ok = False
+        error = None
+        if self.limiter is not None:
+            self.pace(kwargs)
+        try:
+            ok = self.alerter(**kwargs) is not False
+        except Exception as ex:
+            getLogger().error('{} alert failed: {}'.format(self.medium,ex))
+            error = ex
+            if self.limiter is not None and getattr(ex,'status',None) == 429:
+                self.limiter.penalize(self.medium,THROTTLED_PAUSE)
+        finally:
+            with self.pendingLock:
+                self.pending.pop(jobId,None)
+        if ok:
+            self.metrics.incr(self.medium,'sent')
+            if enqueuedAt is not None:
+                latency = time.time() - enqueuedAt
+                self.metrics.observe(self.medium,latency)
+                self.metrics.observe('lane.' + lane,latency)
+        else:
+            self.metrics.incr(self.medium,'failed')
+        done(self.medium,ok,error)
+
+    def pace(self,kwargs):
+        ''' Wait until delivering with kwargs is within the rate limits. '''
+        senderArg,recipientArg = ADDRESSES.get(self.medium,(None,None))
+        waited = self.limiter.wait(self.medium,kwargs.get(senderArg),kwargs.get(recipientArg))
+        self.metrics.observe('wait.' + self.medium,waited)
+        if waited > 0:
+            self.metrics.incr(self.medium,'rateLimited')
+
+    def hasRoom(self,lane,fraction=1.0):
+        ''' True if fewer than fraction * backlog alerts of lane are waiting. '''
+        return self.queue.qsize(lane) < max(1,self.backlog * fraction)
+
+    def waitForRoom(self,lane,timeout=None):
+        with self.queue.cond:
+            return self.queue.cond.wait_for(lambda: self.hasRoom(lane),timeout)
+
+    def depth(self):
+        ''' The number of alerts submitted and not yet finished. '''
+        return len(self.pending)
+
+    def oldestPending(self):
+        ''' The enqueue time of the oldest unfinished alert, or None. '''
+        with self.pendingLock:
+            for enqueuedAt in self.pending.values():
+                return enqueuedAt
+        return None
+
+    def shutdown(self):
+        self.queue.stop(len(self.threads))
+        for t in self.threads:
+            t.join()
+
+class AlertService:
+    '''
+    Claim alert files from stagingDir and deliver them with the
+    alerters in `alerters`, a dict mapping a medium name in MEDIA to a
+    callable. workers maps a medium name to its number of worker threads.
+    '''
+
+    def __init__(self,stagingDir,alerters,workers=None,pollInterval=5,
+            rescanInterval=60,claimTimeout=300,statusFile=None,watcher=None,
+            scanBatchSize=1000,statusInterval=5,shmName=None,logDir=None,
+            logMaxBytes=64*1024*1024,logMaxAge=86400,laneWeights=None,reservedWorkers=1,
+            retryDir=None,deadDir=None,retryOptions=None,rateLimits=None,rateHeadroom=0.9):
+        self.stagingDir = stagingDir
+        self.scanBatchSize = scanBatchSize
+        self.claimDir = os.path.join(stagingDir,'claimed')
+        os.makedirs(self.claimDir,exist_ok=True)
+        self.pollInterval = pollInterval
+        self.rescanInterval = rescanInterval
+        self.claimTimeout = claimTimeout
+        if workers is None:
+            workers = {}
+        self.metrics = Metrics()
+        self.metrics.gauge('queueDepth',self.queueDepth)
+        self.metrics.gauge('oldestPendingAge',self.oldestPendingAge)
+        self.statusWriter = SnapshotWriter(self.metrics,statusFile,statusInterval,shmName)
+        self.alertLog = None
+        if logDir is not None:
+            self.alertLog = AlertLog(logDir,logMaxBytes,logMaxAge)
+        # retryOptions are passed to the RetryScheduler: maxAttempts,
+        # baseDelay, maxDelay, budget and budgetWindow.
+        self.retries = None
+        if deadDir is None:
+            deadDir = os.path.join(retryDir if retryDir is not None else stagingDir,'dead')
+        self.deadDir = deadDir
+        if retryDir is not None:
+            self.retries = RetryScheduler(retryDir,deadDir,self.resubmit,**(retryOptions or {}))
+            self.metrics.gauge('retryPending',self.retries.pending)
+            self.metrics.gauge('deadLettered',lambda: self.retries.deadLettered)
+        # rateLimits maps a medium to its limits per scope (see ratelimit.py).
+        self.limiter = None
+        if rateLimits:
+            self.limiter = RateLimiter(rateLimits,rateHeadroom)
+        self.pools = {}
+        for medium,alerter in alerters.items():
+            self.pools[medium] = MediumPool(medium,alerter,workers.get(medium,2),
+                    metrics=self.metrics,laneWeights=laneWeights,reservedWorkers=reservedWorkers,
+                    limiter=self.limiter)
+        if watcher is None:
+            watcher = makeWatcher(stagingDir,pollInterval)
+        self.watcher = watcher
+        self.claimSuffix = claimSuffix()
+        # Claimed files that could not be read, to be tried again.
+        self.unread = set()
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.idle = threading.Condition(self.lock)
+        self.stopping = threading.Event()
+        # Set when broadcast files were passed over for lack of room,
+        # and resume when there is room for them again.
+        self.deferred = False
+        self.resume = threading.Event()
+
+    #####################
+    # Claiming and processing files.
+    #####################
+    def claim(self,path):
+        '''
+        Move path into the claim directory. Return the claimed path and
+        when the alert was staged, or (None,None) if another worker
+        claimed it first. The claimed file's mtime is then set to now,
+        so other hosts' recoverClaims() time the claim from here.
+        '''
+        claimed = os.path.join(self.claimDir,os.path.basename(path) + self.claimSuffix)
+        try:
+            os.rename(path,claimed)
+            enqueuedAt = os.stat(claimed).st_mtime
+            os.utime(claimed)
+        except FileNotFoundError:
+            return None,None
+        return claimed,enqueuedAt
+
+    def readAlerts(self,claimed):
+        '''
+        Read the alerts in a claimed file: either one JSON object, or a
+        batch of them, one per line. Return the alerts and the lines
+        that are not alerts. Raise ValueError if the file is not text.
+        '''
+        with open(claimed,'r') as inf:
+            text = inf.read()
+        try:
+            alert = json.loads(text)
+            if isinstance(alert,dict):
+                return [alert],[]
+        except ValueError:
+            pass
+        alerts = []
+        bad = []
+        for line in text.splitlines():
+            if line.strip() == '':
+                continue
+            try:
+                alert = json.loads(line)
+            except ValueError:
+                alert = None
+            if isinstance(alert,dict):
+                alerts.append(alert)
+            else:
+                bad.append(line)
+        return alerts,bad
+
+    def mediaFor(self,alert):
+        '''
+        The configured media to send alert by: its "channel" if it
+        names one, otherwise every medium whose address it has.
+        '''
+        if 'message' not in alert:
+            return []
+        if 'channel' in alert:
+            candidates = [alert['channel']]
+        else:
+            candidates = self.pools.keys()
+        return [m for m in candidates if m in self.pools and alert.get(MEDIA[m][0])]
+
+    def process(self,path):
+        ''' Claim and dispatch the alert file at path. Return True if claimed. '''
+        fileLane = laneOfName(os.path.basename(path))
+        if not self.hasRoom(fileLane):
+            if fileLane == BROADCAST:
+                self.deferred = True
+                return False
+            self.waitForRoom(fileLane)
+        claimed,enqueuedAt = self.claim(path)
+        if claimed is None:
+            return False
+        try:
+            alerts,bad = self.readAlerts(claimed)
+        except ValueError as ex:
+            getLogger().error('Bad alert file {}, moving it to {}: {}'.format(path,self.deadDir,ex))
+            self.metrics.incr('invalid','failed')
+            self.deadLetter(claimed)
+            return True
+        except OSError as ex:
+            # Perhaps out of file handles: leave it claimed, and
+            # recoverClaims() will stage it again.
+            getLogger().error('Cannot read alert file {}, will try again: {}'.format(path,ex))
+            with self.lock:
+                self.unread.add(claimed)
+            return True
+        jobs = []
+        for alert in alerts:
+            media = self.mediaFor(alert)
+            if len(media) == 0:
+                bad.append(json.dumps(alert))
+            jobs.extend([(medium,alert,laneOf(alert,fileLane)) for medium in media])
+        if len(bad) > 0:
+            getLogger().error('{} bad or undeliverable alerts in {}, moving them to {}'.format(
+                len(bad),path,self.deadDir))
+            self.metrics.incr('invalid','failed',len(bad))
+            self.deadLetterLines(claimed,bad)
+        if len(jobs) == 0:
+            self.finished(claimed)
+            return True
+        with self.lock:
+            self.inFlight += 1
+        state = dict(pending=len(jobs))
+        stateLock = threading.Lock()
+        def done(medium,ok,error=None):
+            with stateLock:
+                state['pending'] -= 1
+                last = state['pending'] == 0
+            if last:
+                self.finished(claimed)
+                with self.lock:
+                    self.inFlight -= 1
+                    self.idle.notify_all()
+            if self.deferred and self.hasRoom(BROADCAST,0.5):
+                self.deferred = False
+                self.resume.set()
+                self.watcher.wake()
+        for medium,alert,lane in jobs:
+            self.pools[medium].submit(MEDIA[medium][1](alert),
+                    self.logged(alert,self.retrying(alert,done),enqueuedAt),enqueuedAt,lane)
+        return True
+
+    def retrying(self,alert,done):
+        '''
+        Wrap a job's done(medium,ok,error) callback so that a failed
+        alert is saved for retrying, before its claimed file is removed.
+        '''
+        if self.retries is None:
+            return done
+        def retryAndDone(medium,ok,error=None):
+            if not ok:
+                try:
+                    self.retries.schedule(medium,alert,error)
+                except OSError as ex:
+                    getLogger().error('Could not save {} alert for retrying: {}'.format(medium,ex))
+            done(medium,ok,error)
+        return retryAndDone
+
+    def resubmit(self,entry):
+        ''' Deliver a due retry (see RetryScheduler) in the retry lane. '''
+        medium = entry['medium']
+        if medium not in self.pools:
+            self.retries.failed(entry,None)
+            return
+        def retried(medium,ok,error=None):
+            if ok:
+                self.retries.succeeded(entry)
+            else:
+                self.retries.failed(entry,error)
+        self.metrics.incr(medium,'retried')
+        self.pools[medium].submit(MEDIA[medium][1](entry['alert']),
+                self.logged(entry['alert'],retried,time.time()),lane=RETRY)
+
+    def hasRoom(self,lane,fraction=1.0):
+        return all([pool.hasRoom(lane,fraction) for pool in self.pools.values()])
+
+    def waitForRoom(self,lane):
+        for pool in self.pools.values():
+            while not self.stopping.is_set() and not pool.waitForRoom(lane,0.5):
+                pass
+
+    def logged(self,alert,done,enqueuedAt):
+        '''
+        Wrap a job's done(medium,ok,error) callback so that it first
+        records the attempt in the alert log, if there is one.
+        '''
+        if self.alertLog is None:
+            return done
+        def logAndDone(medium,ok,error=None):
+            record = dict(neid=alert.get('neid'),user_id=alert.get('user_id'),
+                    channel=medium,to=alert.get(MEDIA[medium][0]),ok=ok,
+                    latency=round(time.time() - enqueuedAt,3))
+            if error is not None:
+                record['error'] = str(error)
+            try:
+                self.alertLog.write(record)
+            except OSError as ex:
+                getLogger().error('Could not write the alert log: {}'.format(ex))
+            done(medium,ok,error)
+        return logAndDone
+
+    def finished(self,claimed):
+        try:
+            os.unlink(claimed)
+        except FileNotFoundError:
+            pass
+
+    def deadName(self,claimed):
+        return os.path.join(self.deadDir,claimOwner(os.path.basename(claimed))[0])
+
+    def deadLetter(self,claimed):
+        ''' Move a claimed file that is not alerts to the dead-letter directory. '''
+        try:
+            os.makedirs(self.deadDir,exist_ok=True)
+            shutil.move(claimed,self.deadName(claimed))
+        except OSError as ex:
+            getLogger().error('Cannot move {} to {}: {}'.format(claimed,self.deadDir,ex))
+
+    def deadLetterLines(self,claimed,lines):
+        ''' Write the lines of a claimed file that could not be delivered to the dead-letter directory. '''
+        path = self.deadName(claimed)
+        tmp = os.path.join(self.deadDir,'.' + os.path.basename(path) + '.tmp')
+        try:
+            os.makedirs(self.deadDir,exist_ok=True)
+            with open(tmp,'w') as outf:
+                outf.write('\n'.join(lines) + '\n')
+            os.rename(tmp,path)
+        except OSError as ex:
+            getLogger().error('Cannot write {}: {}'.format(path,ex))
+
+    def scan(self):
+        ''' Process every file currently in the staging directory. '''
+        count = 0
+        for batch in scanBatches(self.stagingDir,self.scanBatchSize):
+            for path in batch:
+                if self.stopping.is_set():
+                    return count
+                if self.process(path):
+                    count += 1
+        return count
+
+    def recoverClaims(self):
+        '''
+        Move files claimed by processes that have died back into the
+        staging directory (see claimAbandoned()), and those this
+        process could not read. Other files this process claimed are
+        left alone, however long they take to deliver.
+        '''
+        with self.lock:
+            unread = self.unread
+            self.unread = set()
+        for claimed in unread:
+            try:
+                os.rename(claimed,os.path.join(self.stagingDir,claimOwner(os.path.basename(claimed))[0]))
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                getLogger().error('Cannot stage {} again: {}'.format(claimed,ex))
+                with self.lock:
+                    self.unread.add(claimed)
+        cutoff = time.time() - self.claimTimeout
+        for entry in os.scandir(self.claimDir):
+            try:
+                if entry.name.endswith(self.claimSuffix) or \
+                        not claimAbandoned(entry.name,entry.stat().st_mtime,cutoff):
+                    continue
+                original = claimOwner(entry.name)[0]
+                os.rename(entry.path,os.path.join(self.stagingDir,original))
+                getLogger().warning('Recovered abandoned alert {}'.format(entry.name))
+            except FileNotFoundError:
+                pass
+
+    #####################
+    # Status.
+    #####################
+    def status(self):
+        ''' The delivery counts so far. '''
+        return dict(successfulAlertCount=self.metrics.count('sent'),
+                failedAlertCount=self.metrics.count('failed'))
+
+    def queueDepth(self):
+        ''' Alerts claimed but not yet delivered. '''
+        return sum([pool.depth() for pool in self.pools.values()])
+
+    def oldestPendingAge(self):
+        ''' Seconds since the oldest undelivered claimed alert was queued. '''
+        oldest = [pool.oldestPending() for pool in self.pools.values()]
+        oldest = [t for t in oldest if t is not None]
+        if len(oldest) == 0:
+            return 0
+        return round(time.time() - min(oldest),3)
+
+    def drain(self,timeout=None):
+        ''' Wait until every claimed alert has been delivered. '''
+        with self.lock:
+            return self.idle.wait_for(lambda: self.inFlight == 0,timeout)
+
+    #####################
+    # The main loop.
+    #####################
+    def run(self):
+        self.recoverClaims()
+        self.scan()
+        lastScan = time.time()
+        while not self.stopping.is_set():
+            names = self.watcher.wait(min(self.pollInterval,self.rescanInterval))
+            if self.stopping.is_set():
+                break
+            if names is None or self.resume.is_set() or \
+                    time.time() - lastScan >= self.rescanInterval:
+                self.resume.clear()
+                if time.time() - lastScan >= self.rescanInterval:
+                    self.recoverClaims()
+                self.scan()
+                lastScan = time.time()
+            else:
+                for name in sorted(names):
+                    self.process(os.path.join(self.stagingDir,name))
+        self.drain()
+
+    def start(self):
+        ''' Run the main loop on a background thread. '''
+        self.statusWriter.start()
+        if self.retries is not None:
+            self.retries.start()
+        self.thread = threading.Thread(target=self.run,name='alert-service',daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        ''' Stop claiming alerts, finish those claimed and shut down. '''
+        self.stopping.set()
+        self.watcher.wake()
+        if self.retries is not None:
+            self.retries.stop()
+        thread = getattr(self,'thread',None)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        for pool in self.pools.values():
+            pool.shutdown()
+        self.watcher.close()
+        self.statusWriter.stop()
+        if self.alertLog is not None:
+            self.alertLog.close()
+            self.alertLog = None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='The Unter alert service.')
+    parser.add_argument('--staging',required=True,help='The staging directory to watch.')
+    parser.add_argument('--status-file',default=None,help='Where to write status JSON.')
+    parser.add_argument('--status-interval',type=float,default=5,help='Seconds between status writes.')
+    parser.add_argument('--status-shm',default=None,help='Shared memory segment to publish status in.')
+    parser.add_argument('--log-dir',default=None,help='Directory for the alert activity log.')
+    parser.add_argument('--log-max-mb',type=int,default=64,help='Start a new log segment after this many MB.')
+    parser.add_argument('--poll',type=float,default=5,help='Seconds between scans when polling.')
+    parser.add_argument('--sms-alerter',default=None,help='Dotted name of the SMS alerter.')
+    parser.add_argument('--email-alerter',default=None,help='Dotted name of the email alerter.')
+    parser.add_argument('--sms-workers',type=int,default=4)
+    parser.add_argument('--email-workers',type=int,default=2)
+    parser.add_argument('--retry-dir',default=None,
+            help='Where to keep failed alerts for retrying (default: <staging>/../retry).')
+    parser.add_argument('--dead-letter-dir',default=None,
+            help='Where to put alerts that could not be read or delivered '
+            '(default: <retry dir>/dead, or <staging>/dead without retries).')
+    parser.add_argument('--max-attempts',type=int,default=6,help='Delivery attempts per alert.')
+    parser.add_argument('--retry-delay',type=float,default=30,help='Seconds before the first retry.')
+    parser.add_argument('--retry-budget',type=int,default=60,help='Most retries per medium per minute.')
+    parser.add_argument('--rate-limit',action='append',default=[],metavar='MEDIUM[.SCOPE]=LIMITS',
+            help='Send limits, eg sms=10/s,250000/d or sms.sender=1/s (see ratelimit.py).')
+    parser.add_argument('--rate-headroom',type=float,default=0.9,
+            help='Fraction of the rate limits to send at.')
+    parser.add_argument('--processes',type=int,default=1,
+            help='Worker processes to run under a supervisor (see supervisor.py).')
+    parser.add_argument('--shared',action='store_true',
+            help='With --processes, have every worker watch the staging directory '
+            'instead of sharding alerts by recipient.')
+    parser.add_argument('--reserved-workers',type=int,default=1,
+            help='Workers per medium kept for transactional alerts.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    alerters = {}
+    if args.sms_alerter:
+        alerters['sms'] = loadAlerter(args.sms_alerter)
+    if args.email_alerter:
+        alerters['email'] = loadAlerter(args.email_alerter)
+    retryDir = args.retry_dir
+    if retryDir is None:
+        retryDir = os.path.join(os.path.dirname(os.path.abspath(args.staging)),'retry')
+    options = dict(workers={'sms':args.sms_workers,'email':args.email_workers},
+            pollInterval=args.poll,
+            logDir=args.log_dir,logMaxBytes=args.log_max_mb*1024*1024,
+            reservedWorkers=args.reserved_workers,
+            retryDir=retryDir,deadDir=args.dead_letter_dir,
+            retryOptions=dict(maxAttempts=args.max_attempts,baseDelay=args.retry_delay,
+                budget=args.retry_budget),
+            rateLimits=parseLimitOptions(args.rate_limit),rateHeadroom=args.rate_headroom)
+    if args.processes > 1:
+        from alert_service.service.supervisor import Supervisor
+        svc = Supervisor(args.staging,alerters,args.processes,sharded=not args.shared,
+                statusFile=args.status_file,statusInterval=args.status_interval,
+                shmName=args.status_shm,serviceOptions=options,pollInterval=args.poll)
+    else:
+        svc = AlertService(args.staging,alerters,statusFile=args.status_file,
+                statusInterval=args.status_interval,shmName=args.status_shm,**options)
+    svc.start()
+    signal.signal(signal.SIGTERM,lambda sig,frame: svc.stopping.set())
+    signal.signal(signal.SIGINT,lambda sig,frame: svc.stopping.set())
+    while not svc.stopping.wait(1):
+        pass
+    svc.stop()
+
+if __name__ == '__main__':
+    main()
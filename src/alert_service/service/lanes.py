@@ -0,0 +1,136 @@
+'''
+Priority lanes.
+
+Alerts are either "transactional" (a confirmation, a cancellation, a
+coordinator told a volunteer has dropped out: one message someone is
+waiting for) or "broadcast" (the "volunteers needed" fan-out to
+everyone available). A large broadcast must not hold up a
+cancellation, so each medium's workers take alerts from a LaneQueue:
+
+  * every lane has its own FIFO queue;
+
+  * workers pick the next lane by smooth weighted round robin over the
+    lanes that have alerts waiting, so with the default weights eight
+    transactional alerts are sent for every broadcast one while both
+    are queued, and either lane gets every worker when the other is
+    idle;
+
+  * a lane may be limited in how many workers it can occupy at once.
+    By default broadcasts may use all but one worker, so a
+    transactional alert never waits for a broadcast delivery to finish;
+    retries of failed deliveries (see retry.py) may use half as many.
+
+The lane of an alert is its "lane" field. The web service also puts
+a broadcast batch's lane in its file name (see laneOfName()), so the
+daemon can leave broadcasts in the staging directory, rather than in
+memory, while transactional alerts are claimed.
+
+The web service's dispatcher has the same queue
+(unter.controllers.dispatch); its tests check that the two serve
+lanes alike.
+'''
+import collections
+import threading
+
+__all__ = ['LaneQueue','LANES','TRANSACTIONAL','BROADCAST','RETRY','laneOf','laneOfName',
+        'laneLimits']
+
+TRANSACTIONAL = 'transactional'
+BROADCAST = 'broadcast'
+RETRY = 'retry'
+
+# Lanes and their default weights, highest priority first.
+LANES = collections.OrderedDict([(TRANSACTIONAL,8),(BROADCAST,1),(RETRY,1)])
+
+def laneOf(alert,default=TRANSACTIONAL):
+    ''' The lane alert belongs in. Unknown lanes are transactional. '''
+    lane = alert.get('lane',default)
+    return lane if lane in LANES else default
+
+def laneOfName(name):
+    ''' The lane in an alert file name, "<stamp>.<lane>.json", or transactional. '''
+    parts = name.split('.')
+    if len(parts) >= 3 and parts[-2] in LANES:
+        return parts[-2]
+    return TRANSACTIONAL
+
+def laneLimits(workers,reserved=1):
+    '''
+    Per-lane worker limits for a pool of `workers` threads, keeping
+    `reserved` of them for transactional alerts.
+    '''
+    shared = max(1,workers - reserved)
+    return {BROADCAST:shared,RETRY:max(1,shared // 2)}
+
+class LaneQueue:
+    '''
+    Queues for each lane in weights (a dict of lane: weight), served by
+    weighted round robin. limits maps a lane to the most items of that
+    lane that may be in progress at once. Each get() must be matched
+    by a done() for the lane it returned.
+    '''
+
+    def __init__(self,weights=None,limits=None):
+        if weights is None:
+            weights = LANES
+        self.weights = dict(weights)
+        self.limits = dict(limits or {})
+        self.items = dict([(lane,collections.deque()) for lane in self.weights])
+        self.active = dict([(lane,0) for lane in self.weights])
+        self.credit = dict([(lane,0) for lane in self.weights])
+        self.cond = threading.Condition()
+        self.stops = 0
+
+    def put(self,lane,item):
+        with self.cond:
+            self.items[lane].append(item)
+            # Wake everyone: threads waiting for room (see
+            # MediumPool.waitForRoom()) share this condition with
+            # idle workers, and one notify() may wake the wrong kind.
+            self.cond.notify_all()
+
+    def stop(self,count=1):
+        ''' Make count get() calls return None once the queues are empty. '''
+        with self.cond:
+            self.stops += count
+            self.cond.notify_all()
+
+    def eligible(self):
+        return [lane for lane,items in self.items.items() if len(items) > 0 and \
+                self.active[lane] < self.limits.get(lane,self.active[lane] + 1)]
+
+    def get(self):
+        '''
+        Wait for an item. Return (lane,item), or None when stopped and
+        there is nothing left to do.
+        '''
+        with self.cond:
+            while True:
+                lanes = self.eligible()
+                if len(lanes) > 0:
+                    break
+                if self.stops > 0 and self.qsize() == 0:
+                    self.stops -= 1
+                    return None
+                self.cond.wait()
+            total = 0
+            for lane in lanes:
+                self.credit[lane] += self.weights[lane]
+                total += self.weights[lane]
+            lane = max(lanes,key=lambda l: self.credit[l])
+            self.credit[lane] -= total
+            self.active[lane] += 1
+            item = self.items[lane].popleft()
+            # There is room in lane for whoever is waiting for it.
+            self.cond.notify_all()
+            return lane,item
+
+    def done(self,lane):
+        with self.cond:
+            self.active[lane] -= 1
+            self.cond.notify_all()
+
+    def qsize(self,lane=None):
+        if lane is not None:
+            return len(self.items[lane])
+        return sum([len(items) for items in self.items.values()])
@@ -0,0 +1,267 @@
+'''
+Alert service metrics.
+
+Counters and latency histograms are kept per channel ("sms",
+"email", ...). Every thread that records a metric gets its own shard,
+so recording is a plain dict update with no lock and no contention
+between worker threads; snapshot() sums the shards.
+
+Latencies are the time from when an alert was enqueued (written to
+the staging directory) to when the provider accepted it, counted in
+fixed, roughly logarithmic buckets. Percentiles in a snapshot are the
+upper bound of the bucket the percentile falls in.
+
+Gauges, such as queue depth and the age of the oldest pending alert,
+are functions evaluated when a snapshot is taken.
+
+A SnapshotWriter thread writes snapshots at a fixed interval, to a
+JSON status file (atomically, by write and rename), to a shared
+memory segment, or both. The shared memory segment holds:
+
+    bytes 0-7   a sequence number (little-endian unsigned); odd while
+                a snapshot is being written
+    bytes 8-11  the length of the snapshot JSON
+    bytes 12-   the snapshot JSON, UTF-8
+
+so a reader in another process (see readSharedSnapshot()) can get
+a consistent snapshot without locks and without file I/O.
+'''
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+__all__ = ['Metrics','SnapshotWriter','readSharedSnapshot','LATENCY_BOUNDS']
+
+def getLogger():
+    return logging.getLogger('alert_svc.metrics')
+
+# Histogram bucket upper bounds, in seconds. The last bucket holds
+# everything slower.
+LATENCY_BOUNDS = [0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,300,900,3600]
+
+def bucketFor(seconds):
+    for i,bound in enumerate(LATENCY_BOUNDS):
+        if seconds <= bound:
+            return i
+    return len(LATENCY_BOUNDS)
+
+class Metrics:
+    ''' Sharded counters and histograms, and gauges. '''
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shardsLock = threading.Lock()
+        self.shards = []
+        self.gauges = {}
+        self.started = time.time()
+        self.lastSnapshot = None
+
+    def shard(self):
+        shard = getattr(self.local,'shard',None)
+        if shard is None:
+            shard = dict(counts={},latencies={})
+            self.local.shard = shard
+            with self.shardsLock:
+                self.shards.append(shard)
+        return shard
+
+    def incr(self,channel,name,n=1):
+        ''' Add n to counter name for channel. '''
+        counts = self.shard()['counts']
+        key = (channel,name)
+        counts[key] = counts.get(key,0) + n
+
+    def observe(self,channel,seconds):
+        ''' Record one latency for channel. '''
+        latencies = self.shard()['latencies']
+        hist = latencies.get(channel)
+        if hist is None:
+            hist = latencies[channel] = [0] * (len(LATENCY_BOUNDS) + 1)
+        hist[bucketFor(seconds)] += 1
+
+    def gauge(self,name,fn):
+        ''' Report fn() as name in every snapshot. '''
+        self.gauges[name] = fn
+
+    def totals(self):
+        ''' Sum the shards: ({(channel,name):count}, {channel:histogram}). '''
+        counts = {}
+        hists = {}
+        with self.shardsLock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key,n in list(shard['counts'].items()):
+                counts[key] = counts.get(key,0) + n
+            for channel,hist in list(shard['latencies'].items()):
+                total = hists.setdefault(channel,[0] * len(hist))
+                for i,n in enumerate(list(hist)):
+                    total[i] += n
+        return counts,hists
+
+    def count(self,name,channel=None):
+        ''' The total of counter name, for channel or across all channels. '''
+        counts,hists = self.totals()
+        return sum([n for (ch,nm),n in counts.items() if nm == name and channel in (None,ch)])
+
+    def snapshot(self):
+        '''
+        Get the current metrics as a dict, ready for JSON. Rates are
+        per second since the previous snapshot.
+        '''
+        now = time.time()
+        counts,hists = self.totals()
+        channels = {}
+        for (channel,name),n in counts.items():
+            channels.setdefault(channel,{})[name] = n
+        for channel,hist in hists.items():
+            channels.setdefault(channel,{})['latency'] = histogramSummary(hist)
+        previous = self.lastSnapshot
+        for channel,values in channels.items():
+            if previous is not None and now > previous['time']:
+                before = previous['channels'].get(channel,{}).get('sent',0)
+                values['rate'] = round((values.get('sent',0) - before) / (now - previous['time']),3)
+        result = dict(time=now,uptime=round(now - self.started,3),channels=channels,
+                successfulAlertCount=sum([v.get('sent',0) for v in channels.values()]),
+                failedAlertCount=sum([v.get('failed',0) for v in channels.values()]))
+        for name,fn in self.gauges.items():
+            try:
+                result[name] = fn()
+            except Exception as ex:
+                getLogger().error('Gauge {} failed: {}'.format(name,ex))
+        self.lastSnapshot = dict(time=now,channels=dict([(ch,dict(sent=v.get('sent',0))) \
+                for ch,v in channels.items()]))
+        return result
+
+def histogramSummary(hist):
+    ''' Count and percentile estimates for a latency histogram. '''
+    total = sum(hist)
+    result = dict(count=total,buckets=list(hist))
+    for name,fraction in (('p50',0.5),('p90',0.9),('p99',0.99)):
+        if total == 0:
+            result[name] = None
+            continue
+        target = fraction * total
+        running = 0
+        for i,n in enumerate(hist):
+            running += n
+            if running >= target:
+                result[name] = LATENCY_BOUNDS[i] if i < len(LATENCY_BOUNDS) else None
+                break
+    return result
+
+#####################
+# Publishing snapshots.
+#####################
+SHM_HEADER = struct.Struct('<QI')
+
+# Segments created by SnapshotWriters in this process.
+OWNED_SEGMENTS = set()
+
+class SnapshotWriter:
+    '''
+    Write metrics.snapshot() every interval seconds to statusFile
+    and/or the shared memory segment named shmName.
+    '''
+
+    def __init__(self,metrics,statusFile=None,interval=5,shmName=None,shmSize=64*1024):
+        self.metrics = metrics
+        self.statusFile = statusFile
+        self.interval = interval
+        self.shm = None
+        self.seq = 0
+        if shmName is not None:
+            from multiprocessing import shared_memory
+            try:
+                self.shm = shared_memory.SharedMemory(name=shmName,create=True,size=shmSize)
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=shmName)
+            OWNED_SEGMENTS.add(shmName)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def write(self):
+        ''' Write one snapshot now. '''
+        snap = self.metrics.snapshot()
+        data = json.dumps(snap).encode('utf-8')
+        if self.statusFile is not None:
+            tmp = '{}.tmp{}'.format(self.statusFile,os.getpid())
+            with open(tmp,'wb') as outf:
+                outf.write(data)
+            os.replace(tmp,self.statusFile)
+        if self.shm is not None:
+            buf = self.shm.buf
+            if SHM_HEADER.size + len(data) > len(buf):
+                getLogger().error('Snapshot of {} bytes does not fit in shared memory.'.format(len(data)))
+            else:
+                self.seq += 1
+                SHM_HEADER.pack_into(buf,0,self.seq,0)
+                buf[SHM_HEADER.size:SHM_HEADER.size+len(data)] = data
+                self.seq += 1
+                SHM_HEADER.pack_into(buf,0,self.seq,len(data))
+        return snap
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.write()
+            except OSError as ex:
+                getLogger().error('Could not write status: {}'.format(ex))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name='alert-metrics',daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop the thread, write a final snapshot and release the segment. '''
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
+        if self.shm is not None:
+            OWNED_SEGMENTS.discard(self.shm.name)
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+def attachShared(shmName):
+    '''
+    Attach to an existing segment without letting this process's
+    resource tracker unlink it at exit; the writer owns it.
+    '''
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=shmName,track=False)
+    except TypeError:
+        # Before Python 3.13 every attach is tracked.
+        shm = shared_memory.SharedMemory(name=shmName)
+        if shmName not in OWNED_SEGMENTS:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name,'shared_memory')
+        return shm
+
+def readSharedSnapshot(shmName,retries=100):
+    '''
+    Read the latest snapshot from the shared memory segment shmName.
+    Return None if there is no segment or no snapshot yet.
+    '''
+    try:
+        shm = attachShared(shmName)
+    except FileNotFoundError:
+        return None
+    try:
+        buf = shm.buf
+        for i in range(retries):
+            seq,length = SHM_HEADER.unpack_from(buf,0)
+            if seq == 0:
+                return None
+            if seq % 2 == 1:
+                continue
+            data = bytes(buf[SHM_HEADER.size:SHM_HEADER.size+length])
+            if SHM_HEADER.unpack_from(buf,0)[0] == seq:
+                return json.loads(data.decode('utf-8'))
+        return None
+    finally:
+        shm.close()
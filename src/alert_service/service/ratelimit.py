@@ -0,0 +1,198 @@
+'''
+Pacing deliveries to the providers' limits.
+
+Each medium's worker threads take a token before every delivery from
+the token buckets that apply to it, and wait when one is empty:
+
+  * the medium's provider limits (Twilio's messages per second for
+    the account, the SMTP relay's messages per day, ...);
+  * the sender's limits, per From number or address;
+  * optionally the recipient's limits, per To number or address.
+
+A limit is written "count/period", the period being s, m, h, d or a
+number of seconds, and a scope may have several, separated by commas,
+eg "10/s, 250000/d". On the command line each is given as
+
+    --rate-limit sms=10/s,250000/d --rate-limit sms.sender=1/s
+
+Deliveries are paced at `headroom` (90% by default) of the limits, to
+stay just under them. Waiting callers take their tokens in the order
+they asked (see TokenBucket.reserve()), so a worker is not starved by
+others that happened to wake first.
+
+The time each delivery waited is recorded in the metrics as the
+"wait.<medium>" latency histogram, and waits as the medium's
+"rateLimited" count. When the supervisor runs several processes, each
+gets its share of the provider and sender limits (see scaleLimits()).
+
+The web service paces its own sends with a copy of the parsing and the
+buckets (unter.controllers.ratelimit); its tests check that the two
+agree.
+'''
+import threading
+import time
+
+__all__ = ['TokenBucket','RateLimiter','parseLimits','parseLimitOptions','scaleLimits','SCOPES']
+
+PERIODS = {'s':1,'m':60,'h':3600,'d':86400}
+
+# Scopes of limits, in the order their buckets are taken.
+PROVIDER = 'provider'
+SENDER = 'sender'
+RECIPIENT = 'recipient'
+SCOPES = (PROVIDER,SENDER,RECIPIENT)
+
+def parseLimits(text):
+    '''
+    Parse "count/period, ..." into a list of (count,seconds). None or
+    an empty string means no limits.
+    '''
+    limits = []
+    if text is None:
+        return limits
+    for part in str(text).split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        count,period = part.split('/',1)
+        period = period.strip()
+        seconds = PERIODS.get(period)
+        if seconds is None:
+            seconds = float(period)
+        limits.append((float(count),seconds))
+    return limits
+
+def parseLimitOptions(options):
+    '''
+    Parse --rate-limit options, "medium=limits" for the provider or
+    "medium.scope=limits", into a dict of medium: {scope: limits}.
+    '''
+    limits = {}
+    for option in options or []:
+        name,spec = option.split('=',1)
+        medium,scope = (name.strip().split('.',1) + [PROVIDER])[:2]
+        if scope not in SCOPES:
+            raise ValueError('Unknown rate limit scope {} in {}'.format(scope,option))
+        limits.setdefault(medium,{})[scope] = parseLimits(spec)
+    return limits
+
+def scaleLimits(limits,fraction,scopes=SCOPES):
+    '''
+    limits, a dict of medium: {scope: [(count,seconds)]}, with the
+    counts for scopes multiplied by fraction.
+    '''
+    scaled = {}
+    for medium,byScope in (limits or {}).items():
+        scaled[medium] = dict([(scope,[(count * fraction if scope in scopes else count,seconds) \
+                for count,seconds in specs]) for scope,specs in byScope.items()])
+    return scaled
+
+class TokenBucket:
+    '''
+    At most `capacity` takes per `window` seconds, refilled
+    continuously. take() takes a token only if there is one;
+    reserve() always takes one, going into debt if need be, and
+    returns how long the caller must wait for it.
+    '''
+
+    def __init__(self,capacity,window,clock=time.time):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self,now=None):
+        if now is None:
+            now = self.clock()
+        self.tokens = min(self.capacity,self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self,now=None):
+        ''' Take a token. Return the seconds until it is really ours. '''
+        self.refill(now)
+        self.tokens -= 1
+        return max(0,-self.tokens / self.rate)
+
+    def nextToken(self):
+        ''' Seconds until a token is available. '''
+        self.refill()
+        return max(0,(1 - self.tokens) / self.rate)
+
+    def full(self,now=None):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class RateLimiter:
+    '''
+    The limits for every medium: limits maps a medium to a dict of
+    scope (in SCOPES) to a list of (count,seconds), as from
+    parseLimits(). Media with no limits are not held up.
+    '''
+
+    # Drop idle sender and recipient buckets every this many deliveries.
+    PRUNE_EVERY = 1000
+
+    def __init__(self,limits=None,headroom=0.9,clock=time.time,sleep=time.sleep):
+        self.limits = {}
+        for medium,byScope in (limits or {}).items():
+            self.limits[medium] = dict([(scope,[(count * headroom,seconds) for count,seconds in specs]) \
+                    for scope,specs in byScope.items() if len(specs) > 0])
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.pausedUntil = {}
+        self.reserved = 0
+
+    def bucketsFor(self,medium,scope,key):
+        buckets = self.buckets.get((medium,scope,key))
+        if buckets is None:
+            buckets = [TokenBucket(count,seconds,self.clock) \
+                    for count,seconds in self.limits[medium][scope]]
+            self.buckets[(medium,scope,key)] = buckets
+        return buckets
+
+    def reserve(self,medium,sender=None,recipient=None):
+        ''' Take a token from every bucket that applies. Return the seconds to wait. '''
+        limits = self.limits.get(medium)
+        if limits is None and medium not in self.pausedUntil:
+            return 0
+        keys = {PROVIDER:None,SENDER:sender,RECIPIENT:recipient}
+        with self.lock:
+            now = self.clock()
+            wait = max(0,self.pausedUntil.get(medium,0) - now)
+            for scope in SCOPES:
+                if scope not in (limits or {}) or (scope != PROVIDER and keys[scope] is None):
+                    continue
+                for bucket in self.bucketsFor(medium,scope,keys[scope]):
+                    wait = max(wait,bucket.reserve(now))
+            self.reserved += 1
+            if self.reserved % self.PRUNE_EVERY == 0:
+                self.prune(now)
+        return wait
+
+    def wait(self,medium,sender=None,recipient=None):
+        ''' Wait until a delivery is within medium's limits. Return the seconds waited. '''
+        wait = self.reserve(medium,sender,recipient)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def penalize(self,medium,seconds):
+        ''' medium's provider throttled us: hold its deliveries for seconds. '''
+        with self.lock:
+            self.pausedUntil[medium] = max(self.pausedUntil.get(medium,0),self.clock() + seconds)
+
+    def prune(self,now):
+        ''' Forget sender and recipient buckets that have refilled. Call with self.lock held. '''
+        for key,buckets in list(self.buckets.items()):
+            if key[1] != PROVIDER and all([b.full(now) for b in buckets]):
+                del self.buckets[key]
@@ -0,0 +1,298 @@
+'''
+Retrying failed deliveries.
+
+When an alerter fails (returns False or raises), the alert is not
+lost: the RetryScheduler writes it to the retry directory, one JSON
+file per alert,
+
+  {"medium": "sms", "alert": {...}, "attempts": 1, "error": "...",
+   "firstFailure": 1760000000.5}
+
+named <due time_ns>-<pid>-<sequence>-<medium>.json, and keeps the due
+times in a heap per medium. A timer thread sleeps until the earliest
+one is due and hands it back to the service, which delivers it in the
+"retry" lane (see lanes.py), behind fresh alerts. Because the retries
+are files, they survive a restart: the heaps are rebuilt from the file
+names.
+
+A retry that fails again is rewritten in place and renamed for its
+next due time, and one that gives up is renamed into the dead-letter
+directory, so a crash never leaves two copies of it to be retried.
+
+Attempt n waits baseDelay * 2**(n-1) seconds, at most maxDelay, with
+"equal jitter" (a random delay between half and all of that), so
+alerts that failed together during an outage do not all come back at
+the same moment. Each medium also has a retry budget, a token bucket
+allowing `budget` retries per `budgetWindow` seconds; due retries
+beyond it wait for a token. So a provider outage costs at most the
+budget in retry attempts, however many alerts are failing. A medium
+out of tokens is passed over as a whole until its bucket refills, so
+its waiting retries are not touched in the meantime.
+
+After maxAttempts attempts, or on a failure that retrying cannot fix
+(see isPermanent()), the alert is moved to the dead-letter directory
+with its last error, for a person to look at. So is a retry file that
+cannot be parsed, as it is.
+'''
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import smtplib
+import threading
+import time
+
+from alert_service.service.ratelimit import TokenBucket
+
+__all__ = ['RetryScheduler','PermanentFailure','isPermanent']
+
+def getLogger():
+    return logging.getLogger('alert_svc.retry')
+
+class PermanentFailure(Exception):
+    ''' Raised by an alerter for a delivery that will never succeed. '''
+    permanent = True
+
+def isPermanent(error):
+    '''
+    True if error means retrying is pointless: it says so (a true
+    "permanent" attribute), the recipient was refused, or it is an HTTP
+    4xx error (eg an invalid number from Twilio) other than a timeout
+    or throttling.
+    '''
+    if error is None:
+        return False
+    if getattr(error,'permanent',False):
+        return True
+    if isinstance(error,smtplib.SMTPRecipientsRefused):
+        return True
+    status = getattr(error,'status',None)
+    return isinstance(status,int) and 400 <= status < 500 and status not in (408,429)
+
+class RetryScheduler:
+    '''
+    Persist and time retries. submit(entry) is called on the timer
+    thread when a retry is due; entry is a dict with the fields of
+    the retry file plus "path". The caller reports the outcome with
+    succeeded(entry) or failed(entry,error).
+    '''
+
+    def __init__(self,retryDir,deadDir,submit,maxAttempts=6,baseDelay=30,
+            maxDelay=3600,budget=60,budgetWindow=60,clock=time.time):
+        self.retryDir = retryDir
+        self.deadDir = deadDir
+        self.submit = submit
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.budget = budget
+        self.budgetWindow = budgetWindow
+        self.clock = clock
+        self.buckets = {}
+        # Medium: heap of (due,sequence,path).
+        self.heaps = {}
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.retried = 0
+        self.deadLettered = 0
+        os.makedirs(retryDir,exist_ok=True)
+        os.makedirs(deadDir,exist_ok=True)
+        self.load()
+
+    def load(self):
+        ''' Rebuild the heaps from the retry directory. '''
+        for name in os.listdir(self.retryDir):
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            path = os.path.join(self.retryDir,name)
+            parts = name[:-len('.json')].split('-',3)
+            try:
+                due = int(parts[0]) / 1e9
+                if len(parts) == 4:
+                    medium = parts[3]
+                else:
+                    # Named before the medium was part of the name.
+                    with open(path,'r') as inf:
+                        medium = json.load(inf)['medium']
+            except (OSError,ValueError,KeyError) as ex:
+                getLogger().error('Ignoring unexpected retry file {}: {}'.format(name,ex))
+                continue
+            self.heaps.setdefault(medium,[]).append((due,next(self.seq),path))
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+        if self.pending() > 0:
+            getLogger().info('{} retries pending'.format(self.pending()))
+
+    def delayFor(self,attempts):
+        ''' The backoff before retry number `attempts`, with jitter. '''
+        delay = min(self.maxDelay,self.baseDelay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2,delay)
+
+    def entryName(self,when,medium):
+        return '{:020d}-{}-{:06d}-{}.json'.format(int(when * 1e9),os.getpid(),next(self.seq),medium)
+
+    def writeEntry(self,dname,name,entry):
+        path = os.path.join(dname,name)
+        tmp = os.path.join(dname,'.' + name + '.tmp')
+        with open(tmp,'w') as outf:
+            json.dump(entry,outf)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.rename(tmp,path)
+        return path
+
+    def moveEntry(self,path,dname,name,entry):
+        '''
+        Save entry as dname/name. If it replaces the retry file path,
+        that file is rewritten with entry and then renamed, so there is
+        always exactly one copy of it.
+        '''
+        if path is None:
+            return self.writeEntry(dname,name,entry)
+        self.writeEntry(os.path.dirname(path),os.path.basename(path),entry)
+        newPath = os.path.join(dname,name)
+        try:
+            os.rename(path,newPath)
+        except OSError:
+            # Eg a dead-letter directory on another file system.
+            self.writeEntry(dname,name,entry)
+            self.remove(path)
+        return newPath
+
+    def schedule(self,medium,alert,error=None,attempts=0,firstFailure=None,path=None):
+        '''
+        Record a failed attempt (the attempts-th retry, 0 for the first
+        delivery) and schedule the next one, or dead-letter the alert
+        if it has had all its attempts or cannot succeed. path is the
+        retry file of the attempt that failed, if any, which is moved
+        rather than copied.
+        '''
+        now = self.clock()
+        entry = dict(medium=medium,alert=alert,attempts=attempts + 1,
+                error=None if error is None else str(error),
+                firstFailure=now if firstFailure is None else firstFailure)
+        if isPermanent(error) or attempts + 1 >= self.maxAttempts:
+            self.deadLetter(entry,path)
+            return None
+        due = now + self.delayFor(attempts + 1)
+        path = self.moveEntry(path,self.retryDir,self.entryName(due,medium),entry)
+        with self.cond:
+            heapq.heappush(self.heaps.setdefault(medium,[]),(due,next(self.seq),path))
+            self.cond.notify()
+        return path
+
+    def deadLetter(self,entry,path=None):
+        self.moveEntry(path,self.deadDir,self.entryName(self.clock(),entry['medium']),entry)
+        with self.cond:
+            self.deadLettered += 1
+        getLogger().error('Giving up on {} alert for event {} user {} after {} attempts: {}'.format(
+            entry['medium'],entry['alert'].get('neid'),entry['alert'].get('user_id'),
+            entry['attempts'],entry['error']))
+
+    def deadLetterFile(self,path):
+        ''' Move a retry file that cannot be read, as it is, to the dead-letter directory. Call with self.cond held. '''
+        try:
+            shutil.move(path,os.path.join(self.deadDir,os.path.basename(path)))
+        except OSError as ex:
+            getLogger().error('Cannot move {} to {}: {}'.format(path,self.deadDir,ex))
+            return
+        self.deadLettered += 1
+
+    def succeeded(self,entry):
+        self.remove(entry['path'])
+
+    def failed(self,entry,error):
+        self.schedule(entry['medium'],entry['alert'],error,entry['attempts'],entry['firstFailure'],
+                entry['path'])
+
+    def remove(self,path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def bucket(self,medium):
+        bucket = self.buckets.get(medium)
+        if bucket is None:
+            bucket = self.buckets[medium] = TokenBucket(self.budget,self.budgetWindow,self.clock)
+        return bucket
+
+    def pending(self):
+        ''' The number of retries waiting to be due. '''
+        return sum([len(heap) for heap in self.heaps.values()])
+
+    def nextDue(self):
+        '''
+        Pop the next due retry, within its medium's budget. Return
+        (entry,None), or (None,seconds to wait). A medium out of budget
+        is skipped, without reading its retries, until its next token.
+        '''
+        with self.cond:
+            while True:
+                now = self.clock()
+                ready = None
+                wait = None
+                for medium,heap in self.heaps.items():
+                    if len(heap) == 0:
+                        continue
+                    until = heap[0][0] - now
+                    if until <= 0:
+                        until = self.bucket(medium).nextToken()
+                    if until <= 0 and (ready is None or heap[0] < self.heaps[ready][0]):
+                        ready = medium
+                    elif until > 0 and (wait is None or until < wait):
+                        wait = until
+                if ready is None:
+                    return None,wait
+                due,seq,path = heapq.heappop(self.heaps[ready])
+                try:
+                    with open(path,'r') as inf:
+                        entry = json.load(inf)
+                except FileNotFoundError:
+                    continue
+                except ValueError as ex:
+                    getLogger().error('Unreadable retry {}, moving it to {}: {}'.format(
+                        path,self.deadDir,ex))
+                    self.deadLetterFile(path)
+                    continue
+                except OSError as ex:
+                    # Perhaps out of file handles: try it again later.
+                    getLogger().error('Cannot read retry {}: {}'.format(path,ex))
+                    heapq.heappush(self.heaps[ready],(now + self.baseDelay,next(self.seq),path))
+                    continue
+                self.bucket(ready).take()
+                entry['path'] = path
+                self.retried += 1
+                return entry,None
+
+    def run(self):
+        while True:
+            entry,wait = self.nextDue()
+            if entry is not None:
+                try:
+                    self.submit(entry)
+                except Exception as ex:
+                    getLogger().error('Could not resubmit {}: {}'.format(entry['path'],ex))
+                continue
+            with self.cond:
+                if self.stopping:
+                    return
+                self.cond.wait(wait)
+                if self.stopping:
+                    return
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name='alert-retry',daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,390 @@
+'''
+Run the alert service as several processes.
+
+One process delivers alerts with one core: rendering messages and the
+TLS work of talking to the providers all happen under one GIL. The
+Supervisor forks N worker processes, each running an AlertService,
+and keeps them running:
+
+  * shared mode: every worker watches the staging directory itself.
+    Claiming by rename already makes sure each file goes to exactly
+    one worker.
+
+  * sharded mode: the supervisor claims each file from the staging
+    directory and splits its alerts by recipient, hashing user_id (or
+    the phone number or address if there is none) into one of N
+    shard-<n> subdirectories, and worker n delivers shard n. All of a
+    recipient's alerts go to the same worker, which is what lets each
+    recipient's rate limits be kept whole by that worker rather than
+    divided. The split file keeps the original's name, so its lane
+    carries over, and the worker claims the shard's files in staging
+    order.
+
+    That is affinity, not ordering: a worker delivers with several
+    threads per medium, serves transactional alerts ahead of
+    broadcasts, and retries failures after a backoff, so two alerts
+    for one recipient can still be delivered out of order.
+
+A worker that dies is restarted, after a delay that doubles with each
+crash in a row (up to maxRestartDelay) so a worker that cannot start
+does not spin.
+
+Each worker writes its status to <statusDir>/worker-<n>.json, and
+the supervisor combines them, every statusInterval seconds, into one
+snapshot in the usual form (see metrics.py): counts and latency
+histograms summed, percentiles recomputed from the summed histograms,
+and a "workers" list with each worker's pid and restart count.
+
+Files the supervisor claims but cannot read are moved to the
+dead-letter directory (deadDir, or <stagingDir>/dead). At startup it
+puts back the files that a supervisor which has died left claimed.
+
+Retry directories are per worker, <retryDir>/worker-<n>, since each
+RetryScheduler owns the files it loads. The alert log directory is
+shared.
+
+Rate limits (see ratelimit.py) are divided among the workers: each
+gets 1/N of the provider and sender limits, and of the recipient
+limits too in shared mode, where a recipient's alerts may go to any
+worker.
+'''
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import threading
+import time
+import zlib
+
+from alert_service.service.alert_svc import scanBatches, claimSuffix, claimOwner, claimAbandoned
+from alert_service.service.metrics import SnapshotWriter, histogramSummary
+from alert_service.service.ratelimit import scaleLimits, PROVIDER, SENDER, RECIPIENT
+from alert_service.service.watcher import makeWatcher
+
+__all__ = ['Supervisor','shardFor','mergeStatus']
+
+def getLogger():
+    return logging.getLogger('alert_svc.supervisor')
+
+def recipientKey(alert):
+    for field in ('user_id','phone','email'):
+        if alert.get(field) is not None:
+            return str(alert[field])
+    return ''
+
+def shardFor(alert,shards):
+    '''
+    The shard for alert's recipient. crc32 rather than hash(), which
+    differs between processes.
+    '''
+    return zlib.crc32(recipientKey(alert).encode('utf-8')) % shards
+
+def mergeStatus(statuses):
+    ''' Combine worker status snapshots into one. '''
+    channels = {}
+    merged = dict(successfulAlertCount=0,failedAlertCount=0,queueDepth=0,oldestPendingAge=0,
+            retryPending=0,deadLettered=0)
+    for status in statuses:
+        for key in ('successfulAlertCount','failedAlertCount','queueDepth','retryPending',
+                'deadLettered'):
+            merged[key] += status.get(key) or 0
+        merged['oldestPendingAge'] = max(merged['oldestPendingAge'],status.get('oldestPendingAge') or 0)
+        for channel,values in status.get('channels',{}).items():
+            total = channels.setdefault(channel,{})
+            for name,value in values.items():
+                if name == 'latency':
+                    buckets = total.setdefault('buckets',[0] * len(value['buckets']))
+                    for i,n in enumerate(value['buckets']):
+                        buckets[i] += n
+                elif isinstance(value,(int,float)):
+                    total[name] = total.get(name,0) + value
+    for channel,total in channels.items():
+        if 'buckets' in total:
+            total['latency'] = histogramSummary(total.pop('buckets'))
+        if 'rate' in total:
+            total['rate'] = round(total['rate'],3)
+    merged['channels'] = channels
+    return merged
+
+def runWorker(index,stagingDir,alerters,options):
+    ''' The body of a worker process. '''
+    from alert_service.service.daemon import AlertService
+    svc = AlertService(stagingDir,alerters,**options)
+    signal.signal(signal.SIGTERM,lambda sig,frame: svc.stopping.set())
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    svc.start()
+    while not svc.stopping.wait(1):
+        pass
+    svc.stop()
+
+class Worker:
+    ''' One worker process slot. '''
+
+    def __init__(self,index,stagingDir,options):
+        self.index = index
+        self.stagingDir = stagingDir
+        self.options = options
+        self.process = None
+        self.restarts = 0
+        self.crashes = 0
+        self.startAfter = 0
+        self.startedAt = 0
+
+    def statusFile(self):
+        return self.options.get('statusFile')
+
+    def describe(self):
+        return dict(index=self.index,pid=None if self.process is None else self.process.pid,
+                alive=self.process is not None and self.process.is_alive(),restarts=self.restarts)
+
+class Supervisor:
+    '''
+    Fork `processes` workers delivering the alerts staged in
+    stagingDir with `alerters` (see AlertService), sharded by recipient
+    if `sharded`. serviceOptions are passed to each worker's
+    AlertService; its statusFile, shmName and retryDir are made per
+    worker as described in the module docstring.
+    '''
+
+    def __init__(self,stagingDir,alerters,processes=None,sharded=True,statusFile=None,
+            statusInterval=5,shmName=None,statusDir=None,serviceOptions=None,pollInterval=5,
+            scanBatchSize=1000,maxRestartDelay=30,claimTimeout=300):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.stagingDir = stagingDir
+        self.alerters = alerters
+        self.processes = processes
+        self.sharded = sharded
+        self.statusInterval = statusInterval
+        self.pollInterval = pollInterval
+        self.scanBatchSize = scanBatchSize
+        self.maxRestartDelay = maxRestartDelay
+        self.claimDir = os.path.join(stagingDir,'claimed')
+        os.makedirs(self.claimDir,exist_ok=True)
+        self.claimSuffix = claimSuffix()
+        self.claimTimeout = claimTimeout
+        if statusDir is None:
+            statusDir = os.path.join(stagingDir,'status')
+        os.makedirs(statusDir,exist_ok=True)
+        self.started = time.time()
+        self.context = multiprocessing.get_context('fork')
+        self.stopping = threading.Event()
+        self.watcher = None
+        self.workers = []
+        serviceOptions = dict(serviceOptions or {})
+        for option in ('statusFile','shmName','statusInterval'):
+            serviceOptions.pop(option,None)
+        retryDir = serviceOptions.pop('retryDir',None)
+        if retryDir is not None and serviceOptions.get('deadDir') is None:
+            serviceOptions['deadDir'] = os.path.join(retryDir,'dead')
+        # Where files the supervisor cannot read are put.
+        self.deadDir = serviceOptions.get('deadDir') or os.path.join(stagingDir,'dead')
+        if serviceOptions.get('rateLimits'):
+            scopes = (PROVIDER,SENDER) if sharded else (PROVIDER,SENDER,RECIPIENT)
+            serviceOptions['rateLimits'] = scaleLimits(serviceOptions['rateLimits'],
+                    1.0 / processes,scopes)
+        for index in range(processes):
+            options = dict(serviceOptions,statusInterval=statusInterval,
+                    statusFile=os.path.join(statusDir,'worker-{}.json'.format(index)))
+            if retryDir is not None:
+                options['retryDir'] = os.path.join(retryDir,'worker-{}'.format(index))
+            workerDir = stagingDir
+            if sharded:
+                workerDir = os.path.join(stagingDir,'shard-{}'.format(index))
+                os.makedirs(workerDir,exist_ok=True)
+            self.workers.append(Worker(index,workerDir,options))
+        self.statusWriter = SnapshotWriter(self,statusFile,statusInterval,shmName)
+
+    #####################
+    # Worker processes.
+    #####################
+    def startWorker(self,worker):
+        worker.process = self.context.Process(target=runWorker,
+                args=(worker.index,worker.stagingDir,self.alerters,worker.options),
+                name='alert-worker-{}'.format(worker.index),daemon=False)
+        worker.process.start()
+        worker.startedAt = time.time()
+        getLogger().info('Started worker {} (pid {})'.format(worker.index,worker.process.pid))
+
+    def checkWorkers(self):
+        ''' Start workers that are not running, restarting any that died. '''
+        now = time.time()
+        for worker in self.workers:
+            process = worker.process
+            if process is not None:
+                if process.is_alive():
+                    if now - worker.startedAt > self.maxRestartDelay:
+                        worker.crashes = 0
+                    continue
+                process.join()
+                worker.process = None
+                worker.crashes += 1
+                worker.restarts += 1
+                delay = min(self.maxRestartDelay,2 ** (worker.crashes - 1) - 1)
+                getLogger().error('Worker {} (pid {}) exited with {}; restarting in {}s'.format(
+                    worker.index,process.pid,process.exitcode,delay))
+                worker.startAfter = now + delay
+            if now >= worker.startAfter:
+                self.startWorker(worker)
+
+    def stopWorkers(self,timeout=30):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid,signal.SIGTERM)
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0,deadline - time.time()))
+            if worker.process.is_alive():
+                getLogger().error('Worker {} did not stop; killing it.'.format(worker.index))
+                worker.process.kill()
+                worker.process.join()
+
+    #####################
+    # Splitting staged files into shards.
+    #####################
+    def split(self,path):
+        ''' Claim the file at path and split its alerts into the shards. '''
+        name = os.path.basename(path)
+        claimed = os.path.join(self.claimDir,name + self.claimSuffix)
+        try:
+            os.rename(path,claimed)
+            os.utime(claimed)
+        except FileNotFoundError:
+            return False
+        try:
+            with open(claimed,'r') as inf:
+                text = inf.read()
+        except (OSError,ValueError) as ex:
+            getLogger().error('Cannot read {}, moving it to {}: {}'.format(path,self.deadDir,ex))
+            self.deadLetter(claimed,name)
+            return True
+        shards = {}
+        for line in splitRecords(text):
+            try:
+                alert = json.loads(line)
+            except ValueError:
+                alert = None
+            index = shardFor(alert,self.processes) if isinstance(alert,dict) else 0
+            # Unreadable lines go to shard 0, whose worker counts them as failures.
+            shards.setdefault(index,[]).append(line)
+        for index,lines in shards.items():
+            shardDir = self.workers[index].stagingDir
+            tmp = os.path.join(shardDir,'.' + name + '.tmp')
+            with open(tmp,'w') as outf:
+                outf.write('\n'.join(lines) + '\n')
+            os.rename(tmp,os.path.join(shardDir,name))
+        os.unlink(claimed)
+        return True
+
+    def deadLetter(self,claimed,name):
+        ''' Move an unreadable claimed file to the dead-letter directory. '''
+        try:
+            os.makedirs(self.deadDir,exist_ok=True)
+            shutil.move(claimed,os.path.join(self.deadDir,name))
+        except OSError as ex:
+            getLogger().error('Cannot move {} to {}: {}'.format(claimed,self.deadDir,ex))
+
+    def recoverClaims(self):
+        '''
+        Put back files that a supervisor which has died claimed but did
+        not finish splitting (see alert_svc.claimAbandoned()).
+        '''
+        cutoff = time.time() - self.claimTimeout
+        for entry in os.scandir(self.claimDir):
+            try:
+                if entry.name.endswith(self.claimSuffix) or \
+                        not claimAbandoned(entry.name,entry.stat().st_mtime,cutoff):
+                    continue
+                os.rename(entry.path,os.path.join(self.stagingDir,claimOwner(entry.name)[0]))
+                getLogger().warning('Recovered abandoned alert {}'.format(entry.name))
+            except FileNotFoundError:
+                pass
+
+    def splitAll(self):
+        count = 0
+        for batch in scanBatches(self.stagingDir,self.scanBatchSize):
+            for path in batch:
+                if self.stopping.is_set():
+                    return count
+                if self.split(path):
+                    count += 1
+        return count
+
+    #####################
+    # Status.
+    #####################
+    def snapshot(self):
+        ''' The combined status of the workers (used by the SnapshotWriter). '''
+        statuses = []
+        for worker in self.workers:
+            try:
+                with open(worker.statusFile(),'r') as inf:
+                    statuses.append(json.load(inf))
+            except (OSError,ValueError):
+                pass
+        now = time.time()
+        merged = mergeStatus(statuses)
+        merged.update(time=now,uptime=round(now - self.started,3),
+                workers=[w.describe() for w in self.workers])
+        return merged
+
+    def status(self):
+        snap = self.snapshot()
+        return dict(successfulAlertCount=snap['successfulAlertCount'],
+                failedAlertCount=snap['failedAlertCount'])
+
+    #####################
+    # The main loop.
+    #####################
+    def run(self):
+        ''' Supervise, and split if sharded, until stop(). '''
+        if self.sharded:
+            self.recoverClaims()
+            self.watcher = makeWatcher(self.stagingDir,self.pollInterval)
+            self.splitAll()
+        self.checkWorkers()
+        self.statusWriter.start()
+        lastScan = time.time()
+        while not self.stopping.is_set():
+            if self.sharded:
+                names = self.watcher.wait(1)
+                if names is None or time.time() - lastScan >= 60:
+                    self.splitAll()
+                    lastScan = time.time()
+                else:
+                    for name in sorted(names):
+                        self.split(os.path.join(self.stagingDir,name))
+            else:
+                self.stopping.wait(1)
+            self.checkWorkers()
+        self.stopWorkers()
+        self.statusWriter.stop()
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name='alert-supervisor',daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopping.set()
+        if self.watcher is not None:
+            self.watcher.wake()
+        thread = getattr(self,'thread',None)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+def splitRecords(text):
+    ''' The JSON records in an alert file: one object, or one per line. '''
+    try:
+        alert = json.loads(text)
+        if isinstance(alert,dict):
+            return [json.dumps(alert)]
+    except ValueError:
+        pass
+    return [line for line in text.splitlines() if line.strip() != '']
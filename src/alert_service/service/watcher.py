@@ -0,0 +1,125 @@
+'''
+Watch the staging directory for new alert files.
+
+On Linux the directory is watched with inotify (through ctypes, so
+no extra packages are needed), and a new file is seen as soon as it
+is renamed into the directory. Elsewhere, or if inotify cannot be
+set up, the directory is polled.
+
+A watcher's wait(timeout) returns either a list of new file names, or
+None, meaning "something may have changed, rescan the directory".
+wake() makes a wait() in another thread return early.
+'''
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+__all__ = ['InotifyWatcher','PollingWatcher','makeWatcher']
+
+def getLogger():
+    return logging.getLogger('alert_svc.watcher')
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class PollingWatcher:
+    ''' Ask for a rescan every pollInterval seconds. '''
+
+    def __init__(self,dname,pollInterval=5):
+        self.dname = dname
+        self.pollInterval = pollInterval
+        self.woken = threading.Event()
+
+    def wait(self,timeout=None):
+        if timeout is None or timeout > self.pollInterval:
+            timeout = self.pollInterval
+        self.woken.wait(timeout)
+        self.woken.clear()
+        return None
+
+    def wake(self):
+        self.woken.set()
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    '''
+    Report files renamed into, or written and closed in, dname.
+    Only names ending with suffix are reported.
+    '''
+
+    def __init__(self,dname,suffix='.json'):
+        self.dname = dname
+        self.suffix = suffix
+        libcName = ctypes.util.find_library('c')
+        if libcName is None:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(libcName,use_errno=True)
+        if not hasattr(libc,'inotify_init1'):
+            raise OSError('inotify not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+        wd = libc.inotify_add_watch(self.fd,os.fsencode(dname),IN_MOVED_TO | IN_CLOSE_WRITE)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err,os.strerror(err),dname)
+        self.wakeRead,self.wakeWrite = os.pipe()
+
+    def wait(self,timeout=None):
+        ready,_,_ = select.select([self.fd,self.wakeRead],[],[],timeout)
+        if self.wakeRead in ready:
+            os.read(self.wakeRead,512)
+        if self.fd not in ready:
+            return []
+        try:
+            data = os.read(self.fd,64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset < len(data):
+            wd,mask,cookie,length = EVENT_HEADER.unpack_from(data,offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if mask & (IN_Q_OVERFLOW | IN_IGNORED):
+                # Events were lost, or the directory went away.
+                return None
+            name = os.fsdecode(name)
+            if name.endswith(self.suffix):
+                names.append(name)
+        return names
+
+    def wake(self):
+        os.write(self.wakeWrite,b'x')
+
+    def close(self):
+        if self.fd >= 0:
+            for fd in (self.fd,self.wakeRead,self.wakeWrite):
+                os.close(fd)
+            self.fd = -1
+
+def makeWatcher(dname,pollInterval=5,suffix='.json'):
+    ''' Get an inotify watcher for dname if possible, else a polling one. '''
+    try:
+        watcher = InotifyWatcher(dname,suffix)
+        getLogger().info('Watching {} with inotify.'.format(dname))
+        return watcher
+    except (OSError,AttributeError) as ex:
+        getLogger().info('inotify unavailable ({}), polling {} every {}s.'.format(ex,dname,pollInterval))
+        return PollingWatcher(dname,pollInterval)
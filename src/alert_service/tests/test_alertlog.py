@@ -0,0 +1,118 @@
+'''
+Test the alert activity log: records are appended as JSONL, segments
+rotate by size, and the log can be paged, searched by event and
+recipient, and queried by time through the indexes.
+'''
+import json
+import os
+import shutil
+import time
+from nose.tools import ok_, eq_
+
+from ..service.alertlog import AlertLog, AlertLogReader
+
+LOG_DIR = '_alert_svc_log'
+
+class TestAlertLog:
+
+    def setUp(self):
+        shutil.rmtree(LOG_DIR,ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(LOG_DIR,ignore_errors=True)
+
+    def writeLog(self,count,maxBytes=64*1024*1024,close=True):
+        log = AlertLog(LOG_DIR,maxBytes=maxBytes)
+        for n in range(count):
+            log.write(dict(ts=1000.0 + n,neid=n % 10,user_id=n % 7,channel='sms',ok=True,n=n))
+        if close:
+            log.close()
+        return log
+
+    def test_0_jsonl(self):
+        ''' Segments are plain JSONL. '''
+        self.writeLog(5)
+        segments = AlertLogReader(LOG_DIR).segments()
+        eq_(1,len(segments))
+        with open(segments[0] + '.jsonl') as inf:
+            eq_(list(range(5)),[json.loads(line)['n'] for line in inf])
+
+    def test_1_rotation(self):
+        ''' A new segment is started when the current one is full. '''
+        self.writeLog(100,maxBytes=1000)
+        reader = AlertLogReader(LOG_DIR)
+        ok_(len(reader.segments()) > 5,reader.segments())
+        for base in reader.segments():
+            ok_(os.path.getsize(base + '.jsonl') <= 1000)
+            ok_(os.path.exists(base + '.evt') and os.path.exists(base + '.usr'))
+
+    def test_2_paging(self):
+        ''' Paging returns every record once, newest first, across segments. '''
+        self.writeLog(100,maxBytes=1000)
+        reader = AlertLogReader(LOG_DIR)
+        seen = []
+        cursor = None
+        while True:
+            records,cursor = reader.page(cursor,limit=7)
+            ok_(len(records) <= 7)
+            seen.extend([r['n'] for r in records])
+            if cursor is None:
+                break
+        eq_(list(range(99,-1,-1)),seen)
+
+    def test_3_findByEventAndRecipient(self):
+        ''' Records are found by event, by recipient and by both. '''
+        self.writeLog(100,maxBytes=1000)
+        reader = AlertLogReader(LOG_DIR)
+        eq_([n for n in range(99,-1,-1) if n % 10 == 4],[r['n'] for r in reader.find(neid=4)])
+        eq_([n for n in range(99,-1,-1) if n % 7 == 3],[r['n'] for r in reader.find(user_id=3)])
+        eq_([n for n in range(99,-1,-1) if n % 10 == 4 and n % 7 == 3],
+                [r['n'] for r in reader.find(neid=4,user_id=3)])
+        eq_([],reader.find(neid=11))
+        eq_(3,len(reader.find(neid=4,limit=3)))
+
+    def test_4_findInOpenSegment(self):
+        ''' The segment still being written is searched too. '''
+        log = self.writeLog(20,close=False)
+        try:
+            eq_([12,2],[r['n'] for r in AlertLogReader(LOG_DIR).find(neid=2)])
+        finally:
+            log.close()
+
+    def test_5_timeRange(self):
+        ''' between() returns the records in a time range. '''
+        self.writeLog(100,maxBytes=1000)
+        records = AlertLogReader(LOG_DIR).between(1010.0,1030.0)
+        eq_(list(range(29,9,-1)),[r['n'] for r in records])
+
+    def test_6_recoverUnclosed(self):
+        ''' Segments left open by a dead process are indexed on restart. '''
+        log = self.writeLog(10,close=False)
+        log.log.close()
+        log.idx.close()
+        self.writeLog(0)
+        first = AlertLogReader(LOG_DIR).segments()[0]
+        ok_(os.path.exists(first + '.usr'))
+        eq_([5],[r['n'] for r in AlertLogReader(LOG_DIR).find(neid=5)])
+
+    def test_7_timestamped(self):
+        ''' Records without a timestamp get one. '''
+        log = AlertLog(LOG_DIR)
+        before = time.time()
+        log.write(dict(neid=1,user_id=2,ok=False))
+        log.close()
+        record = AlertLogReader(LOG_DIR).find(neid=1)[0]
+        ok_(record['ts'] >= before)
+        eq_(False,record['ok'])
+
+    def test_8_badCursor(self):
+        ''' A malformed cursor is refused. '''
+        self.writeLog(10)
+        reader = AlertLogReader(LOG_DIR)
+        for cursor in ('garbage','alerts-1:x','../etc/passwd:3'):
+            try:
+                reader.page(cursor)
+            except ValueError:
+                pass
+            else:
+                ok_(False,cursor)
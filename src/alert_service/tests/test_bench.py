@@ -0,0 +1,42 @@
+'''
+Smoke-test the benchmark harness on a small load, so it keeps
+working as the service changes.
+'''
+from nose.tools import ok_, eq_
+
+from ..bench.bench_pipeline import burst, soak, StubSink
+
+class TestBench:
+
+    def test_0_burst(self):
+        ''' A burst delivers every alert and reports its figures. '''
+        result = burst(alerts=300,batch=25,smsWorkers=4,emailWorkers=2,timeout=30)
+        eq_(300,result['delivered'])
+        ok_(result['alertsPerSecond'] > 0)
+        ok_(0 <= result['p50'] <= result['p99'])
+        ok_(result['peakRss'] > 0)
+
+    def test_1_failuresRetried(self):
+        ''' With retries, alerts that fail at first are all delivered. '''
+        result = burst(alerts=100,failureRate=0.2,retry=True,seed=1,timeout=30)
+        eq_(100,result['delivered'])
+        ok_(result['failures'] > 0)
+
+    def test_2_soak(self):
+        ''' A short soak reports each interval. '''
+        lines = []
+        results = soak(rate=200,duration=0.5,report=0.2,out=lines.append)
+        ok_(len(results) >= 2,results)
+        eq_(len(results) + 1,len(lines))
+        ok_(results[-1]['written'] > 0)
+
+    def test_3_stubFailures(self):
+        ''' The stub sink fails at its configured rate. '''
+        sink = StubSink(failureRate=1.0)
+        eq_(False,sink(message='bench 0'))
+        try:
+            sink(message='bench 0')
+            ok_(False,'expected a failure')
+        except OSError:
+            pass
+        eq_(2,sink.failed)
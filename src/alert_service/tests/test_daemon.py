@@ -0,0 +1,327 @@
+'''
+Test the alert service daemon: files renamed into the staging
+directory are delivered once each, by the right media, whether the
+directory is watched with inotify or polled, and when several
+services share the directory.
+'''
+import json
+import os
+import shutil
+import threading
+import time
+import logging
+from pathlib import Path
+from nose.tools import ok_, eq_
+
+from ..service import AlertService
+from ..service.alert_svc import claimSuffix
+from ..service.watcher import InotifyWatcher, PollingWatcher
+
+TEST_DIR='_alert_svc_daemon'
+
+class RecordingAlerter:
+    ''' An alerter that records what it was asked to send. '''
+
+    def __init__(self,delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def __call__(self,**kwargs):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls.append(kwargs)
+
+def stageAlert(n,**alert):
+    ''' Write an alert file the way the web service does: write, then rename. '''
+    tmp = Path(TEST_DIR,'..','_alert_{}.tmp'.format(n))
+    with open(tmp,'w') as outf:
+        json.dump(alert,outf)
+    os.rename(tmp,Path(TEST_DIR,'{:06d}.json'.format(n)))
+
+def waitFor(condition,timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+def deadPid():
+    ''' The pid of a process that has exited. '''
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid,0)
+    return pid
+
+class TestDaemon:
+
+    def setUp(self):
+        shutil.rmtree(TEST_DIR,ignore_errors=True)
+        os.mkdir(TEST_DIR)
+        self.sms = RecordingAlerter()
+        self.email = RecordingAlerter()
+        self.services = []
+
+    def tearDown(self):
+        for svc in self.services:
+            svc.stop()
+        try:
+            shutil.rmtree(TEST_DIR)
+        except:
+            logging.getLogger('unter.alert_svc.test').error('Could not delete {}'.\
+                    format(TEST_DIR))
+
+    def startService(self,**kwargs):
+        svc = AlertService(TEST_DIR,{'sms':self.sms,'email':self.email},**kwargs)
+        self.services.append(svc)
+        svc.start()
+        return svc
+
+    def sentCount(self):
+        return len(self.sms.calls) + len(self.email.calls)
+
+    def test_0_inotifyUsed(self):
+        ''' On Linux the staging directory is watched with inotify. '''
+        svc = self.startService()
+        ok_(isinstance(svc.watcher,InotifyWatcher),svc.watcher)
+
+    def test_1_deliverByMedium(self):
+        ''' Each alert goes to the media it names, and its file is removed. '''
+        svc = self.startService(pollInterval=30)
+        stageAlert(1,phone='+15550000001',message='sms only')
+        stageAlert(2,email='a@example.com',subject='Hi',message='email only')
+        stageAlert(3,phone='+15550000003',email='b@example.com',message='both')
+        ok_(waitFor(lambda: svc.status()['successfulAlertCount'] == 4),svc.status())
+        eq_(['sms only','both'],sorted([c['message'] for c in self.sms.calls],reverse=True))
+        eq_(set(['email only','both']),set([c['message'] for c in self.email.calls]))
+        email = [c for c in self.email.calls if c['message'] == 'email only'][0]
+        eq_('a@example.com',email['toAddr'])
+        eq_('Hi',email['subject'])
+        ok_(waitFor(lambda: os.listdir(os.path.join(TEST_DIR,'claimed')) == []))
+        eq_(['claimed'],os.listdir(TEST_DIR))
+
+    def test_2_existingFilesOnStartup(self):
+        ''' Alerts staged before the service starts are delivered. '''
+        for n in range(5):
+            stageAlert(n,phone='+1555000000{}'.format(n),message='m{}'.format(n))
+        svc = self.startService()
+        ok_(waitFor(lambda: len(self.sms.calls) == 5),self.sms.calls)
+
+    def test_3_polling(self):
+        ''' The polling watcher also delivers new alerts. '''
+        svc = self.startService(watcher=PollingWatcher(TEST_DIR,0.05))
+        stageAlert(1,phone='+15550000001',message='polled')
+        ok_(waitFor(lambda: len(self.sms.calls) == 1),self.sms.calls)
+
+    def test_4_sharedDirectoryNoDuplicates(self):
+        ''' Services sharing a staging directory deliver each alert exactly once. '''
+        self.sms.delay = 0.001
+        for i in range(3):
+            self.startService(workers={'sms':2,'email':2})
+        for n in range(200):
+            stageAlert(n,phone='+1555{:07d}'.format(n),message='m{}'.format(n))
+        ok_(waitFor(lambda: len(self.sms.calls) >= 200,timeout=15),len(self.sms.calls))
+        time.sleep(0.2)
+        messages = [c['message'] for c in self.sms.calls]
+        eq_(200,len(messages))
+        eq_(200,len(set(messages)))
+
+    def test_5_badFilesCounted(self):
+        ''' Unreadable alerts are counted as failures and dead-lettered. '''
+        svc = self.startService()
+        Path(TEST_DIR,'_bad.tmp').write_text('{not json')
+        os.rename(Path(TEST_DIR,'_bad.tmp'),Path(TEST_DIR,'bad.json'))
+        Path(TEST_DIR,'_binary.tmp').write_bytes(b'\xff\xfe not text')
+        os.rename(Path(TEST_DIR,'_binary.tmp'),Path(TEST_DIR,'binary.json'))
+        ok_(waitFor(lambda: svc.status()['failedAlertCount'] == 2),svc.status())
+        ok_(waitFor(lambda: sorted(os.listdir(svc.deadDir)) == ['bad.json','binary.json']))
+        eq_('{not json\n',Path(svc.deadDir,'bad.json').read_text())
+        eq_(b'\xff\xfe not text',Path(svc.deadDir,'binary.json').read_bytes())
+        eq_([],os.listdir(os.path.join(TEST_DIR,'claimed')))
+
+    def test_6_abandonedClaimsRecovered(self):
+        ''' Files left claimed by a dead process are returned and delivered. '''
+        os.makedirs(os.path.join(TEST_DIR,'claimed'))
+        path = Path(TEST_DIR,'claimed','000001.json.otherhost.1234')
+        path.write_text(json.dumps(dict(phone='+15550000001',message='recovered')))
+        old = time.time() - 3600
+        os.utime(path,(old,old))
+        svc = self.startService(claimTimeout=60)
+        ok_(waitFor(lambda: len(self.sms.calls) == 1),self.sms.calls)
+        eq_('recovered',self.sms.calls[0]['message'])
+
+    def test_7_statusFile(self):
+        ''' The status file reports alert counts. '''
+        status = os.path.join(TEST_DIR,'..','_alert_svc_status.json')
+        svc = self.startService(statusFile=status,statusInterval=0.05)
+        stageAlert(1,phone='+15550000001',message='counted')
+        ok_(waitFor(lambda: os.path.exists(status) and \
+                json.load(open(status))['successfulAlertCount'] == 1))
+        svc.stop()
+        self.services.remove(svc)
+        os.unlink(status)
+
+    def test_8_batchFiles(self):
+        ''' A batch file is delivered one alert per line, each by its own channel. '''
+        svc = self.startService()
+        records = [dict(channel='sms',phone='+15550000001',message='s1',neid=1,user_id=1),
+                dict(channel='email',email='a@example.com',subject='S',message='e1',neid=1,user_id=1),
+                dict(channel='sms',phone='+15550000002',message='s2',neid=1,user_id=2),
+                dict(channel='sms',message='no phone',neid=1,user_id=3)]
+        tmp = Path(TEST_DIR,'_batch.tmp')
+        tmp.write_text('\n'.join([json.dumps(r) for r in records]) + '\n')
+        os.rename(tmp,Path(TEST_DIR,'000001.json'))
+        ok_(waitFor(lambda: svc.status()['failedAlertCount'] == 1 and \
+                svc.status()['successfulAlertCount'] == 3),svc.status())
+        eq_(['s1','s2'],sorted([c['message'] for c in self.sms.calls]))
+        eq_(['e1'],[c['message'] for c in self.email.calls])
+        # The undeliverable alert is kept.
+        ok_(waitFor(lambda: os.path.exists(os.path.join(svc.deadDir,'000001.json'))))
+        eq_([records[3]],[json.loads(line) for line in Path(svc.deadDir,'000001.json').read_text().splitlines()])
+
+    def test_9_alertLog(self):
+        ''' Every delivery attempt is recorded in the alert log. '''
+        from ..service.alertlog import AlertLogReader
+        logDir = os.path.join(TEST_DIR,'..','_alert_svc_daemon_log')
+        shutil.rmtree(logDir,ignore_errors=True)
+        try:
+            svc = self.startService(logDir=logDir)
+            records = [dict(channel='sms',phone='+15550000001',message='s1',neid=42,user_id=7),
+                    dict(channel='email',email='a@example.com',message='e1',neid=42,user_id=7),
+                    dict(channel='sms',phone='+15550000002',message='s2',neid=42,user_id=8)]
+            tmp = Path(TEST_DIR,'_batch.tmp')
+            tmp.write_text('\n'.join([json.dumps(r) for r in records]) + '\n')
+            os.rename(tmp,Path(TEST_DIR,'000001.json'))
+            ok_(waitFor(lambda: svc.status()['successfulAlertCount'] == 3),svc.status())
+            svc.stop()
+            self.services.remove(svc)
+            found = AlertLogReader(logDir).find(neid=42,user_id=7)
+            eq_(['email','sms'],sorted([r['channel'] for r in found]))
+            ok_(all([r['ok'] for r in found]))
+            eq_(['+15550000002'],[r['to'] for r in AlertLogReader(logDir).find(user_id=8)])
+        finally:
+            shutil.rmtree(logDir,ignore_errors=True)
+
+    def test_10_transactionalAheadOfBroadcast(self):
+        ''' A cancellation is delivered promptly while a large broadcast is queued. '''
+        self.sms.delay = 0.01
+        svc = self.startService(workers={'sms':2,'email':1})
+        records = [dict(lane='broadcast',phone='+1555{:07d}'.format(n),message='b{}'.format(n))
+                for n in range(300)]
+        tmp = Path(TEST_DIR,'_batch.tmp')
+        tmp.write_text('\n'.join([json.dumps(r) for r in records]) + '\n')
+        os.rename(tmp,Path(TEST_DIR,'000001.broadcast.json'))
+        ok_(waitFor(lambda: len(self.sms.calls) > 0))
+        stageAlert(2,lane='transactional',phone='+15559999999',message='cancelled')
+        ok_(waitFor(lambda: 'cancelled' in [c['message'] for c in self.sms.calls]))
+        messages = [c['message'] for c in self.sms.calls]
+        ok_(messages.index('cancelled') < 50,messages.index('cancelled'))
+        ok_(waitFor(lambda: len(self.sms.calls) == 301,timeout=15),len(self.sms.calls))
+
+    def test_11_broadcastFilesWaitOnDisk(self):
+        ''' Broadcast files stay in the staging directory while the backlog is full. '''
+        gate = threading.Event()
+        def blocked(**kwargs):
+            gate.wait()
+            self.sms(**kwargs)
+        svc = AlertService(TEST_DIR,{'sms':blocked},workers={'sms':1})
+        self.services.append(svc)
+        svc.start()
+        try:
+            for n in range(5):
+                tmp = Path(TEST_DIR,'_b{}.tmp'.format(n))
+                tmp.write_text(json.dumps(dict(lane='broadcast',phone='+1555000000{}'.format(n),
+                    message='b{}'.format(n))))
+                os.rename(tmp,Path(TEST_DIR,'{:06d}.broadcast.json'.format(n)))
+            staged = lambda: len([n for n in os.listdir(TEST_DIR) if n.endswith('.json')])
+            ok_(waitFor(lambda: staged() <= 4))
+            time.sleep(0.2)
+            ok_(staged() >= 3,os.listdir(TEST_DIR))
+            stageAlert(9,phone='+15559999999',message='confirmed')
+            ok_(waitFor(lambda: not Path(TEST_DIR,'000009.json').exists()))
+        finally:
+            gate.set()
+        ok_(waitFor(lambda: len(self.sms.calls) == 6),self.sms.calls)
+        ok_('confirmed' in [c['message'] for c in self.sms.calls[:3]],self.sms.calls)
+
+    def test_12_failedAlertsRetried(self):
+        ''' An alert whose delivery fails is retried, and one that always fails is dead-lettered. '''
+        retryDir = os.path.join(TEST_DIR,'..','_alert_svc_daemon_retry')
+        shutil.rmtree(retryDir,ignore_errors=True)
+        calls = []
+        def flaky(**kwargs):
+            calls.append(kwargs['message'])
+            if kwargs['message'] == 'never':
+                raise OSError('provider down')
+            if calls.count(kwargs['message']) == 1:
+                return False
+        try:
+            svc = AlertService(TEST_DIR,{'sms':flaky},retryDir=retryDir,
+                    retryOptions=dict(baseDelay=0.05,maxAttempts=3))
+            self.services.append(svc)
+            svc.start()
+            stageAlert(1,phone='+15550000001',message='second time lucky')
+            stageAlert(2,phone='+15550000002',message='never')
+            ok_(waitFor(lambda: calls.count('second time lucky') == 2 and \
+                    len(os.listdir(os.path.join(retryDir,'dead'))) == 1),calls)
+            eq_(3,calls.count('never'))
+            ok_(waitFor(lambda: [n for n in os.listdir(retryDir) if n.endswith('.json')] == []))
+            eq_(1,svc.metrics.snapshot()['deadLettered'])
+        finally:
+            shutil.rmtree(retryDir,ignore_errors=True)
+
+    def test_13_rateLimited(self):
+        ''' Deliveries are paced to the rate limits, and the waits recorded. '''
+        svc = self.startService(workers={'sms':4},rateHeadroom=1.0,
+                rateLimits={'sms':{'provider':[(20,1)],'sender':[(100,1)]}})
+        start = time.time()
+        for n in range(40):
+            stageAlert(n,phone='+1555000{:04d}'.format(n),source='+15559999999',message='m{}'.format(n))
+        ok_(waitFor(lambda: len(self.sms.calls) == 40),len(self.sms.calls))
+        # 20 at once, then 20 more at 20 a second.
+        ok_(time.time() - start >= 0.9,time.time() - start)
+        snap = svc.metrics.snapshot()
+        ok_(snap['channels']['sms']['rateLimited'] > 0,snap['channels']['sms'])
+        eq_(40,snap['channels']['wait.sms']['latency']['count'])
+
+    def test_14_ownClaimsKept(self):
+        ''' Old alerts the service is still delivering are not recovered and sent again. '''
+        self.sms.delay = 0.05
+        old = time.time() - 3600
+        for n in range(10):
+            stageAlert(n,phone='+1555000000{}'.format(n),message='m{}'.format(n))
+            os.utime(Path(TEST_DIR,'{:06d}.json'.format(n)),(old,old))
+        # Claimed by a live process on this host, long ago.
+        alive = Path(TEST_DIR,'claimed','000100.json' + claimSuffix(os.getppid()))
+        os.makedirs(alive.parent,exist_ok=True)
+        alive.write_text(json.dumps(dict(phone='+15550000100',message='theirs')))
+        os.utime(alive,(old,old))
+        svc = self.startService(workers={'sms':1},claimTimeout=0.01,rescanInterval=0.05,
+                pollInterval=0.05)
+        ok_(waitFor(lambda: len(self.sms.calls) >= 10),self.sms.calls)
+        time.sleep(0.3)
+        eq_(sorted(['m{}'.format(n) for n in range(10)]),sorted([c['message'] for c in self.sms.calls]))
+        ok_(alive.exists())
+        # Its owner dies: it is recovered at once, however recent.
+        alive.rename(Path(TEST_DIR,'claimed','000100.json' + claimSuffix(deadPid())))
+        ok_(waitFor(lambda: len(self.sms.calls) == 11),self.sms.calls)
+        eq_('theirs',self.sms.calls[-1]['message'])
+
+    def test_15_unreadableFilesTriedAgain(self):
+        ''' A file that cannot be read for now stays claimed, and is tried again. '''
+        svc = AlertService(TEST_DIR,{'sms':self.sms,'email':self.email},rescanInterval=3600)
+        stageAlert(1,phone='+15550000001',message='later')
+        readAlerts = svc.readAlerts
+        def tooManyFiles(claimed):
+            raise OSError(24,'Too many open files')
+        svc.readAlerts = tooManyFiles
+        ok_(svc.process(os.path.join(TEST_DIR,'000001.json')))
+        eq_(1,len(os.listdir(os.path.join(TEST_DIR,'claimed'))))
+        ok_(not os.path.exists(svc.deadDir))
+        svc.readAlerts = readAlerts
+        self.services.append(svc)
+        svc.start()
+        ok_(waitFor(lambda: len(self.sms.calls) == 1),self.sms.calls)
+        eq_('later',self.sms.calls[0]['message'])
@@ -0,0 +1,92 @@
+'''
+Test priority lanes: weighted round robin between lanes, per-lane
+worker limits, and lanes named in alert file names.
+'''
+import threading
+import time
+from nose.tools import ok_, eq_
+
+from ..service.lanes import LaneQueue, laneOf, laneOfName, laneLimits, \
+        TRANSACTIONAL, BROADCAST
+
+class TestLanes:
+
+    def test_0_weightedRoundRobin(self):
+        ''' While both lanes have work, they are served in proportion to their weights. '''
+        q = LaneQueue({TRANSACTIONAL:3,BROADCAST:1})
+        for i in range(20):
+            q.put(BROADCAST,i)
+            q.put(TRANSACTIONAL,i)
+        order = []
+        for i in range(8):
+            lane,item = q.get()
+            q.done(lane)
+            order.append(lane)
+        eq_(6,order.count(TRANSACTIONAL))
+        eq_(2,order.count(BROADCAST))
+
+    def test_1_idleLaneYields(self):
+        ''' A lane with nothing queued does not hold up the other. '''
+        q = LaneQueue()
+        for i in range(5):
+            q.put(BROADCAST,i)
+        got = []
+        for i in range(5):
+            lane,item = q.get()
+            q.done(lane)
+            got.append(item)
+        eq_(list(range(5)),got)
+
+    def test_2_laneLimit(self):
+        ''' A limited lane cannot take every worker. '''
+        q = LaneQueue(limits=laneLimits(2))
+        q.put(BROADCAST,'b1')
+        q.put(BROADCAST,'b2')
+        eq_((BROADCAST,'b1'),q.get())
+        eq_([],q.eligible())
+        q.put(TRANSACTIONAL,'t1')
+        eq_((TRANSACTIONAL,'t1'),q.get())
+        q.done(BROADCAST)
+        eq_((BROADCAST,'b2'),q.get())
+
+    def test_3_stop(self):
+        ''' Stopped workers finish what is queued first. '''
+        q = LaneQueue()
+        q.put(TRANSACTIONAL,'last')
+        q.stop()
+        lane,item = q.get()
+        eq_('last',item)
+        q.done(lane)
+        eq_(None,q.get())
+
+    def test_4_laneNames(self):
+        ''' Lanes come from the alert, or the file name, and default to transactional. '''
+        eq_(BROADCAST,laneOf(dict(lane='broadcast')))
+        eq_(TRANSACTIONAL,laneOf(dict(lane='bogus')))
+        eq_(BROADCAST,laneOf({},BROADCAST))
+        eq_(BROADCAST,laneOfName('00000000000000000001-12-000001.broadcast.json'))
+        eq_(TRANSACTIONAL,laneOfName('00000000000000000001-12-000001.json'))
+
+    def test_5_wakeups(self):
+        ''' Workers and threads waiting for room share the condition, and put() and get() wake both. '''
+        q = LaneQueue({TRANSACTIONAL:3,BROADCAST:1},{BROADCAST:0})
+        q.put(BROADCAST,'stuck')
+        q.put(TRANSACTIONAL,'first')
+        roomMade = []
+        def waitForRoom(lane):
+            with q.cond:
+                roomMade.append(q.cond.wait_for(lambda: q.qsize(lane) == 0,2))
+        waiters = [threading.Thread(target=waitForRoom,args=(lane,),daemon=True) for lane in (TRANSACTIONAL,BROADCAST)]
+        got = []
+        worker = threading.Thread(target=lambda: got.extend([q.get(),q.get()]),daemon=True)
+        for t in waiters:
+            t.start()
+        time.sleep(0.1)
+        worker.start()
+        waiters[0].join(1)
+        eq_([True],roomMade)
+        time.sleep(0.1)
+        q.put(TRANSACTIONAL,'second')
+        worker.join(1)
+        eq_([(TRANSACTIONAL,'first'),(TRANSACTIONAL,'second')],got)
+        ok_(waiters[1].is_alive())
@@ -0,0 +1,102 @@
+'''
+Test the alert service metrics: sharded counters and histograms,
+gauges, and snapshots published to a file and to shared memory.
+'''
+import json
+import os
+import threading
+import time
+import uuid
+from nose.tools import ok_, eq_
+
+from ..service.metrics import Metrics, SnapshotWriter, readSharedSnapshot, LATENCY_BOUNDS
+
+STATUS_FILE = '_alert_svc_metrics.json'
+
+class TestMetrics:
+
+    def tearDown(self):
+        if os.path.exists(STATUS_FILE):
+            os.unlink(STATUS_FILE)
+
+    def test_0_shardedCounters(self):
+        ''' Counts recorded on many threads add up exactly. '''
+        m = Metrics()
+        def work():
+            for i in range(10000):
+                m.incr('sms','sent')
+                m.incr('email','failed',2)
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(80000,m.count('sent'))
+        eq_(80000,m.count('sent','sms'))
+        eq_(0,m.count('sent','email'))
+        eq_(160000,m.count('failed'))
+        eq_(8,len(m.shards))
+
+    def test_1_percentiles(self):
+        ''' Percentiles come from the histogram buckets. '''
+        m = Metrics()
+        for i in range(98):
+            m.observe('sms',0.02)
+        m.observe('sms',3)
+        m.observe('sms',4000)
+        latency = m.snapshot()['channels']['sms']['latency']
+        eq_(100,latency['count'])
+        eq_(0.025,latency['p50'])
+        eq_(0.025,latency['p90'])
+        eq_(5,latency['p99'])
+        eq_(1,latency['buckets'][len(LATENCY_BOUNDS)])
+
+    def test_2_snapshotTotalsAndGauges(self):
+        ''' Snapshots hold the status file totals, rates and gauges. '''
+        m = Metrics()
+        m.gauge('queueDepth',lambda: 7)
+        m.incr('sms','sent',3)
+        m.incr('email','sent',2)
+        m.incr('email','failed')
+        snap = m.snapshot()
+        eq_(5,snap['successfulAlertCount'])
+        eq_(1,snap['failedAlertCount'])
+        eq_(7,snap['queueDepth'])
+        time.sleep(0.05)
+        m.incr('sms','sent',10)
+        snap = m.snapshot()
+        ok_(snap['channels']['sms']['rate'] > 0,snap)
+        eq_(0,snap['channels']['email']['rate'])
+
+    def test_3_statusFile(self):
+        ''' The writer replaces the status file with each snapshot. '''
+        m = Metrics()
+        writer = SnapshotWriter(m,statusFile=STATUS_FILE,interval=0.02)
+        writer.start()
+        m.incr('sms','sent')
+        time.sleep(0.1)
+        with open(STATUS_FILE) as inf:
+            eq_(1,json.load(inf)['successfulAlertCount'])
+        m.incr('sms','sent')
+        writer.stop()
+        with open(STATUS_FILE) as inf:
+            eq_(2,json.load(inf)['successfulAlertCount'])
+        eq_([],[n for n in os.listdir('.') if n.startswith(STATUS_FILE + '.tmp')])
+
+    def test_4_sharedMemory(self):
+        ''' Snapshots can be read from shared memory. '''
+        name = 'alert_svc_test_{}'.format(uuid.uuid4().hex[:8])
+        m = Metrics()
+        writer = SnapshotWriter(m,interval=60,shmName=name)
+        try:
+            eq_(None,readSharedSnapshot(name))
+            m.incr('sms','sent',4)
+            writer.write()
+            snap = readSharedSnapshot(name)
+            eq_(4,snap['successfulAlertCount'])
+            m.incr('sms','sent')
+            writer.write()
+            eq_(5,readSharedSnapshot(name)['successfulAlertCount'])
+        finally:
+            writer.stop()
+        eq_(None,readSharedSnapshot(name))
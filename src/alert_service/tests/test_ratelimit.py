@@ -0,0 +1,63 @@
+'''
+Test the rate limits that pace deliveries to the providers.
+'''
+from nose.tools import ok_, eq_, raises
+
+from ..service.ratelimit import RateLimiter, parseLimits, parseLimitOptions, scaleLimits
+
+class FakeClock:
+    ''' A clock that only moves when something sleeps. '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self,seconds):
+        self.now += seconds
+
+class TestRateLimit:
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self,limits,headroom=1.0):
+        return RateLimiter(limits,headroom,self.clock,self.clock.sleep)
+
+    def test_0_parse(self):
+        eq_([(10,1),(250000,86400)],parseLimits('10/s,250000/d'))
+        eq_(dict(sms=dict(provider=[(10,1)],sender=[(1,1)]),email=dict(recipient=[(2,3600)])),
+                parseLimitOptions(['sms=10/s','sms.sender=1/s','email.recipient=2/h']))
+
+    @raises(ValueError)
+    def test_1_badScope(self):
+        parseLimitOptions(['sms.everyone=1/s'])
+
+    def test_2_paced(self):
+        ''' Past the burst, deliveries are paced at the limit, in the order they asked. '''
+        limiter = self.limiter(dict(sms=dict(provider=parseLimits('5/s'))))
+        waits = [limiter.reserve('sms') for i in range(8)]
+        eq_([0,0,0,0,0,0.2,0.4,0.6],[round(w,6) for w in waits])
+        eq_(0,limiter.wait('email'))
+
+    def test_3_scopes(self):
+        ''' Senders and recipients each have their own buckets. '''
+        limiter = self.limiter(dict(sms=dict(sender=parseLimits('1/s'),recipient=parseLimits('1/m'))))
+        eq_(0,limiter.wait('sms','A','x'))
+        eq_(0,limiter.wait('sms','B','y'))
+        eq_(1,limiter.wait('sms','A','z'))
+        ok_(limiter.wait('sms','B','x') > 50)
+
+    def test_4_penalize(self):
+        ''' After a 429, the medium's deliveries wait even without limits. '''
+        limiter = self.limiter({})
+        limiter.penalize('sms',3)
+        eq_(3,limiter.wait('sms'))
+        eq_(0,limiter.wait('sms'))
+
+    def test_5_scaleLimits(self):
+        ''' Each of several processes gets its share of the chosen scopes. '''
+        limits = dict(sms=dict(provider=[(10,1)],recipient=[(4,60)]))
+        eq_(dict(sms=dict(provider=[(2.5,1)],recipient=[(4,60)])),
+                scaleLimits(limits,0.25,('provider','sender')))
@@ -0,0 +1,197 @@
+'''
+Test retrying failed deliveries: backoff with jitter, retries that
+survive a restart, the retry budget, and the dead-letter directory.
+'''
+import json
+import os
+import shutil
+import smtplib
+import threading
+from nose.tools import ok_, eq_
+
+from ..service.retry import RetryScheduler, PermanentFailure, isPermanent
+
+RETRY_DIR = '_alert_svc_retry'
+DEAD_DIR = os.path.join(RETRY_DIR,'dead')
+
+class FakeClock:
+
+    def __init__(self,now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class HttpError(Exception):
+
+    def __init__(self,status):
+        self.status = status
+
+class TestRetry:
+
+    def setUp(self):
+        shutil.rmtree(RETRY_DIR,ignore_errors=True)
+        self.clock = FakeClock()
+        self.submitted = []
+
+    def tearDown(self):
+        shutil.rmtree(RETRY_DIR,ignore_errors=True)
+
+    def makeScheduler(self,**kwargs):
+        return RetryScheduler(RETRY_DIR,DEAD_DIR,self.submitted.append,clock=self.clock,**kwargs)
+
+    def retryFiles(self):
+        return sorted([n for n in os.listdir(RETRY_DIR) if n.endswith('.json')])
+
+    def deadFiles(self):
+        return sorted(os.listdir(DEAD_DIR))
+
+    def test_0_backoffWithJitter(self):
+        ''' Delays double with each attempt, up to the maximum, and are jittered. '''
+        rs = self.makeScheduler(baseDelay=10,maxDelay=60)
+        for attempts,top in ((1,10),(2,20),(3,40),(4,60),(9,60)):
+            delays = [rs.delayFor(attempts) for i in range(50)]
+            ok_(min(delays) >= top / 2 and max(delays) <= top,(attempts,delays))
+            ok_(len(set(delays)) > 1)
+
+    def test_1_dueInOrder(self):
+        ''' Retries are handed back when due, earliest first. '''
+        rs = self.makeScheduler(baseDelay=10)
+        rs.schedule('sms',dict(message='a'),RuntimeError('down'))
+        eq_(None,rs.nextDue()[0])
+        ok_(0 < rs.nextDue()[1] <= 10)
+        self.clock.now += 10
+        entry,wait = rs.nextDue()
+        eq_('a',entry['alert']['message'])
+        eq_(1,entry['attempts'])
+        eq_('down',entry['error'])
+        rs.succeeded(entry)
+        eq_([],self.retryFiles())
+
+    def test_2_survivesRestart(self):
+        ''' Pending retries are reloaded from the retry directory. '''
+        rs = self.makeScheduler(baseDelay=10)
+        rs.schedule('sms',dict(message='a'),RuntimeError('down'))
+        rs.schedule('email',dict(message='b'),RuntimeError('down'))
+        rs = self.makeScheduler(baseDelay=10)
+        eq_(2,rs.pending())
+        self.clock.now += 10
+        eq_(set(['a','b']),set([rs.nextDue()[0]['alert']['message'] for i in range(2)]))
+
+    def test_3_deadLetterAfterMaxAttempts(self):
+        ''' An alert that keeps failing ends up in the dead-letter directory. '''
+        rs = self.makeScheduler(baseDelay=1,maxAttempts=3)
+        rs.schedule('sms',dict(message='a'),RuntimeError('down'))
+        for i in range(2):
+            self.clock.now += 100
+            entry,wait = rs.nextDue()
+            rs.failed(entry,RuntimeError('still down'))
+        eq_([],self.retryFiles())
+        eq_(1,len(self.deadFiles()))
+        with open(os.path.join(DEAD_DIR,self.deadFiles()[0])) as inf:
+            dead = json.load(inf)
+        eq_(3,dead['attempts'])
+        eq_('still down',dead['error'])
+        eq_(1,rs.deadLettered)
+
+    def test_4_permanentFailures(self):
+        ''' Failures retrying cannot fix are dead-lettered at once. '''
+        ok_(isPermanent(PermanentFailure('bad number')))
+        ok_(isPermanent(HttpError(400)))
+        ok_(not isPermanent(HttpError(429)))
+        ok_(not isPermanent(HttpError(503)))
+        ok_(isPermanent(smtplib.SMTPRecipientsRefused({})))
+        ok_(not isPermanent(OSError('connection refused')))
+        rs = self.makeScheduler()
+        eq_(None,rs.schedule('sms',dict(message='a'),HttpError(400)))
+        eq_([],self.retryFiles())
+        eq_(1,len(self.deadFiles()))
+
+    def test_5_budget(self):
+        ''' During an outage, retries per medium are limited by the budget. '''
+        rs = self.makeScheduler(baseDelay=1,budget=5,budgetWindow=60)
+        for i in range(50):
+            rs.schedule('sms',dict(message=str(i)),RuntimeError('down'))
+        rs.schedule('email',dict(message='e'),RuntimeError('down'))
+        self.clock.now += 10
+        due = []
+        while True:
+            entry,wait = rs.nextDue()
+            if entry is None:
+                break
+            due.append(entry['medium'])
+        eq_(5,due.count('sms'))
+        eq_(1,due.count('email'))
+        ok_(0 < wait <= 12,wait)
+        self.clock.now += 12
+        eq_('sms',rs.nextDue()[0]['medium'])
+
+    def test_6_timerThread(self):
+        ''' The timer thread submits retries as they fall due. '''
+        submitted = threading.Event()
+        def submit(entry):
+            self.submitted.append(entry)
+            submitted.set()
+        rs = RetryScheduler(RETRY_DIR,DEAD_DIR,submit,baseDelay=0.05)
+        rs.start()
+        try:
+            rs.schedule('sms',dict(message='a'),RuntimeError('down'))
+            ok_(submitted.wait(5))
+            eq_('a',self.submitted[0]['alert']['message'])
+        finally:
+            rs.stop()
+
+    def test_7_overBudgetUntouched(self):
+        ''' Retries of a medium out of budget are not read until it has a token again. '''
+        rs = self.makeScheduler(baseDelay=1,budget=2,budgetWindow=60)
+        for i in range(10):
+            rs.schedule('sms',dict(message=str(i)),RuntimeError('down'))
+        self.clock.now += 10
+        eq_(2,len([rs.nextDue()[0] for i in range(2)]))
+        # Were they read, these would be dropped as unreadable.
+        for name in self.retryFiles():
+            with open(os.path.join(RETRY_DIR,name),'w') as outf:
+                outf.write('gone')
+        for i in range(100):
+            entry,wait = rs.nextDue()
+            eq_(None,entry)
+            ok_(0 < wait <= 30,wait)
+            self.clock.now += 0.1
+        eq_(8,rs.pending())
+
+    def test_8_rescheduleMoves(self):
+        ''' A retry that fails again is moved to its new time, never copied. '''
+        rs = self.makeScheduler(baseDelay=1)
+        rs.schedule('sms',dict(message='a'),RuntimeError('down'))
+        first = self.retryFiles()
+        self.clock.now += 10
+        entry,wait = rs.nextDue()
+        rs.failed(entry,RuntimeError('still down'))
+        eq_(1,len(self.retryFiles()))
+        ok_(self.retryFiles() != first)
+        with open(os.path.join(RETRY_DIR,self.retryFiles()[0])) as inf:
+            eq_(2,json.load(inf)['attempts'])
+        eq_(1,rs.pending())
+
+    def test_9_oldFileNames(self):
+        ''' Retry files named without their medium are still loaded. '''
+        os.makedirs(RETRY_DIR)
+        with open(os.path.join(RETRY_DIR,'{:020d}-1-000001.json'.format(int(990 * 1e9))),'w') as outf:
+            json.dump(dict(medium='email',alert=dict(message='old'),attempts=1,error='down',
+                firstFailure=900),outf)
+        rs = self.makeScheduler()
+        eq_(1,rs.pending())
+        eq_('old',rs.nextDue()[0]['alert']['message'])
+
+    def test_10_corruptFiles(self):
+        ''' A retry file that cannot be read is moved to the dead-letter directory. '''
+        os.makedirs(RETRY_DIR)
+        name = '{:020d}-1-000001-sms.json'.format(int(990 * 1e9))
+        with open(os.path.join(RETRY_DIR,name),'w') as outf:
+            outf.write('{"medium": "sms", "ale')
+        rs = self.makeScheduler()
+        eq_((None,None),rs.nextDue())
+        eq_([],self.retryFiles())
+        eq_([name],self.deadFiles())
+        eq_(1,rs.deadLettered)
+        eq_(0,self.makeScheduler().pending())
@@ -7,7 +7,7 @@ import logging
 from pathlib import Path
 from nose.tools import ok_, eq_
 
-from ..service import scanDir
+from ..service import scanDir, scanBatches, scanFiles, makeAlertName
 
 TEST_DIR='_alert_svc_staging'
 
@@ -63,3 +63,50 @@ class TestStagingDir:
         eq_(expected,result,'Expected {}, found {}'.format(expected,result))
 
 
+
+    def test_4_creationOrder(self):
+        ''' Files named with makeAlertName() are scanned in creation order. '''
+        names = [makeAlertName() for i in range(50)]
+        for name in reversed(names):
+            Path(TEST_DIR,name).touch()
+        expected = ['{}/{}'.format(TEST_DIR,name) for name in names]
+        eq_(expected,scanDir(TEST_DIR))
+
+    def test_5_skipPartialFiles(self):
+        ''' Temporary and hidden files, and directories, are not claimable. '''
+        for name in ('1.json','_2.json','.3.json','4.json.tmp','5.txt'):
+            Path(TEST_DIR,name).touch()
+        os.mkdir(os.path.join(TEST_DIR,'6.json'))
+        eq_(['{}/1.json'.format(TEST_DIR)],scanDir(TEST_DIR))
+
+    def test_6_boundedBatches(self):
+        ''' Batches are bounded and together cover every file once, in order. '''
+        for n in range(25):
+            Path(TEST_DIR,'{:03d}.json'.format(n)).touch()
+        batches = list(scanBatches(TEST_DIR,batchSize=10))
+        eq_([10,10,5],[len(b) for b in batches])
+        flat = [p for b in batches for p in b]
+        eq_(['{}/{:03d}.json'.format(TEST_DIR,n) for n in range(25)],flat)
+
+    def test_7_resumeFromCursor(self):
+        ''' A scan started from a cursor yields only later files. '''
+        for n in range(10):
+            Path(TEST_DIR,'{:03d}.json'.format(n)).touch()
+        found = list(scanFiles(TEST_DIR,batchSize=3,cursor='006.json'))
+        eq_(['{}/{:03d}.json'.format(TEST_DIR,n) for n in (7,8,9)],found)
+
+    def test_8_consumedWhileScanning(self):
+        ''' Files removed while a scan is under way are not yielded again. '''
+        for n in range(10):
+            Path(TEST_DIR,'{:03d}.json'.format(n)).touch()
+        seen = []
+        for batch in scanBatches(TEST_DIR,batchSize=4):
+            for path in batch:
+                seen.append(path)
+                os.unlink(path)
+        eq_(10,len(seen))
+        eq_(10,len(set(seen)))
+
+    def test_9_missingDir(self):
+        ''' Scanning a directory that does not exist finds nothing. '''
+        eq_([],scanDir(os.path.join(TEST_DIR,'nope')))
@@ -0,0 +1,145 @@
+'''
+Test the supervisor: alerts are split into shards by recipient and
+delivered by worker processes, crashed workers are restarted, and the
+workers' status is combined.
+'''
+import json
+import os
+import shutil
+import signal
+import time
+from pathlib import Path
+from nose.tools import ok_, eq_
+
+from ..service.supervisor import Supervisor, shardFor, mergeStatus
+from ..service.alert_svc import claimSuffix
+from ..service.metrics import LATENCY_BOUNDS
+
+TEST_DIR = '_alert_svc_supervisor'
+OUT_FILE = '_alert_svc_supervisor.out'
+
+def fileAlerter(message,destNumber=None,**kwargs):
+    ''' Record each delivery, and which process made it, in OUT_FILE. '''
+    with open(OUT_FILE,'a') as outf:
+        outf.write(json.dumps(dict(pid=os.getpid(),message=message,to=destNumber)) + '\n')
+
+def delivered():
+    try:
+        with open(OUT_FILE) as inf:
+            return [json.loads(line) for line in inf]
+    except FileNotFoundError:
+        return []
+
+def waitFor(condition,timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+def deadPid():
+    ''' The pid of a process that has exited. '''
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid,0)
+    return pid
+
+class TestSupervisor:
+
+    def setUp(self):
+        shutil.rmtree(TEST_DIR,ignore_errors=True)
+        os.mkdir(TEST_DIR)
+        if os.path.exists(OUT_FILE):
+            os.unlink(OUT_FILE)
+        self.supervisor = None
+
+    def tearDown(self):
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        shutil.rmtree(TEST_DIR,ignore_errors=True)
+        if os.path.exists(OUT_FILE):
+            os.unlink(OUT_FILE)
+
+    def start(self,**kwargs):
+        self.supervisor = Supervisor(TEST_DIR,{'sms':fileAlerter},statusInterval=0.1,
+                pollInterval=0.5,**kwargs)
+        self.supervisor.start()
+        return self.supervisor
+
+    def stage(self,n,records):
+        tmp = Path(TEST_DIR,'_batch.tmp')
+        tmp.write_text('\n'.join([json.dumps(r) for r in records]) + '\n')
+        os.rename(tmp,Path(TEST_DIR,'{:06d}.json'.format(n)))
+
+    def test_0_shardFor(self):
+        ''' A recipient always maps to the same shard. '''
+        eq_(shardFor(dict(user_id=7,phone='+1'),4),shardFor(dict(user_id=7,phone='+2'),4))
+        eq_(set(range(4)),set([shardFor(dict(user_id=u),4) for u in range(100)]))
+
+    def test_1_shardedDelivery(self):
+        ''' Each recipient's alerts are delivered by one worker; with one delivery thread, in order. '''
+        sup = self.start(processes=3,serviceOptions=dict(workers={'sms':1}))
+        for n in range(10):
+            self.stage(n,[dict(channel='sms',user_id=u,phone='+1555000{:04d}'.format(u),
+                message='{} {}'.format(u,n)) for u in range(20)])
+        ok_(waitFor(lambda: len(delivered()) == 200),len(delivered()))
+        byUser = {}
+        for d in delivered():
+            user,n = d['message'].split()
+            byUser.setdefault(user,[]).append((d['pid'],int(n)))
+        for user,sends in byUser.items():
+            eq_(1,len(set([pid for pid,n in sends])),(user,sends))
+            eq_(list(range(10)),[n for pid,n in sends])
+        ok_(len(set([d['pid'] for d in delivered()])) > 1)
+        ok_(waitFor(lambda: sup.status()['successfulAlertCount'] == 200),sup.status())
+
+    def test_2_restartCrashedWorker(self):
+        ''' A worker that dies is restarted, and delivery carries on. '''
+        sup = self.start(processes=2,sharded=False)
+        ok_(waitFor(lambda: all([w['alive'] for w in sup.snapshot()['workers']])))
+        pid = sup.workers[0].process.pid
+        os.kill(pid,signal.SIGKILL)
+        ok_(waitFor(lambda: sup.workers[0].restarts == 1 and sup.workers[0].process is not None \
+                and sup.workers[0].process.is_alive()))
+        ok_(sup.workers[0].process.pid != pid)
+        self.stage(1,[dict(channel='sms',user_id=u,phone='+1',message='m{}'.format(u))
+            for u in range(10)])
+        ok_(waitFor(lambda: len(delivered()) == 10),delivered())
+
+    def test_3_mergeStatus(self):
+        ''' Worker counts and histograms are summed, and percentiles recomputed. '''
+        def hist(bucket,n):
+            buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+            buckets[bucket] = n
+            return dict(buckets=buckets)
+        merged = mergeStatus([
+            dict(successfulAlertCount=90,failedAlertCount=1,queueDepth=2,oldestPendingAge=3,
+                channels=dict(sms=dict(sent=90,failed=1,latency=hist(0,90)))),
+            dict(successfulAlertCount=10,failedAlertCount=0,queueDepth=1,oldestPendingAge=7,
+                channels=dict(sms=dict(sent=10,latency=hist(5,10)))),
+            ])
+        eq_(100,merged['successfulAlertCount'])
+        eq_(3,merged['queueDepth'])
+        eq_(7,merged['oldestPendingAge'])
+        eq_(100,merged['channels']['sms']['sent'])
+        eq_(100,merged['channels']['sms']['latency']['count'])
+        eq_(LATENCY_BOUNDS[0],merged['channels']['sms']['latency']['p50'])
+        eq_(LATENCY_BOUNDS[5],merged['channels']['sms']['latency']['p99'])
+
+    def test_4_claims(self):
+        ''' Unreadable files are dead-lettered, and only claims whose owner died are recovered. '''
+        claimed = Path(TEST_DIR,'claimed')
+        claimed.mkdir()
+        Path(TEST_DIR,'000001.json').write_bytes(b'\xff\xfe not text')
+        orphan = Path(claimed,'000002.json' + claimSuffix(deadPid()))
+        orphan.write_text(json.dumps(dict(channel='sms',user_id=1,phone='+1',message='orphan')))
+        old = time.time() - 3600
+        held = Path(claimed,'000003.json' + claimSuffix(os.getppid()))
+        held.write_text(json.dumps(dict(channel='sms',user_id=2,phone='+2',message='held')))
+        os.utime(held,(old,old))
+        sup = self.start(processes=1,claimTimeout=1)
+        ok_(waitFor(lambda: [d['message'] for d in delivered()] == ['orphan']),delivered())
+        eq_(['000001.json'],os.listdir(sup.deadDir))
+        ok_(held.exists())
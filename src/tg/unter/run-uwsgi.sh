@@ -13,4 +13,10 @@ if [ "${VENV_DIR}" == "" ] ; then
 fi
 echo ROOT_DIR $ROOT_DIR
 echo VENV_DIR $VENV_DIR
-uwsgi --paste "config:${ROOT_DIR}/development.ini" --socket 127.0.0.1:8053 --http-socket 127.0.0.1:8052 --virtualenv "${VENV_DIR}" -b 32768
+# --enable-threads: the alert dispatcher, reminders, re-evaluation
+# and retention run on background threads, which uWSGI does not run
+# without it. --lazy-apps: load the app in each worker, after the
+# fork, so each one starts its own threads if --processes is added.
+# Reminders and re-evaluation need a single process, and are not
+# started with more than one (see unter.controllers.reminders).
+uwsgi --enable-threads --lazy-apps --paste "config:${ROOT_DIR}/development.ini" --socket 127.0.0.1:8053 --http-socket 127.0.0.1:8052 --virtualenv "${VENV_DIR}" -b 32768
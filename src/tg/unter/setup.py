@@ -48,7 +48,8 @@ install_requires = [
     "wtforms_components",
     "tg.devtools",
     "twilio",
-    "bs4"
+    "bs4",
+    "numpy"
 ]
 
 if py_version != (3, 2):
@@ -150,5 +150,18 @@ def configureAlerts():
     import unter.controllers.alerts as alerts
     alerts.configureSMSAlerts()
     alerts.configureEmailAlerter()
+    alerts.configureDispatch()
+    import unter.controllers.tokens as tokens
+    tokens.configureAlertTokens(tg.config)
+    import unter.controllers.alert_status as alert_status
+    alert_status.configureAlertStatus(tg.config)
+    import unter.controllers.alert_log as alert_log
+    alert_log.configureAlertLog(tg.config)
+    import unter.controllers.retention as retention
+    retention.configureRetention(tg.config)
+    import unter.controllers.reminders as reminders
+    reminders.configureReminders(tg.config)
+    import unter.controllers.reevaluate as reevaluate
+    reevaluate.configureReevaluation(tg.config)
 tg.configuration.milestones.environment_loaded.register(configureAlerts)
 
@@ -0,0 +1,55 @@
+'''
+Read the alert service's activity log.
+
+The alert service (src/alert_service) records every delivery attempt
+in its activity log (see alert_service.service.alertlog), along with
+indexes by time, event and recipient. Configure where to find it in
+the [app:main] section of the .ini file:
+
+  alerts.log.dir = /var/log/unter/alerts    The service's --log-dir.
+
+The reader comes from the alert_service package, which must be
+importable by the web service; if it is not, the log is reported as
+unavailable.
+'''
+import logging
+
+__all__ = ['readAlertLog','configureAlertLog']
+
+def getLogger():
+    return logging.getLogger('unter.alert_log')
+
+# Set from the .ini file by configureAlertLog().
+LOG_DIR = None
+
+def configureAlertLog(config):
+    ''' Read the alerts.log.dir option (see the module docstring). '''
+    global LOG_DIR
+    LOG_DIR = config.get('alerts.log.dir',None)
+
+def getReader():
+    ''' An AlertLogReader for LOG_DIR, or None. '''
+    if LOG_DIR is None:
+        return None
+    try:
+        from alert_service.service.alertlog import AlertLogReader
+    except ImportError as ex:
+        getLogger().warning('Cannot read the alert log: {}'.format(ex))
+        return None
+    return AlertLogReader(LOG_DIR)
+
+def readAlertLog(neid=None,user_id=None,cursor=None,limit=50):
+    '''
+    Get alert log records, newest first, as a dict ready for JSON:
+    the records for event neid and/or volunteer user_id if either is
+    given, otherwise one page of the whole log starting at cursor,
+    with the cursor for the next page. Return None if the log is not
+    configured or available. Raise ValueError for a malformed cursor.
+    '''
+    reader = getReader()
+    if reader is None:
+        return None
+    if neid is not None or user_id is not None:
+        return dict(records=reader.find(neid,user_id,limit),cursor=None)
+    records,cursor = reader.page(cursor,limit)
+    return dict(records=records,cursor=cursor)
@@ -0,0 +1,92 @@
+'''
+Read the alert service's status.
+
+The alert service (src/alert_service) publishes a metrics snapshot
+every few seconds: delivery counts, throughput, latency percentiles
+per channel, queue depth and the age of the oldest pending alert.
+Configure where to read it in the [app:main] section of the .ini
+file:
+
+  alerts.status.shm = unter_alerts      The shared memory segment the
+                                        service was started with
+                                        (--status-shm). Read without
+                                        file I/O.
+  alerts.status.file = /path/status.json The service's --status-file,
+                                        read if there is no segment.
+
+The segment layout is described in alert_service.service.metrics: an
+8-byte sequence number that is odd while a snapshot is being written,
+a 4-byte length, then the snapshot JSON.
+'''
+import json
+import logging
+import struct
+
+__all__ = ['readAlertStatus','configureAlertStatus']
+
+def getLogger():
+    return logging.getLogger('unter.alert_status')
+
+SHM_HEADER = struct.Struct('<QI')
+
+# Set from the .ini file by configureAlertStatus().
+STATUS_SHM = None
+STATUS_FILE = None
+
+def configureAlertStatus(config):
+    ''' Read the alerts.status.* options (see the module docstring). '''
+    global STATUS_SHM, STATUS_FILE
+    STATUS_SHM = config.get('alerts.status.shm',None)
+    STATUS_FILE = config.get('alerts.status.file',None)
+
+def readShared(name,retries=100):
+    ''' Read a snapshot from shared memory, or None. '''
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(name=name,track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment with the
+        # resource tracker, which would unlink it when we exit.
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name,'shared_memory')
+    try:
+        buf = shm.buf
+        for i in range(retries):
+            seq,length = SHM_HEADER.unpack_from(buf,0)
+            if seq == 0:
+                return None
+            if seq % 2 == 1:
+                continue
+            data = bytes(buf[SHM_HEADER.size:SHM_HEADER.size+length])
+            if SHM_HEADER.unpack_from(buf,0)[0] == seq:
+                return json.loads(data.decode('utf-8'))
+        return None
+    finally:
+        shm.close()
+
+def readAlertStatus():
+    '''
+    Get the alert service's latest status snapshot as a dict, with
+    'source' saying where it came from, or None if no status is
+    configured or available.
+    '''
+    shmName = STATUS_SHM
+    if shmName is not None:
+        try:
+            status = readShared(shmName)
+            if status is not None:
+                status['source'] = 'shm'
+                return status
+        except FileNotFoundError:
+            getLogger().warning('No alert status segment {}'.format(shmName))
+    fname = STATUS_FILE
+    if fname is not None:
+        try:
+            with open(fname,'r') as inf:
+                status = json.load(inf)
+            status['source'] = 'file'
+            return status
+        except (OSError,ValueError) as ex:
+            getLogger().warning('Cannot read alert status {}: {}'.format(fname,ex))
+    return None
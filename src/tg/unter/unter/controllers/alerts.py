@@ -4,20 +4,29 @@ Utilities for sending alerts.
 import datetime as dt
 import logging
 import importlib
-import uuid
 import smtplib
+import atexit
+import contextlib
+import threading
+import time
 
 from twilio.rest import Client as TwiCli
 
 from unter.controllers.util import *
 
 import unter.model as model
+import unter.controllers.dispatch as dispatch
+import unter.controllers.tokens as tokens
+import unter.controllers.messages as messages
+from unter.controllers.spool import alertBatch, alertContext
+from unter.controllers.ratelimit import limiterFromConfig
 
 import tg
+from sqlalchemy.orm import joinedload
 
 __all__ = ["sendSMSUsingTwilio","stubSMSAlerter","getSMSAlerter","setSMSAlerter",
     "sendAlerts","SMS_ENABLED","EMAIL_ENABLED","MVCA_SITE","configureSMSAlerts",
-    "MIN_PWD_RESET_INTERVAL","MIN_PWD_EMAIL_INTERVAL"]
+    "MIN_PWD_RESET_INTERVAL","MIN_PWD_EMAIL_INTERVAL","rateLimitStats"]
 
 # Alert no more than every 4 hours for any particular event.
 MIN_ALERT_SECONDS = 3600 * 4
@@ -34,27 +43,46 @@ MIN_PWD_RESET_INTERVAL = None
 def getLogger():
     return logging.getLogger('unter.allerts')
 
+def alertedRecently(nev):
+    '''
+    True if nev was alerted less than MIN_ALERT_SECONDS ago.
+    '''
+    now = dt.datetime.now().timestamp()
+    return now - MIN_ALERT_SECONDS < nev.last_alert_time
+
 def sendAlerts(volunteers,nev,honorLastAlertTime=True):
     '''
     Send alerts to the given volunteers for need event nev.
     '''
     if honorLastAlertTime:
-        now = dt.datetime.now().timestamp()
-        if now - MIN_ALERT_SECONDS < nev.last_alert_time:
+        if alertedRecently(nev):
             getLogger().debug("NOT alerting for need event {} - it was alerted recently.".format(\
                     nev.neid))
             return False
-    for vol in volunteers:
-        logging.getLogger("unter.alerts").info("ALERTING {} for need event {}".format(vol.user_name,nev.neid))
-        if SMS_ENABLED and vol.text_alerts_ok == 1:
-                getLogger().info('  Alerting via SMS')
-                sendSmsForEvent(nev,vol)
-        if EMAIL_ENABLED:
-            getLogger().info('  Alerting via email')
-            sendEmailForEvent(nev,vol)
+    volunteers = [vol for vol in volunteers if wantsSMS(vol) or EMAIL_ENABLED]
+    # One token per volunteer, shared by their SMS and email, all
+    # inserted at once.
+    tokenFor = makeUUIDsForAlerts(nev,volunteers)
+    # The message is the same for everyone but the token.
+    template = messages.eventMessage(nev,site=MVCA_SITE)
+    # A spooling alerter writes the whole fan-out as one batch. It is
+    # a broadcast, so it queues behind confirmations and cancellations.
+    with alertBatch(neid=nev.neid,lane=dispatch.BROADCAST):
+        for vol in volunteers:
+            logging.getLogger("unter.alerts").info("ALERTING {} for need event {}".format(vol.user_name,nev.neid))
+            with alertContext(user_id=vol.user_id):
+                if wantsSMS(vol):
+                        getLogger().info('  Alerting via SMS')
+                        sendSmsForEvent(nev,vol,token=tokenFor[vol.user_id],template=template)
+                if EMAIL_ENABLED:
+                    getLogger().info('  Alerting via email')
+                    sendEmailForEvent(nev,vol,token=tokenFor[vol.user_id],template=template)
     nev.last_alert_time = int(dt.datetime.now().timestamp())
     return True
 
+def wantsSMS(vol):
+    return SMS_ENABLED and vol.text_alerts_ok == 1
+
 def sendConfirmationAlert(vol,nev,confirming=True):
     '''
     Send a "Thanks for confirming" alert to the volunteer
@@ -65,82 +93,69 @@ def sendConfirmationAlert(vol,nev,confirming=True):
     getLogger().info("Confirming event {} to volunteer {}".\
             format(nev.neid,vol.user_name))
     msgText = makeConfirmationMsgForEvent(vol,nev,confirming)
+    with alertBatch(neid=nev.neid,user_id=vol.user_id,lane=dispatch.TRANSACTIONAL):
+        sendToVolunteer(vol,msgText,"Event confirmation","Confirming")
+
+def sendToVolunteer(vol,msgText,subject,verb):
+    ''' Send msgText to vol by every medium they accept. '''
     if SMS_ENABLED and vol.text_alerts_ok == 1:
-            getLogger().info("  Confirming via SMS")
+            getLogger().info("  {} via SMS".format(verb))
             sendSMS = getSMSAlerter()
             destNumber = makeValidSMSPhoneNumber(vol.phone)
             sendSMS(msgText,destNumber=destNumber)
     if EMAIL_ENABLED:
-        getLogger().info("  Confirming via email")
+        getLogger().info("  {} via email".format(verb))
         sendEmail = getEmailAlerter()
-        sendEmail(message=msgText,toAddr=vol.email_address,subject="Event confirmation")
+        sendEmail(message=msgText,toAddr=vol.email_address,subject=subject)
 
 def makeConfirmationMsgForEvent(vol,ev,confirming):
-    txt = "Thank you for responding, {}. ".format(vol.display_name)
-    if confirming:
-        ev_date = dt.datetime.fromtimestamp(ev.date_of_need)
-        txt += "Please go to {} at {} on {}. You will receive a reminder one hour beforehand.".\
-                format(ev.location,minutesPastMidnightToTimeString(ev.time_of_need),\
-                str(dt.date(ev_date.year,ev_date.month,ev_date.day)))
-    else:
-        txt += "Enough volunteers have responded already, so you do not need to attend this event. "
-        txt += "If someone cancels, we may contact you again. Thank you for being "
-        txt += "willing to help!"
-    return txt
+    return messages.confirmationMessage(ev,confirming).render(name=vol.display_name)
+
+def sendReminderAlert(vol,ev):
+    '''
+    Remind a volunteer of an event they committed to, shortly before
+    it starts (see unter.controllers.reminders).
+    '''
+    getLogger().info('Reminding volunteer {} of event {}.'.format(vol.user_name,ev.neid))
+    msg = messages.reminderMessage(ev).render(name=vol.display_name)
+    with alertBatch(neid=ev.neid,user_id=vol.user_id,lane=dispatch.TRANSACTIONAL):
+        sendToVolunteer(vol,msg,"Event reminder","Reminding")
 
 def sendCoordDecommitAlert(vol,ev):
     getLogger().info("Alerting coordinator {} of volunteer decommitment.".\
             format(ev.created_by.user_name))
     msg = makeCoordDecommitMsg(vol,ev)
-    if SMS_ENABLED and vol.text_alerts_ok == 1:
-        getLogger().info("  Alerting via SMS.")
-        sendSMS = getSMSAlerter()
-        destNumber = makeValidSMSPhoneNumber(ev.created_by.phone)
-        sendSMS(msg,destNumber=destNumber)
-    if EMAIL_ENABLED:
-        getLogger().info("  Alerting via email.")
-        sendEmail = getEmailAlerter()
-        sendEmail(message=msg,toAddr=ev.created_by.email_address,subject="A volunteer has cancelled")
+    with alertBatch(neid=ev.neid,user_id=ev.created_by.user_id,lane=dispatch.TRANSACTIONAL):
+        if SMS_ENABLED and vol.text_alerts_ok == 1:
+            getLogger().info("  Alerting via SMS.")
+            sendSMS = getSMSAlerter()
+            destNumber = makeValidSMSPhoneNumber(ev.created_by.phone)
+            sendSMS(msg,destNumber=destNumber)
+        if EMAIL_ENABLED:
+            getLogger().info("  Alerting via email.")
+            sendEmail = getEmailAlerter()
+            sendEmail(message=msg,toAddr=ev.created_by.email_address,subject="A volunteer has cancelled")
 
 def makeCoordDecommitMsg(vol,ev):
-    getLogger().debug("ev.date_of_need is a {}".format(type(ev.date_of_need)))
-    getLogger().debug("ev.date_of_need is {}".format(ev.date_of_need))
-    txt = "Volunteer {} cannot serve at your event {} {} at {}".\
-            format(vol.display_name,
-                    dt.date.fromtimestamp(ev.date_of_need),
-                    minutesPastMidnightToTimeString(ev.time_of_need),
-                    ev.location)
-    return txt
+    return messages.coordDecommitMessage(ev).render(name=vol.display_name)
 
 def sendCancellationAlert(ev,vol):
     getLogger().info('Alerting volunteer {} of cancelled event {}.'.\
             format(vol.user_name,ev.neid))
     msg = makeEventCancellationMsg(ev,vol)
-    if SMS_ENABLED and vol.text_alerts_ok == 1:
-        getLogger().info('  Alerting via SMS.')
-        sendSMS = getSMSAlerter()
-        destNumber = makeValidSMSPhoneNumber(vol.phone)
-        sendSMS(msg,destNumber=destNumber)
-    if EMAIL_ENABLED:
-        getLogger().info("  Alerting via email.")
-        sendEmail = getEmailAlerter()
-        sendEmail(message=msg,toAddr=vol.email_address,subject="An event has been cancelled")
+    with alertBatch(neid=ev.neid,user_id=vol.user_id,lane=dispatch.TRANSACTIONAL):
+        sendToVolunteer(vol,msg,"An event has been cancelled","Alerting")
 
 def makeEventCancellationMsg(ev,vol):
-    msg = 'An event you committed to has been cancelled. '
-    msg += 'You do not need to go to {} at {} on {}. '.\
-            format(ev.location,dt.date.fromtimestamp(ev.date_of_need),\
-                    minutesPastMidnightToTimeString(ev.time_of_need))
-    msg += 'Thank you for being willing to help!'
-    return msg
+    return messages.cancellationMessage(ev).render()
 
-def sendEmailForEvent(nev,vol,source="MVCA"):
+def sendEmailForEvent(nev,vol,source="MVCA",token=None,template=None):
     '''
     Send an email using the configured EMAIL_ALERTER.
     '''
     emailAlerter = getEmailAlerter()
     toAddr = vol.email_address
-    msg = makeMessageForEvent(nev,vol)
+    msg = makeMessageForEvent(nev,vol,source,token=token,template=template)
     emailAlerter(message=msg,toAddr=toAddr,subject="Volunteers needed")
 
 def stubEmailAlerter(message,toAddr,fromAddr="none@nowhere",subject="Volunteer alert"):
@@ -153,14 +168,151 @@ def stubEmailAlerter(message,toAddr,fromAddr="none@nowhere",subject="Volunteer a
 SMTP_ALERTER = None
 def sendEmailUsingSMTP(message,toAddr,fromAddr=None,subject="Volunteer alert"):
     '''
-    An alerter that sends via a configured SMTP server.
+    An alerter that sends via a configured SMTP server. Return
+    False if the message was not sent, so that the alert service can
+    retry it, rather than raising into the caller.
     '''
+    getLogger().info("Sending email via SMPTP:\nTo: {}\nFrom: {}\n\n{}".\
+            format(toAddr,fromAddr,message))
+    try:
+        return getSMTPAlerter().send_email(message,toAddr,fromAddr,subject)
+    except (smtplib.SMTPException,OSError) as ex:
+        getLogger().error('Email to {} NOT sent: {}'.format(toAddr,ex))
+        return False
+
+def getSMTPAlerter():
+    ''' Get the process-wide SMTPAlerter, creating it if necessary. '''
     global SMTP_ALERTER
     if SMTP_ALERTER is None:
         SMTP_ALERTER = SMTPAlerter()
-    getLogger().info("Sending email via SMPTP:\nTo: {}\nFrom: {}\n\n{}".\
-            format(toAddr,fromAddr,message))
-    SMTP_ALERTER.send_email(message,toAddr,fromAddr,subject)
+        atexit.register(SMTP_ALERTER.close)
+    return SMTP_ALERTER
+
+def closeQuietly(server):
+    ''' QUIT an SMTP connection, ignoring errors. '''
+    try:
+        server.quit()
+    except:
+        try:
+            server.close()
+        except:
+            pass
+
+class SMTPConnectionPool:
+    '''
+    A small pool of connected, logged-in SMTP sessions, so that
+    messages after the first do not each pay for a TCP connect,
+    EHLO, STARTTLS and LOGIN.
+
+    connect is a function returning a new ready-to-use smtplib.SMTP.
+    At most size sessions are open at once; callers wait for one to
+    be returned. A session idle for more than noopInterval seconds
+    is checked with NOOP before it is reused, and one idle for more
+    than idleTimeout seconds is closed rather than reused, since
+    servers drop idle clients anyway.
+    '''
+
+    def __init__(self,connect,size=2,idleTimeout=60,noopInterval=10):
+        self.connect = connect
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.noopInterval = noopInterval
+        self.cond = threading.Condition()
+        # (last used time, session), most recently used last.
+        self.idle = []
+        self.open = 0
+        self.connects = 0
+
+    def acquire(self):
+        ''' Get a session, connecting if necessary. '''
+        server = None
+        with self.cond:
+            while True:
+                stale = self.pruneIdle()
+                if len(self.idle) > 0:
+                    lastUsed,server = self.idle.pop()
+                    break
+                if self.open < self.size:
+                    self.open += 1
+                    break
+                self.cond.wait()
+        for old in stale:
+            closeQuietly(old)
+        if server is not None and time.time() - lastUsed > self.noopInterval:
+            if not self.alive(server):
+                getLogger().info('Dropping stale SMTP connection.')
+                closeQuietly(server)
+                server = None
+        if server is None:
+            try:
+                server = self.connect()
+                self.connects += 1
+            except:
+                with self.cond:
+                    self.open -= 1
+                    self.cond.notify()
+                raise
+        return server
+
+    def release(self,server,broken=False):
+        ''' Return a session to the pool, or close it if broken. '''
+        with self.cond:
+            if broken:
+                self.open -= 1
+            else:
+                self.idle.append((time.time(),server))
+            self.cond.notify()
+        if broken:
+            closeQuietly(server)
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Use a pooled session. A session is discarded if the code using
+        it fails with anything other than an SMTP error reply, after
+        which the connection state is unknown.
+        '''
+        server = self.acquire()
+        try:
+            yield server
+        except (smtplib.SMTPResponseException,smtplib.SMTPRecipientsRefused):
+            self.release(server)
+            raise
+        except:
+            self.release(server,broken=True)
+            raise
+        else:
+            self.release(server)
+
+    def alive(self,server):
+        try:
+            return server.noop()[0] == 250
+        except:
+            return False
+
+    def pruneIdle(self):
+        '''
+        Remove sessions idle for longer than idleTimeout and return
+        them for closing. Call with self.cond held.
+        '''
+        cutoff = time.time() - self.idleTimeout
+        stale = [server for lastUsed,server in self.idle if lastUsed < cutoff]
+        if len(stale) > 0:
+            self.idle = [(lastUsed,server) for lastUsed,server in self.idle if lastUsed >= cutoff]
+            self.open -= len(stale)
+        return stale
+
+    def close(self):
+        ''' Close every idle session. '''
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+            self.open -= len(idle)
+        for lastUsed,server in idle:
+            closeQuietly(server)
+
+# Replies with which relays say we are sending too fast.
+THROTTLED_SMTP_CODES = (421,450,451,452)
 
 class SMTPAlerter:
     '''
@@ -172,19 +324,45 @@ class SMTPAlerter:
     smtp.pwd.file = the file containing the SMTP user's password.
     smtp.smtp.server = the name or IP of the SMTP SMTP server.
 
+    Optional settings for the connection pool:
+
+    smtp.starttls = whether to STARTTLS after connecting (default true).
+    smtp.pool.size = the most connections to hold open (default 2).
+    smtp.idle.timeout = seconds before an idle connection is closed (60).
+    smtp.noop.interval = seconds idle before a connection is checked
+        with NOOP before reuse (10).
+
+    Optional send limits (see unter.controllers.ratelimit):
+
+    smtp.limits, smtp.sender.limits, smtp.recipient.limits = the
+        relay's limits, eg "14/s, 50000/d" (none).
+    smtp.backoff = seconds every send waits after the relay answers
+        that we are sending too fast (5).
+
     Note that the credential files should NEVER be commited to
     version control.
     '''
 
     def __init__(self):
+        self.user = None
+        self.pwd = None
         self.ready = self.loadSMTPCredentials()
+        self.starttls = str(tg.config.get('smtp.starttls','true')).lower() in ('true','1','yes','on')
+        self.pool = SMTPConnectionPool(self.connect,
+                size=int(tg.config.get('smtp.pool.size',2)),
+                idleTimeout=float(tg.config.get('smtp.idle.timeout',60)),
+                noopInterval=float(tg.config.get('smtp.noop.interval',10)))
+        self.limiter = limiterFromConfig(tg.config,'smtp')
+        self.backoff = float(tg.config.get('smtp.backoff',5))
 
     def loadSMTPCredentials(self):
         '''
         Load the smtp login credentials. Return True if that
         succeeds, False otherwise.
         '''
-        result = False
+        self.fromAddr = tg.config.get('smtp.from','mvca@mvca.org')
+        self.smtpServer = tg.config.get('smtp.smtp.server','smtp.smtp.com:587')
+
         userFname = tg.config.get('smtp.user.file',None)
         pwdFname = tg.config.get('smtp.pwd.file',None)
         
@@ -202,36 +380,105 @@ class SMTPAlerter:
                 getLogger().error("Could not load smtp user from file {}".format(userFname))
                 return False
 
-        self.fromAddr = tg.config.get('smtp.from','mvca@mvca.org')
-        self.smtpServer = tg.config.get('smtp.smtp.server','smtp.smtp.com:587')
-
         return True
 
-    def send_email(self,message,toAddr,fromAddr=None,subject=None):
-        if not self.ready:
-            getLogger().error('SMTP alerter not ready - not sending to {}'.format(toAddr))
-            return
-        if fromAddr is None:
-            fromAddr = self.fromAddr
+    def connect(self):
+        ''' Open a new SMTP session, logged in if credentials are configured. '''
+        getLogger().info("Connecting to SMTP server {}".format(self.smtpServer))
+        server = smtplib.SMTP(self.smtpServer)
+        try:
+            server.ehlo()
+            if self.starttls:
+                server.starttls()
+                server.ehlo()
+            if self.user is not None:
+                server.login(self.user,self.pwd)
+        except:
+            closeQuietly(server)
+            raise
+        return server
 
-        # Credentials (if needed)
-        username = self.user
-        password = self.pwd
-      
+    def formatMessage(self,message,subject):
         # Append subject.
         if subject is not None:
-            message = 'subject:' +subject+'\n\n'+message
+            return 'subject:' +subject+'\n\n'+message
         else:
-            message = '\n'+message
+            return '\n'+message
 
-        # The actual mail send  
-        getLogger().info("   sending: {}".format(message))
-        server = smtplib.SMTP(self.smtpServer)
-        server.ehlo()
-        server.starttls()
-        server.login(username,password)
-        server.sendmail(fromAddr, toAddr, message)
-        server.quit()
+    def send_email(self,message,toAddr,fromAddr=None,subject=None):
+        ''' Send one message. Return True if it was sent. '''
+        if not self.ready:
+            getLogger().error('SMTP alerter not ready - not sending to {}'.format(toAddr))
+            return False
+        return self.send_batch([dict(message=message,toAddr=toAddr,fromAddr=fromAddr,subject=subject)])[0] is True
+
+    def send_batch(self,messages):
+        '''
+        Send several messages over one pooled connection. messages is a
+        list of dicts with the keyword arguments of send_email(). Return
+        each message's result, in the same order: True if it was sent,
+        False if the server refused it, and None if it was never tried.
+
+        A message the server refuses is logged and the batch carries on
+        with the next. If the connection is lost, reconnect and try the
+        message again; the batch is only abandoned, leaving the rest
+        None, when that fails too.
+        '''
+        results = [None] * len(messages)
+        if not self.ready:
+            getLogger().error('SMTP alerter not ready - not sending {} messages'.format(len(messages)))
+            return results
+        index = 0
+        retried = False
+        while index < len(messages):
+            try:
+                with self.pool.connection() as server:
+                    while index < len(messages):
+                        results[index] = self.sendOne(server,messages[index])
+                        index += 1
+                        retried = False
+            except (smtplib.SMTPServerDisconnected,OSError) as ex:
+                if retried:
+                    getLogger().error('SMTP connection lost, {} of {} messages not sent: {}'.format(
+                        len(messages) - index,len(messages),ex))
+                    break
+                retried = True
+                getLogger().warning('SMTP connection lost, reconnecting: {}'.format(ex))
+            except smtplib.SMTPException as ex:
+                # Connecting or logging in failed.
+                getLogger().error('Could not open SMTP session, {} of {} messages not sent: {}'.format(
+                    len(messages) - index,len(messages),ex))
+                break
+        return results
+
+    def sendOne(self,server,msg):
+        '''
+        Send msg over server. Return True if it was sent, False if the
+        server refused it. Raise SMTPServerDisconnected or OSError if
+        the connection was lost.
+        '''
+        fromAddr = msg.get('fromAddr') or self.fromAddr
+        text = self.formatMessage(msg['message'],msg.get('subject'))
+        getLogger().info("   sending: {}".format(text))
+        self.limiter.wait(fromAddr,msg['toAddr'])
+        try:
+            server.sendmail(fromAddr,msg['toAddr'],text)
+            return True
+        except smtplib.SMTPRecipientsRefused:
+            getLogger().error('SMTP server refused recipient {}'.format(msg['toAddr']))
+        except smtplib.SMTPResponseException as ex:
+            if ex.smtp_code in THROTTLED_SMTP_CODES:
+                self.limiter.penalize(self.backoff)
+            getLogger().error('SMTP server refused message to {}: {} {}'.format(
+                msg['toAddr'],ex.smtp_code,ex.smtp_error))
+        except smtplib.SMTPServerDisconnected:
+            raise
+        except smtplib.SMTPException as ex:
+            getLogger().error('Message to {} NOT sent: {}'.format(msg['toAddr'],ex))
+        return False
+
+    def close(self):
+        self.pool.close()
 
 def makeValidSMSPhoneNumber(num):
     if len(num) == 7:
@@ -241,7 +488,7 @@ def makeValidSMSPhoneNumber(num):
         num = "+1"+num
     return num
 
-def sendSmsForEvent(nev,vol,source="MVCA"):
+def sendSmsForEvent(nev,vol,source="MVCA",token=None,template=None):
     '''
     Send an SMS alert for an event, using the configured
     SMS alerter. The SMS alerter can be configured using
@@ -252,61 +499,86 @@ def sendSmsForEvent(nev,vol,source="MVCA"):
     sendSMS = getSMSAlerter()
 
     destNumber = makeValidSMSPhoneNumber(vol.phone)
-    msg = makeMessageForEvent(nev,vol)
+    msg = makeMessageForEvent(nev,vol,source,token=token,template=template)
     sendSMS(msg,destNumber=destNumber)
 
-def makeMessageForEvent(nev,vol,source='MVCA'):
-    n_vols = nev.volunteer_count
-    at_time=nev.time_of_need
-    at_date=str(dt.date.fromtimestamp(nev.date_of_need))
-    ev_type = nev.event_type.etid
-    location = nev.location
-    coord_num = nev.created_by.phone
-    coord_name = nev.created_by.display_name
-    uuid = makeUUIDForAlert(nev,vol)
-    link = "{}/sms_response?uuid={}&action=accept".format(MVCA_SITE,uuid)
-    dlink = "{}/sms_response?uuid={}&action=refuse".format(MVCA_SITE,uuid)
-    msg = ("This is {}. We have a need for {} volunteer(s) at {} {}. Purpose: {}. "\
-            +"Location: {}. Can you help? Call {} {} or click link to commit: {}. "\
-            +"Or click to ignore: {}").format(source,\
-            n_vols,\
-            minutesPastMidnightToTimeString(at_time),\
-            at_date,
-            evTypeToString(ev_type),\
-            location, coord_name, coord_num, link,dlink)
-    return msg
+def makeMessageForEvent(nev,vol,source='MVCA',token=None,template=None):
+    '''
+    The "volunteers needed" message for vol, with response links
+    carrying token (a new one if None; see makeUUIDsForAlerts()).
+    template is nev's compiled message (see
+    unter.controllers.messages), looked up if None.
+    '''
+    if token is None:
+        token = makeUUIDForAlert(nev,vol)
+    if template is None:
+        template = messages.eventMessage(nev,source,MVCA_SITE)
+    return template.render(token=token)
 
 def makeUUIDForAlert(nev,vol):
     '''
     Create an entry in the AlertUUID table for the given
     event and volunteer.
     '''
-    auuid = model.AlertUUID(user_id=vol.user_id,neid=nev.neid,uuid=str(uuid.uuid4()))
-    result = auuid.uuid
-    model.DBSession.add(auuid)
-    model.DBSession.flush()
+    return makeUUIDsForAlerts(nev,[vol])[vol.user_id]
+
+def makeUUIDsForAlerts(nev,volunteers):
+    '''
+    Create alert tokens (see unter.controllers.tokens) for the given
+    event and each of volunteers, and record them in the AlertUUID
+    table with a single INSERT. Return a dict mapping each volunteer's
+    user_id to their token.
+    '''
+    expiry = tokens.expiryFor(nev)
+    result = {}
+    for vol in volunteers:
+        result[vol.user_id] = tokens.newToken(vol.user_id,nev.neid,expiry)
+    if len(result) > 0:
+        # The event may not have been written yet.
+        model.DBSession.flush()
+        model.DBSession.bulk_insert_mappings(model.AlertUUID,
+                [dict(user_id=user_id,neid=nev.neid,uuid=token) for user_id,token in result.items()])
     return result
 
 def getUserAndEventForUUID(uuid):
     '''
     Get the user and event associated with a UUID. Return the (user,event) tuple,
-    or (None,None) if the UUID doesn't exist.
+    or (None,None) if the UUID doesn't exist. A signed token is checked
+    and its user and event fetched by primary key, without reading the
+    AlertUUID table.
     '''
+    if tokens.isSigned(uuid):
+        return getUserAndEventForSignedToken(uuid)
     result = None,None
-    auuid = model.DBSession.query(model.AlertUUID).filter_by(uuid=uuid).first()
+    auuid = model.DBSession.query(model.AlertUUID).filter_by(uuid=uuid).\
+            options(joinedload(model.AlertUUID.user),joinedload(model.AlertUUID.need_event)).first()
     if auuid is not None:
         result = auuid.user,auuid.need_event
         getLogger().info('Responding to alert UUID {} for user {} event {}'\
                 .format(auuid.uuid,auuid.user.user_name,auuid.need_event.neid))
         # Don't delete. This allows the user to click on the
-        # "decommit" link in the SMS to change their mind. We
-        # should delete these when we vacuum old events out of
-        # the DB.
+        # "decommit" link in the SMS to change their mind. The
+        # retention job (unter.controllers.retention) deletes
+        # them once the event is over.
         # model.DBSession.delete(auuid)
     else:
         getLogger().info('No such UUID {} for alert response.'.format(uuid))
     return result
 
+def getUserAndEventForSignedToken(token):
+    ids = tokens.verifyToken(token)
+    if ids is None:
+        getLogger().info('Invalid or expired token {} for alert response.'.format(token))
+        return None,None
+    user_id,neid = ids
+    user = model.DBSession.query(model.User).get(user_id)
+    nev = model.DBSession.query(model.NeedEvent).get(neid)
+    if user is None or nev is None:
+        getLogger().info('No user {} or event {} for alert response.'.format(user_id,neid))
+        return None,None
+    getLogger().info('Responding to signed token for user {} event {}'.format(user.user_name,neid))
+    return user,nev
+
 #####################
 # An SMS alerter that really sends an SMS, via Twilio.
 # Note that we must configure a callable as the SMS alerter
@@ -315,6 +587,27 @@ def getUserAndEventForUUID(uuid):
 # time it is called. (Do we need to make this thread-local?)
 #####################
 class TwilioSMSAlerter:
+    '''
+    Send SMS via Twilio's Messages API. One client, with a pooled
+    HTTP session, is shared by every send. The configuration options
+    in the [app:main] section of the .ini file are:
+
+    twilio.sid.filename = the file containing the Twilio account SID.
+    twilio.auth.filename = the file containing the auth token.
+
+    and optionally:
+
+    twilio.workers = concurrent requests made by send_batch() (8).
+    twilio.rate = most messages submitted per second, 0 for no limit (10).
+    twilio.limits, twilio.sender.limits, twilio.recipient.limits =
+        finer send limits, replacing twilio.rate (see
+        unter.controllers.ratelimit).
+    twilio.retries = times to retry a message throttled with 429 (4).
+    twilio.backoff = seconds every send waits after a 429 before the
+        first retry; doubled for each retry after that (1).
+    twilio.timeout = HTTP timeout in seconds (10).
+    twilio.api.url = the API base URL, eg for a local test stand-in.
+    '''
 
     def __init__(self):
         self.TWILIO_SID = None
@@ -336,30 +629,96 @@ class TwilioSMSAlerter:
         else:
             logging.getLogger('unter').error("No twilio.auth.filename defined in [app:main]")
 
+        self.workers = int(tg.config.get('twilio.workers',8))
+        self.retries = int(tg.config.get('twilio.retries',4))
+        self.backoff = float(tg.config.get('twilio.backoff',1))
+        self.timeout = float(tg.config.get('twilio.timeout',10))
+        self.apiUrl = tg.config.get('twilio.api.url',None)
+        rate = float(tg.config.get('twilio.rate',10))
+        self.limiter = limiterFromConfig(tg.config,'twilio','{}/s'.format(rate) if rate > 0 else None)
+        self.client = None
+        self.clientLock = threading.Lock()
+
+    def getClient(self):
+        ''' Get the shared Twilio client, creating it on first use. '''
+        with self.clientLock:
+            if self.client is None:
+                from requests.adapters import HTTPAdapter
+                from twilio.http.http_client import TwilioHttpClient
+                http = TwilioHttpClient(pool_connections=True,timeout=self.timeout)
+                # Room in the connection pool for every send_batch() worker.
+                adapter = HTTPAdapter(pool_connections=1,pool_maxsize=max(10,self.workers))
+                http.session.mount('https://',adapter)
+                http.session.mount('http://',adapter)
+                self.client = TwiCli(self.TWILIO_SID,self.TWILIO_AUTH_TOK,http_client=http)
+                if self.apiUrl is not None:
+                    self.client.api.base_url = self.apiUrl
+            return self.client
+
     def __call__(self,message,sourceNumber=None,destNumber=None):
+        '''
+        Send one message. Return False if it was not sent, so that the
+        alert service can retry it.
+        '''
         getLogger().info("Sending SMS alert to {} using Twilio.".format(destNumber))
         if self.TWILIO_SID is None or self.TWILIO_AUTH_TOK is None:
             logging.getLogger('unter').error("Cannot send SMS via Twilio - missing credentials.")
             stubSMSAlerter(message,sourceNumber,destNumber)
             return
-       
-        try:
-            cli = TwiCli(self.TWILIO_SID,self.TWILIO_AUTH_TOK)
-            message = cli.messages.create(body=message,
-                    from_=sourceNumber,
-                    to=destNumber)
-            print(message.sid)
-            getLogger().info("   Message sent to {}".format(destNumber))
-        except:
-            getLogger().warn("   Message NOT sent to {}".format(destNumber))
+        return self.send(message,sourceNumber,destNumber) is not None
 
+    def send(self,message,sourceNumber,destNumber):
+        '''
+        Submit one message, retrying with exponential backoff while
+        Twilio answers 429 Too Many Requests. Return the message SID,
+        or None if it was not sent. A 429 holds up every send, not
+        just this one, since they all count against the same limit.
+        '''
+        from twilio.base.exceptions import TwilioException, TwilioRestException
+        delay = self.backoff
+        for attempt in range(self.retries+1):
+            self.limiter.wait(sourceNumber,destNumber)
+            try:
+                sent = self.getClient().messages.create(body=message,
+                        from_=sourceNumber,
+                        to=destNumber)
+                getLogger().info("   Message {} sent to {}".format(sent.sid,destNumber))
+                return sent.sid
+            except TwilioRestException as ex:
+                if ex.status != 429 or attempt == self.retries:
+                    getLogger().warning("   Message NOT sent to {}: HTTP {} code {} {}".format(
+                        destNumber,ex.status,ex.code,ex.msg))
+                    return None
+                getLogger().info("   Throttled sending to {}, retrying in {}s".format(destNumber,delay))
+                self.limiter.penalize(delay)
+                delay *= 2
+            except (TwilioException,OSError) as ex:
+                getLogger().warning("   Message NOT sent to {}: {}".format(destNumber,ex))
+                return None
+
+    def send_batch(self,messages):
+        '''
+        Submit many messages concurrently, on up to twilio.workers
+        threads and within the twilio.rate limit. messages is a list of
+        dicts with the keyword arguments of __call__(). Return the
+        message SIDs in the same order, None for messages not sent.
+        '''
+        if self.TWILIO_SID is None or self.TWILIO_AUTH_TOK is None:
+            logging.getLogger('unter').error("Cannot send SMS via Twilio - missing credentials.")
+            for msg in messages:
+                stubSMSAlerter(**msg)
+            return [None] * len(messages)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(lambda msg: self.send(msg['message'],
+                msg.get('sourceNumber'),msg.get('destNumber')),messages))
 
 TWILIO_SMS_ALERTER = None
 def sendSMSUsingTwilio(message,sourceNumber="+19159743306",destNumber="+19155495098"):
     global TWILIO_SMS_ALERTER
     if TWILIO_SMS_ALERTER is None:
         TWILIO_SMS_ALERTER = TwilioSMSAlerter()
-    TWILIO_SMS_ALERTER(message,sourceNumber,destNumber)
+    return TWILIO_SMS_ALERTER(message,sourceNumber,destNumber)
 
 #####################
 # An SMS alerter that just logs the alert.
@@ -367,14 +726,29 @@ def sendSMSUsingTwilio(message,sourceNumber="+19159743306",destNumber="+19155495
 def stubSMSAlerter(message,sourceNumber="+19159743306",destNumber="+19155495098"):
     getLogger().info("CALLING stubSMSAlerter({},{},{})".format(message,sourceNumber,destNumber))
 
+def rateLimitStats():
+    ''' How many sends each provider's rate limits held up, and for how long. '''
+    stats = {}
+    if TWILIO_SMS_ALERTER is not None:
+        stats['sms'] = TWILIO_SMS_ALERTER.limiter.stats()
+    if SMTP_ALERTER is not None:
+        stats['email'] = SMTP_ALERTER.limiter.stats()
+    return stats
+
 #####################
 # Alert settings.
 #####################
 SMS_ALERTER = stubSMSAlerter
 EMAIL_ALERTER = stubEmailAlerter
 
-# Get/set the SMS alert callable.
+# Get/set the SMS alert callable. When asynchronous dispatch
+# is configured (see unter.controllers.dispatch) the getters
+# return callables that queue the alert and return at once,
+# unless the alerter is marked queueable = False.
 def getSMSAlerter():
+    dispatcher = dispatch.getDispatcher()
+    if dispatcher is not None and getattr(SMS_ALERTER,'queueable',True):
+        return dispatcher.alerter('sms',SMS_ALERTER)
     return SMS_ALERTER
 
 def setSMSAlerter(alerter):
@@ -383,6 +757,9 @@ def setSMSAlerter(alerter):
 
 # Get/set the email alert callable.
 def getEmailAlerter():
+    dispatcher = dispatch.getDispatcher()
+    if dispatcher is not None and getattr(EMAIL_ALERTER,'queueable',True):
+        return dispatcher.alerter('email',EMAIL_ALERTER)
     return EMAIL_ALERTER
 
 def setEmailAlerter(alerter):
@@ -417,6 +794,18 @@ def configureEmailAlerter():
     '''
     configHandler('email.alerter',stubEmailAlerter,setEmailAlerter)
 
+#####################
+# Configuration handler called from unter/config/app_config.py
+# to set up asynchronous alert dispatch on app startup.
+#####################
+def configureDispatch():
+    '''
+    Queue alerts for delivery by worker threads if alerts.async is
+    set in the [app:main] section of the .ini file. See
+    unter.controllers.dispatch for the options.
+    '''
+    dispatch.configureDispatch(tg.config)
+
 # Generic configuration handler.
 def configHandler(alerterOpt,stubAlerter,assignmentLambda):
     alerter = tg.config.get(alerterOpt,None)
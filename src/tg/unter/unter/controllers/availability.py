@@ -0,0 +1,208 @@
+'''
+A compact, vectorized copy of all VolunteerAvailability rows.
+
+Each availability window is held as one slot in a set of NumPy
+column arrays: a 7-bit day-of-week mask (bit n set for
+datetime.weekday() == n), the start and end minutes, and the owning
+user_id. Matching an event against every window is then a handful of
+array comparisons and one AND, rather than a Python loop over ORM
+objects.
+
+Windows are kept separately rather than OR-ed into one weekly mask per
+volunteer, because a volunteer is only available for an event if a
+single window contains it.
+
+The volunteer_availability table remains the source of truth. The
+bitmap is loaded from it on first use, updated incrementally as
+availability rows are inserted, updated and deleted through the ORM
+(the changes are applied when the transaction commits), and reloaded
+from the table after MAX_BITMAP_AGE seconds, so that changes made by
+other processes are eventually seen. Until then, matching with the
+bitmap (unter.controllers.need.sweepEvents()) can disagree with the
+SQL path (queryAlertableVolunteers()) about a volunteer whose
+availability another process changed.
+
+Each bitmap has a lock held while windows are changed and while it is
+matched against, since changes are applied by whichever thread
+commits and matching runs on request threads and the re-evaluator's
+(unter.controllers.reevaluate).
+'''
+import logging
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+import unter.model as model
+
+__all__ = ['DOW_COLUMNS','AvailabilityBitmap','getAvailabilityBitmap','invalidate']
+
+# VolunteerAvailability day-of-week columns, indexed by
+# datetime.weekday().
+DOW_COLUMNS = ['dow_monday','dow_tuesday','dow_wednesday','dow_thursday',
+        'dow_friday','dow_saturday','dow_sunday']
+
+# Reload the bitmap from the DB when it is older than this, so
+# other processes' changes are at most this many seconds stale.
+MAX_BITMAP_AGE = 60
+
+def getLogger():
+    return logging.getLogger('unter.availability')
+
+def dayMask(av):
+    ''' Get the day-of-week bit mask for a VolunteerAvailability. '''
+    mask = 0
+    for dow,col in enumerate(DOW_COLUMNS):
+        if getattr(av,col) == 1:
+            mask |= 1 << dow
+    return mask
+
+class AvailabilityBitmap:
+    '''
+    Availability windows in column arrays. Slots are packed: removing
+    a window moves the last slot into its place. Hold lock to make
+    several changes at once.
+    '''
+
+    def __init__(self,capacity=64):
+        self.lock = threading.RLock()
+        self.size = 0
+        self.slots = {}
+        self.vaids = np.zeros(capacity,dtype=np.int64)
+        self.user_ids = np.zeros(capacity,dtype=np.int64)
+        self.days = np.zeros(capacity,dtype=np.uint8)
+        self.starts = np.zeros(capacity,dtype=np.int32)
+        self.ends = np.zeros(capacity,dtype=np.int32)
+
+    def grow(self):
+        capacity = 2 * len(self.vaids)
+        for name in ('vaids','user_ids','days','starts','ends'):
+            old = getattr(self,name)
+            new = np.zeros(capacity,dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self,name,new)
+
+    def set(self,vaid,user_id,days,start,end):
+        ''' Add or replace the window with the given vaid. '''
+        with self.lock:
+            slot = self.slots.get(vaid)
+            if slot is None:
+                if self.size == len(self.vaids):
+                    self.grow()
+                slot = self.size
+                self.size += 1
+                self.slots[vaid] = slot
+            self.vaids[slot] = vaid
+            self.user_ids[slot] = user_id
+            self.days[slot] = days
+            self.starts[slot] = start
+            self.ends[slot] = end
+
+    def remove(self,vaid):
+        ''' Remove the window with the given vaid, if present. '''
+        with self.lock:
+            slot = self.slots.pop(vaid,None)
+            if slot is None:
+                return
+            last = self.size - 1
+            if slot != last:
+                for arr in (self.vaids,self.user_ids,self.days,self.starts,self.ends):
+                    arr[slot] = arr[last]
+                self.slots[int(self.vaids[slot])] = slot
+            self.size = last
+
+    def matches(self,dow,start,end):
+        ''' A boolean array: which slots contain [start,end] on day-of-week dow. '''
+        with self.lock:
+            n = self.size
+            return ((self.days[:n] & (1 << dow)) != 0) & \
+                    (self.starts[:n] <= start) & (self.ends[:n] >= end)
+
+    def availableUserIds(self,dow,start,end):
+        '''
+        Get the IDs of users with a window on day-of-week dow that
+        contains the minute-of-day interval [start,end].
+        '''
+        with self.lock:
+            return set(self.user_ids[:self.size][self.matches(dow,start,end)].tolist())
+
+    @staticmethod
+    def load(dbsession):
+        ''' Build a bitmap from every row in the volunteer_availability table. '''
+        va = model.VolunteerAvailability
+        cols = [getattr(va,col) for col in DOW_COLUMNS]
+        rows = dbsession.query(va.vaid,va.user_id,va.start_time,va.end_time,*cols).all()
+        result = AvailabilityBitmap(capacity=max(64,len(rows)))
+        for row in rows:
+            mask = 0
+            for dow in range(7):
+                if row[4+dow] == 1:
+                    mask |= 1 << dow
+            result.set(row[0],row[1],mask,row[2],row[3])
+        return result
+
+#####################
+# The process-wide bitmap.
+#####################
+BITMAP = None
+BITMAP_LOAD_TIME = 0
+BITMAP_LOCK = threading.RLock()
+
+def getAvailabilityBitmap(dbsession):
+    ''' Get the process-wide bitmap, loading it if necessary. '''
+    global BITMAP, BITMAP_LOAD_TIME
+    with BITMAP_LOCK:
+        if BITMAP is None or time.time() - BITMAP_LOAD_TIME > MAX_BITMAP_AGE:
+            BITMAP = AvailabilityBitmap.load(dbsession)
+            BITMAP_LOAD_TIME = time.time()
+            getLogger().debug('Loaded {} availability windows.'.format(BITMAP.size))
+        return BITMAP
+
+def invalidate():
+    ''' Discard the process-wide bitmap; it is reloaded on next use. '''
+    global BITMAP
+    with BITMAP_LOCK:
+        BITMAP = None
+
+#####################
+# Incremental maintenance. Row changes are collected per session
+# as they are flushed and applied to the bitmap when the session
+# commits, so rolled-back changes never reach it.
+#####################
+PENDING_KEY = 'unter.availability.pending'
+
+def recordChange(session,change):
+    if session is not None:
+        session.info.setdefault(PENDING_KEY,[]).append(change)
+
+@event.listens_for(model.VolunteerAvailability,'after_insert')
+@event.listens_for(model.VolunteerAvailability,'after_update')
+def availabilitySaved(mapper,connection,av):
+    recordChange(object_session(av),('set',av.vaid,av.user_id,dayMask(av),av.start_time,av.end_time))
+
+@event.listens_for(model.VolunteerAvailability,'after_delete')
+def availabilityDeleted(mapper,connection,av):
+    recordChange(object_session(av),('remove',av.vaid))
+
+@event.listens_for(model.DBSession,'after_commit')
+def applyChanges(session):
+    changes = session.info.pop(PENDING_KEY,[])
+    if len(changes) == 0:
+        return
+    with BITMAP_LOCK:
+        bitmap = BITMAP
+    if bitmap is None:
+        return
+    # Readers see all of a transaction's changes or none of them.
+    with bitmap.lock:
+        for change in changes:
+            if change[0] == 'set':
+                bitmap.set(*change[1:])
+            else:
+                bitmap.remove(change[1])
+
+@event.listens_for(model.DBSession,'after_rollback')
+def discardChanges(session):
+    session.info.pop(PENDING_KEY,None)
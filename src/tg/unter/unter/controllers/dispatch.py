@@ -0,0 +1,299 @@
+'''
+Asynchronous alert dispatch.
+
+When enabled, getSMSAlerter() and getEmailAlerter() in
+unter.controllers.alerts return callables that put the alert on a
+queue and return at once. A bounded pool of worker threads per
+channel ("sms", "email") takes alerts off the queues and calls the
+real alerters, so a request that alerts hundreds of volunteers costs
+the time to build the messages, not the time to deliver them.
+
+Each channel's queue has two priority lanes, "transactional" for
+confirmations, cancellations and the like, and "broadcast" for the
+"volunteers needed" fan-out; the lane is the "lane" field of the
+current alertContext() (see unter.controllers.spool), transactional
+if there is none. Workers serve the lanes by weighted round robin,
+and broadcasts may not occupy the workers reserved for transactional
+alerts, so a cancellation is not stuck behind a large broadcast.
+
+Configure this in the [app:main] section of the .ini file:
+
+  alerts.async = true            Enable asynchronous dispatch.
+  alerts.sms.workers = 4         Concurrent SMS deliveries.
+  alerts.email.workers = 2       Concurrent email deliveries.
+  alerts.queue.size = 10000      Alerts queued per channel before
+                                 callers wait for room.
+  alerts.queue.timeout = 5       Seconds a caller waits for room
+                                 before delivering the alert itself.
+  alerts.transactional.weight = 8
+  alerts.broadcast.weight = 1    Relative share of the workers each
+                                 lane gets while both have alerts.
+  alerts.reserved.workers = 1    Workers per channel broadcasts may
+                                 not use.
+
+Queued alerts are drained when the process exits.
+'''
+import atexit
+import collections
+import logging
+import queue
+import threading
+import time
+
+from unter.controllers.spool import currentContext
+
+__all__ = ['AlertDispatcher','configureDispatch','getDispatcher','setDispatcher']
+
+def getLogger():
+    return logging.getLogger('unter.dispatch')
+
+# Queued in place of an alert to stop a worker.
+STOP = object()
+
+TRANSACTIONAL = 'transactional'
+BROADCAST = 'broadcast'
+
+# Priority lanes and their default weights.
+LANE_WEIGHTS = collections.OrderedDict([(TRANSACTIONAL,8),(BROADCAST,1)])
+
+def currentLane():
+    ''' The lane of alerts sent on this thread now. '''
+    lane = currentContext().get('lane',TRANSACTIONAL)
+    return lane if lane in LANE_WEIGHTS else TRANSACTIONAL
+
+class LaneQueue:
+    '''
+    A bounded FIFO queue per lane, with the queue.Queue methods the
+    dispatcher uses. get() picks a lane by smooth weighted round robin
+    among the lanes with alerts waiting and fewer than their limit in
+    progress; each get() must be matched by a task_done(lane).
+
+    The alert service has the same queue (alert_service.service.lanes);
+    test_alert_dispatch checks that the two serve lanes alike.
+    '''
+
+    def __init__(self,maxsize=0,weights=None,limits=None):
+        if weights is None:
+            weights = LANE_WEIGHTS
+        self.maxsize = maxsize
+        self.weights = dict(weights)
+        self.limits = dict(limits or {})
+        self.items = dict([(lane,collections.deque()) for lane in self.weights])
+        self.active = dict([(lane,0) for lane in self.weights])
+        self.credit = dict([(lane,0) for lane in self.weights])
+        self.unfinished = 0
+        self.stops = 0
+        self.cond = threading.Condition()
+
+    def put(self,item,timeout=None,lane=TRANSACTIONAL):
+        with self.cond:
+            if item is STOP:
+                self.stops += 1
+            else:
+                if self.maxsize > 0 and not self.cond.wait_for(\
+                        lambda: len(self.items[lane]) < self.maxsize,timeout):
+                    raise queue.Full()
+                self.items[lane].append(item)
+                self.unfinished += 1
+            self.cond.notify_all()
+
+    def eligible(self):
+        return [lane for lane,items in self.items.items() if len(items) > 0 and \
+                self.active[lane] < self.limits.get(lane,self.active[lane] + 1)]
+
+    def get(self):
+        ''' Wait for an alert; return (lane,item), or (None,STOP) when stopped and empty. '''
+        with self.cond:
+            while True:
+                lanes = self.eligible()
+                if len(lanes) > 0:
+                    break
+                if self.stops > 0 and self.qsize() == 0:
+                    self.stops -= 1
+                    return None,STOP
+                self.cond.wait()
+            total = 0
+            for lane in lanes:
+                self.credit[lane] += self.weights[lane]
+                total += self.weights[lane]
+            lane = max(lanes,key=lambda l: self.credit[l])
+            self.credit[lane] -= total
+            self.active[lane] += 1
+            item = self.items[lane].popleft()
+            self.cond.notify_all()
+            return lane,item
+
+    def task_done(self,lane):
+        with self.cond:
+            self.active[lane] -= 1
+            self.unfinished -= 1
+            self.cond.notify_all()
+
+    def qsize(self,lane=None):
+        if lane is not None:
+            return len(self.items[lane])
+        return sum([len(items) for items in self.items.values()])
+
+    def join(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.unfinished == 0)
+
+class AlertDispatcher:
+    '''
+    A queue with priority lanes and a fixed set of worker threads for
+    each channel. reservedWorkers of each channel's workers are kept
+    for transactional alerts.
+    '''
+
+    def __init__(self,workers=None,queueSize=10000,queueTimeout=5,laneWeights=None,
+            reservedWorkers=1):
+        if workers is None:
+            workers = {'sms':4,'email':2}
+        self.queueTimeout = queueTimeout
+        self.queues = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.accepting = True
+        self.delivered = 0
+        self.failed = 0
+        # The longest any alert in each lane has waited in a queue, in seconds.
+        self.maxWait = dict([(lane,0) for lane in (laneWeights or LANE_WEIGHTS)])
+        for channel,count in workers.items():
+            self.queues[channel] = LaneQueue(queueSize,laneWeights,
+                    {BROADCAST:max(1,count - reservedWorkers)})
+            self.threads[channel] = []
+            for i in range(count):
+                t = threading.Thread(target=self.work,args=(channel,),
+                        name='unter-{}-{}'.format(channel,i),daemon=True)
+                t.start()
+                self.threads[channel].append(t)
+
+    def alerter(self,channel,alerter):
+        '''
+        Get a callable with the same signature as alerter that
+        queues the call on channel instead of making it.
+        '''
+        def queued(*args,**kwargs):
+            self.submit(channel,alerter,*args,**kwargs)
+        return queued
+
+    def submit(self,channel,alerter,*args,**kwargs):
+        '''
+        Queue a call of alerter(*args,**kwargs) on channel, in the
+        current lane. If the dispatcher is draining, or the lane stays
+        full for queueTimeout seconds, the call is made on the caller's
+        thread.
+        '''
+        item = (time.time(),alerter,args,kwargs)
+        lane = currentLane()
+        if self.accepting:
+            try:
+                self.queues[channel].put(item,timeout=self.queueTimeout,lane=lane)
+                return
+            except queue.Full:
+                getLogger().warning('{} {} queue full, delivering on request thread.'.\
+                        format(channel,lane))
+        self.deliver(channel,item)
+
+    def deliver(self,channel,item,lane=None):
+        queuedAt,alerter,args,kwargs = item
+        if lane is not None:
+            waited = time.time() - queuedAt
+            with self.lock:
+                self.maxWait[lane] = max(self.maxWait[lane],waited)
+        try:
+            # An alerter returns False when it could not send.
+            if alerter(*args,**kwargs) is False:
+                with self.lock:
+                    self.failed += 1
+                getLogger().error('{} alert was not sent.'.format(channel))
+            else:
+                with self.lock:
+                    self.delivered += 1
+        except:
+            import sys
+            with self.lock:
+                self.failed += 1
+            getLogger().error('{} alert failed: {}'.format(channel,sys.exc_info()[1]))
+
+    def work(self,channel):
+        q = self.queues[channel]
+        while True:
+            lane,item = q.get()
+            if item is STOP:
+                return
+            try:
+                self.deliver(channel,item,lane)
+            finally:
+                q.task_done(lane)
+
+    def depth(self,channel=None,lane=None):
+        ''' The number of alerts waiting on channel (or all channels) in lane (or all lanes). '''
+        if channel is not None:
+            return self.queues[channel].qsize(lane)
+        return sum([q.qsize(lane) for q in self.queues.values()])
+
+    def join(self):
+        ''' Wait until every queued alert has been delivered. '''
+        for q in self.queues.values():
+            q.join()
+
+    def drain(self,timeout=30):
+        '''
+        Stop accepting alerts, deliver everything already queued and
+        stop the workers. Wait at most timeout seconds for the workers.
+        '''
+        self.accepting = False
+        for channel,threads in self.threads.items():
+            for t in threads:
+                self.queues[channel].put(STOP)
+        deadline = time.time() + timeout
+        for threads in self.threads.values():
+            for t in threads:
+                t.join(max(0,deadline-time.time()))
+        left = self.depth()
+        if left > 0:
+            getLogger().error('Alert dispatcher stopped with {} alerts undelivered.'.format(left))
+
+#####################
+# The process-wide dispatcher. None means alerts are
+# delivered synchronously.
+#####################
+DISPATCHER = None
+
+def getDispatcher():
+    return DISPATCHER
+
+def setDispatcher(dispatcher):
+    ''' Install dispatcher, draining any previous one. '''
+    global DISPATCHER
+    old = DISPATCHER
+    DISPATCHER = dispatcher
+    if old is not None:
+        old.drain()
+
+def drainOnExit():
+    if DISPATCHER is not None:
+        DISPATCHER.drain()
+
+atexit.register(drainOnExit)
+
+def configureDispatch(config):
+    '''
+    Set up the process-wide dispatcher from the alerts.* options in
+    config (see the module docstring).
+    '''
+    if str(config.get('alerts.async','false')).lower() not in ('true','1','yes','on'):
+        getLogger().info('Alerts are delivered synchronously. Set alerts.async = true to queue them.')
+        setDispatcher(None)
+        return
+    workers = {'sms':int(config.get('alerts.sms.workers',4)),
+            'email':int(config.get('alerts.email.workers',2))}
+    getLogger().info('Alerts are queued, workers: {}'.format(workers))
+    weights = dict([(lane,int(config.get('alerts.{}.weight'.format(lane),weight))) \
+            for lane,weight in LANE_WEIGHTS.items()])
+    setDispatcher(AlertDispatcher(workers=workers,
+        queueSize=int(config.get('alerts.queue.size',10000)),
+        queueTimeout=float(config.get('alerts.queue.timeout',5)),
+        laneWeights=weights,
+        reservedWorkers=int(config.get('alerts.reserved.workers',1))))
@@ -11,8 +11,7 @@ import datetime
 from unter import model
 
 def getEventTypeChoices():
-    ets = model.DBSession.query(model.EventType).all()
-    return list([(str(et.etid),et.name) for et in ets])
+    return list([(str(et.etid),et.name) for et in model.EventType.all_types()])
 
 class AddEventTypeForm(wtf.Form):
     name = wtf.TextField("Name")
@@ -35,7 +34,8 @@ class NeedEventForm(wtf.Form):
 
 	date_of_need = wtfc.DateField("Date")
 	time_of_need = wtfc.TimeField("Time")
-	ev_type = wtf.SelectField("Type of Need",choices=getEventTypeChoices())
+	# Choices are filled in per instance by __init__().
+	ev_type = wtf.SelectField("Type of Need",choices=[])
 	duration = wtf.DecimalField("Estimated Duration (minutes)")
 	volunteer_count = wtf.DecimalField("Number of Volunteers Needed")
 	affected_persons = wtf.DecimalField("Number of People With Need")
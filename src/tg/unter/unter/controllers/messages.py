@@ -0,0 +1,205 @@
+'''
+Alert message templates.
+
+An alert for an event says the same thing to every volunteer but for
+a few words: the response token in the links of a "volunteers needed"
+message, the volunteer's name in a confirmation. Building the whole
+message for each recipient re-derives the date and time strings, the
+event type description and the coordinator's details every time, so
+instead each kind of message is compiled once per event into a
+MessageTemplate, and only the per-recipient slots are filled in for
+each volunteer:
+
+    template = eventMessage(nev,site=MVCA_SITE)
+    for vol in volunteers:
+        send(template.render(token=tokenFor[vol.user_id]))
+
+Compiled templates are cached, keyed by every event field they use,
+so an edited event gets a new template rather than a stale one, and
+confirmations and cancellations for the same event, which arrive one
+request at a time, reuse theirs.
+
+The response links in an event message are short: SITE/a/TOKEN to
+accept and SITE/r/TOKEN to refuse, handled by RootController.a() and
+r(). An SMS over 160 characters is sent, and billed, as several
+segments of 153 (see smsSegments()), and the old
+SITE/sms_response?uuid=...&action=... links alone took most of two.
+'''
+import collections
+import datetime as dt
+import math
+import threading
+
+from unter.controllers.util import evTypeToString, minutesPastMidnightToTimeString
+
+__all__ = ['MessageTemplate','eventMessage','confirmationMessage','cancellationMessage',
+        'coordDecommitMessage','reminderMessage','clearTemplates','templateStats','smsSegments']
+
+# Compiled templates kept, least recently used dropped first.
+MAX_TEMPLATES = 256
+
+class Slot:
+    ''' A per-recipient part of a MessageTemplate, filled in by render(). '''
+
+    def __init__(self,name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Slot({!r})'.format(self.name)
+
+class MessageTemplate:
+    '''
+    A message made of literal text and Slots. Adjacent literals are
+    joined when the template is built, so render() only concatenates
+    a few strings. Slot values are inserted as str() of them, without
+    formatting, so braces in a name need no escaping.
+    '''
+
+    def __init__(self,*parts):
+        self.parts = []
+        for part in parts:
+            if isinstance(part,str) and len(self.parts) > 0 and isinstance(self.parts[-1],str):
+                self.parts[-1] += part
+            elif not isinstance(part,str) or part != '':
+                self.parts.append(part)
+        self.slots = [p.name for p in self.parts if isinstance(p,Slot)]
+
+    def render(self,**values):
+        return ''.join([str(values[p.name]) if isinstance(p,Slot) else p for p in self.parts])
+
+    def __repr__(self):
+        return 'MessageTemplate({})'.format(', '.join([repr(p) for p in self.parts]))
+
+#####################
+# The cache.
+#####################
+TEMPLATES = collections.OrderedDict()
+TEMPLATES_LOCK = threading.Lock()
+STATS = dict(hits=0,misses=0)
+
+def cachedTemplate(key,compile):
+    ''' The template cached under key, compiling and caching it if there is none. '''
+    with TEMPLATES_LOCK:
+        template = TEMPLATES.get(key)
+        if template is not None:
+            TEMPLATES.move_to_end(key)
+            STATS['hits'] += 1
+            return template
+        STATS['misses'] += 1
+    template = compile()
+    with TEMPLATES_LOCK:
+        TEMPLATES[key] = template
+        while len(TEMPLATES) > MAX_TEMPLATES:
+            TEMPLATES.popitem(last=False)
+    return template
+
+def clearTemplates():
+    with TEMPLATES_LOCK:
+        TEMPLATES.clear()
+        STATS['hits'] = STATS['misses'] = 0
+
+def templateStats():
+    with TEMPLATES_LOCK:
+        return dict(STATS,size=len(TEMPLATES))
+
+#####################
+# The messages.
+#####################
+def eventDate(ev):
+    return str(dt.date.fromtimestamp(ev.date_of_need))
+
+def eventMessage(nev,source='MVCA',site=''):
+    '''
+    The "volunteers needed" message for nev, with a "token" slot for
+    the recipient's response token (see unter.controllers.tokens).
+    '''
+    coord = nev.created_by
+    # The event type's description, not its id, so an edited
+    # description is not served from an old template.
+    purpose = evTypeToString(nev.etid)
+    key = ('event',nev.neid,source,site,nev.volunteer_count,nev.time_of_need,nev.date_of_need,
+            purpose,nev.location,coord.display_name,coord.phone)
+    def compile():
+        token = Slot('token')
+        return MessageTemplate(
+                "This is {}. We have a need for {} volunteer(s) at {} {}. Purpose: {}. ".format(
+                    source,nev.volunteer_count,minutesPastMidnightToTimeString(nev.time_of_need),
+                    eventDate(nev),purpose),
+                "Location: {}. Can you help? Call {} {} or click link to commit: ".format(
+                    nev.location,coord.display_name,coord.phone),
+                "{}/a/".format(site),token,". ",
+                "Or click to ignore: ",
+                "{}/r/".format(site),token)
+    return cachedTemplate(key,compile)
+
+def confirmationMessage(ev,confirming=True):
+    '''
+    The reply to a volunteer who accepted ev, with a "name" slot for
+    their display name. If not confirming, the event already has
+    enough volunteers.
+    '''
+    if not confirming:
+        return cachedTemplate(('redundant',),lambda: MessageTemplate(
+                "Thank you for responding, ",Slot('name'),". ",
+                "Enough volunteers have responded already, so you do not need to attend this event. ",
+                "If someone cancels, we may contact you again. Thank you for being ",
+                "willing to help!"))
+    key = ('confirmation',ev.neid,ev.location,ev.time_of_need,ev.date_of_need)
+    return cachedTemplate(key,lambda: MessageTemplate(
+            "Thank you for responding, ",Slot('name'),". ",
+            "Please go to {} at {} on {}. You will receive a reminder one hour beforehand.".format(
+                ev.location,minutesPastMidnightToTimeString(ev.time_of_need),eventDate(ev))))
+
+def reminderMessage(ev):
+    ''' The reminder sent to a volunteer, the "name" slot, shortly before ev. '''
+    key = ('reminder',ev.neid,ev.location,ev.time_of_need,ev.date_of_need)
+    return cachedTemplate(key,lambda: MessageTemplate(
+            "Reminder, ",Slot('name'),": ",
+            "please go to {} at {} on {}. Thank you for helping!".format(
+                ev.location,minutesPastMidnightToTimeString(ev.time_of_need),eventDate(ev))))
+
+def cancellationMessage(ev):
+    ''' The message to volunteers committed to ev when it is cancelled. It has no slots. '''
+    key = ('cancellation',ev.neid,ev.location,ev.time_of_need,ev.date_of_need)
+    return cachedTemplate(key,lambda: MessageTemplate(
+            'An event you committed to has been cancelled. ',
+            'You do not need to go to {} at {} on {}. '.format(
+                ev.location,eventDate(ev),minutesPastMidnightToTimeString(ev.time_of_need)),
+            'Thank you for being willing to help!'))
+
+def coordDecommitMessage(ev):
+    ''' The message to ev's coordinator when a volunteer, the "name" slot, cancels. '''
+    key = ('decommit',ev.neid,ev.location,ev.time_of_need,ev.date_of_need)
+    return cachedTemplate(key,lambda: MessageTemplate(
+            "Volunteer ",Slot('name'),
+            " cannot serve at your event {} {} at {}".format(
+                eventDate(ev),minutesPastMidnightToTimeString(ev.time_of_need),ev.location)))
+
+#####################
+# SMS segments.
+#####################
+# The GSM 03.38 alphabet. Characters in GSM_EXTENDED take two of a
+# segment's septets; any other character makes the whole message
+# UCS-2.
+GSM_BASIC = frozenset("@\u00a3$\u00a5\u00e8\u00e9\u00f9\u00ec\u00f2\u00c7\n\u00d8\u00f8\r\u00c5\u00e5"
+        "\u0394_\u03a6\u0393\u039b\u03a9\u03a0\u03a8\u03a3\u0398\u039e\u00c6\u00e6\u00df\u00c9"
+        " !\"#\u00a4%&'()*+,-./0123456789:;<=>?"
+        "\u00a1ABCDEFGHIJKLMNOPQRSTUVWXYZ\u00c4\u00d6\u00d1\u00dc\u00a7"
+        "\u00bfabcdefghijklmnopqrstuvwxyz\u00e4\u00f6\u00f1\u00fc\u00e0")
+GSM_EXTENDED = frozenset("^{}\\[~]|\u20ac\f")
+
+def smsSegments(text):
+    '''
+    The number of segments text is sent as: one of up to 160 GSM
+    characters, else 153 per segment (70 and 67 if it needs UCS-2).
+    '''
+    septets = 0
+    for ch in text:
+        if ch in GSM_BASIC:
+            septets += 1
+        elif ch in GSM_EXTENDED:
+            septets += 2
+        else:
+            units = len(text.encode('utf-16-le')) // 2
+            return 1 if units <= 70 else math.ceil(units / 67)
+    return 1 if septets <= 160 else math.ceil(septets / 153)
@@ -4,11 +4,21 @@ Code for matching need events with volunteers.
 import datetime as dt
 import logging
 import sys
+import bisect
+import functools
+import operator
 import datetime as dt
 
+from sqlalchemy import and_, or_, exists, func
+from sqlalchemy.orm import aliased
+
 import unter.model as model
 import unter.controllers.alerts as alerts
+import unter.controllers.reminders as reminders
 from unter.controllers.util import Thing
+from unter.controllers.availability import DOW_COLUMNS, getAvailabilityBitmap
+from unter.controllers.profiles import withProfile
+from unter.model.auth import user_group_table, group_permission_table
 
 def debug(msg):
     logging.getLogger(__name__).debug(msg)
@@ -32,11 +42,21 @@ def checkOneEvent(dbsession,ev_id,honorLastAlertTime=True):
     alerts.sendAlerts(vols,nev,honorLastAlertTime=honorLastAlertTime)
     dbsession.flush()
 
-def checkValidEvents(dbsession,when=None):
+def checkValidEvents(dbsession,when=None,honorLastAlertTime=True):
+    '''
+    Send alerts for every incomplete event that needs them. All
+    events, availabilities, permissions and commitments are loaded
+    once and matched in memory by sweepEvents(), so the cost grows
+    with the number of events plus the number of volunteers.
+    '''
     print("Checking need events at {}".format(when))
     nevs = dbsession.query(model.NeedEvent).filter_by(complete=0).all()
-    for nev in nevs:
-        checkOneEvent(dbsession,nev.neid)
+    if honorLastAlertTime:
+        nevs = [nev for nev in nevs if not alerts.alertedRecently(nev)]
+    for nev,vols in sweepEvents(dbsession,nevs):
+        debugTest("  Alertable vols for {}: {}".format(nev.notes,[v.user_name for v in vols]))
+        alerts.sendAlerts(vols,nev,honorLastAlertTime=honorLastAlertTime)
+    dbsession.flush()
 
 def cancelEvent(dbsession,ev,sendAlerts=True):
     vols = [r.user for r in ev.event_response]
@@ -44,6 +64,7 @@ def cancelEvent(dbsession,ev,sendAlerts=True):
         for vol in vols:
             alerts.sendCancellationAlert(ev,vol)
     ev.cancelled = 1
+    reminders.eventClosed(ev)
 
 def commit_volunteer(dbsession,user,nev):
     '''
@@ -60,6 +81,7 @@ def commit_volunteer(dbsession,user,nev):
             vresp = model.VolunteerResponse(user_id=user.user_id,neid=nev.neid)
             model.DBSession.add(vresp)
             alerts.sendConfirmationAlert(user,nev,confirming=True)
+            reminders.responseAdded(user,nev)
         else:
             alerts.sendConfirmationAlert(user,nev,confirming=False)
     else:
@@ -107,6 +129,7 @@ def decommit_volunteer(dbsession,vcom=None,user=None,ev=None):
             alertCoord = True
     if alertCoord:
         alerts.sendCoordDecommitAlert(vresp.user,vresp.need_event)
+        reminders.responseRemoved(vresp.user,vresp.need_event)
     if vresp.user is None or vresp.need_event is None:
         raise Exception("Cannot decommit - user or event missing.")
     existingDecommit = dbsession.query(model.VolunteerDecommitment).filter_by(user_id=vresp.user.user_id).\
@@ -122,17 +145,13 @@ def getDowCheck(nev):
     Get a function that will check VolunteerAvailability
     objects to see if they match the day-of-week of nev.
     '''
-    dow = dt.datetime.fromtimestamp(nev.date_of_need).weekday()
+    return DOW_CHECKS[dayOf(nev.date_of_need).weekday()]
 
-    return {
-            0:lambda x: x.dow_monday == 1,
-            1:lambda x: x.dow_tuesday == 1,
-            2:lambda x: x.dow_wednesday == 1,
-            3:lambda x: x.dow_thursday == 1,
-            4:lambda x: x.dow_friday == 1,
-            5:lambda x: x.dow_saturday == 1,
-            6:lambda x: x.dow_sunday == 1,
-            }[dow]
+def makeDowCheck(col):
+    getter = operator.attrgetter(col)
+    return lambda x: getter(x) == 1
+
+DOW_CHECKS = [makeDowCheck(col) for col in DOW_COLUMNS]
 
 def getCommittedVolunteers(dbsession,nev):
     '''
@@ -173,20 +192,30 @@ def getAvailableEventsForVolunteer(dbsession,vol):
     '''
     result = []
 
-    allEvs = dbsession.query(model.NeedEvent).filter_by(complete=0).filter_by(cancelled=0)
+    if 'respond_to_need' not in [p.permission_name for p in vol.permissions]:
+        return result
+
+    allEvs = withProfile(dbsession.query(model.NeedEvent),'event_list').\
+            filter_by(complete=0).filter_by(cancelled=0).all()
     committedEvs = [vr.need_event for vr in vol.volunteer_response]
     committedEvs = [ev for ev in committedEvs if ev.complete == 0 and ev.cancelled == 0]
-    committedEvIDs = [ev.neid for ev in committedEvs]
-    allEvs = [ev for ev in allEvs if ev.neid not in committedEvIDs and not isFullyServed(dbsession,ev)]
+    committedEvIDs = set([ev.neid for ev in committedEvs])
+    committed = EventIntervalIndex(committedEvs)
+    vr = model.VolunteerResponse
+    responseCounts = dict(dbsession.query(vr.neid,func.count(vr.vrid)).group_by(vr.neid).all())
+    avails = vol.volunteer_availability
     for eachEv in allEvs:
-        if overlapsAny(eachEv,committedEvs):
+        if eachEv.neid in committedEvIDs or eachEv.volunteer_count <= responseCounts.get(eachEv.neid,0):
+            continue
+        if committed.conflictsAny(eachEv):
             # Cannot be available if committed to overlapping event.
             continue
-        vols = getAvailableVolunteers(dbsession,eachEv,[vol])
-        if len(vols) == 1:
-            # Available if getAvailableVolunteers() finds this volunteer
-            # when it is the only one supplied.
-            result.append(eachEv)
+        dowCheck = getDowCheck(eachEv)
+        for avail in avails:
+            if dowCheck(avail) and avail.start_time <= eachEv.time_of_need and\
+                    avail.end_time >= eachEv.time_of_need+eachEv.duration:
+                result.append(eachEv)
+                break
     return result
 
 def isFullyServed(dbsession,ev):
@@ -199,33 +228,15 @@ def ev2Str(ev):
     return "{}/{}/{} {} {}".format(date.year,date.month,date.day,time,duration)
 
 def overlapsAny(ev,evs):
+    day,start,end = eventSpan(ev)
     for ev2 in evs:
-        if overlappingEvents(ev,ev2):
+        day2,start2,end2 = eventSpan(ev2)
+        if day == day2 and spansOverlap(start,end,start2,end2):
             return True
     return False
 
 def overlappingEvents(ev1,ev2):
-    result = None
-    ev1Date = dt.datetime.fromtimestamp(ev1.date_of_need)
-    ev2Date = dt.datetime.fromtimestamp(ev2.date_of_need)
-    if ev1Date.year != ev2Date.year or \
-        ev1Date.month != ev2Date.month or \
-        ev1Date.day != ev2Date.day:
-            result = False
-    else:
-        ev1start = ev1.time_of_need
-        ev1end = ev1.time_of_need + ev1.duration
-        ev2start = ev2.time_of_need
-        ev2end = ev2.time_of_need + ev2.duration
-        if ev1start >= ev2start and ev1start <= ev2end:
-            result = True
-        if ev1end >= ev2start and ev1end <= ev2end:
-            result = True
-        if ev2start >= ev1start and ev2start <= ev1end:
-            result = True
-        if ev2end >= ev1start and ev2end <= ev1end:
-            result = True
-    return result
+    return overlapsAny(ev1,[ev2])
 
 def getUncommittedVolunteers(dbsession,nev,vols):
     '''
@@ -235,17 +246,221 @@ def getUncommittedVolunteers(dbsession,nev,vols):
     result = []
 
     for vol in vols:
-        available = True
-        for r in vol.volunteer_response:
-            rnev = r.need_event
-            if overlappingEvents(nev,rnev):
-                # Not available.
-                available = False
-                break
-        if available:
+        if not overlapsAny(nev,[r.need_event for r in vol.volunteer_response]):
             result.append(vol)
 
     return result
 
+#####################
+# Event conflict detection. Events conflict when they fall on
+# the same calendar day and their minute-of-day intervals
+# overlap, end points included.
+#####################
+
+@functools.lru_cache(maxsize=4096)
+def dayOf(timestamp):
+    ''' The local calendar date of a Unix time. '''
+    return dt.date.fromtimestamp(timestamp)
+
+def eventSpan(ev):
+    '''
+    Get the (day,start,end) span of ev: its calendar date, and its
+    start and end in minutes past midnight.
+    '''
+    return dayOf(ev.date_of_need),ev.time_of_need,ev.time_of_need+ev.duration
+
+def spansOverlap(start1,end1,start2,end2):
+    ''' True if [start1,end1] and [start2,end2] overlap. '''
+    return (start2 <= start1 <= end2) or (start2 <= end1 <= end2) or \
+            (start1 <= start2 <= end1) or (start1 <= end2 <= end1)
+
+class EventIntervalIndex:
+    '''
+    An index of event spans, kept per calendar day in order of
+    start time. Finding the entries that overlap a span costs a
+    bisection plus the number of entries starting within the
+    longest indexed duration before it, rather than a comparison
+    against every indexed event.
+
+    Entries are events by default, but any item may be indexed
+    under a span with addSpan().
+    '''
+
+    def __init__(self,evs=()):
+        self.days = {}
+        self.maxDuration = 0
+        for ev in evs:
+            self.add(ev)
+
+    def add(self,ev,item=None):
+        ''' Index ev, or item under the span of ev. '''
+        if item is None:
+            item = ev
+        day,start,end = eventSpan(ev)
+        self.addSpan(day,start,end,item)
+
+    def addSpan(self,day,start,end,item):
+        starts,entries = self.days.setdefault(day,([],[]))
+        i = bisect.bisect_right(starts,start)
+        starts.insert(i,start)
+        entries.insert(i,(start,end,item))
+        self.maxDuration = max(self.maxDuration,end-start)
+
+    def overlapping(self,day,start,end):
+        ''' Generate the items whose spans overlap [start,end] on day. '''
+        if day not in self.days:
+            return
+        starts,entries = self.days[day]
+        lo = bisect.bisect_left(starts,start-self.maxDuration)
+        hi = bisect.bisect_right(starts,end)
+        for start2,end2,item in entries[lo:hi]:
+            if spansOverlap(start,end,start2,end2):
+                yield item
+
+    def conflicts(self,ev):
+        ''' Get the indexed items that conflict with ev. '''
+        return list(self.overlapping(*eventSpan(ev)))
+
+    def conflictsAny(self,ev):
+        ''' True if any indexed item conflicts with ev. '''
+        for item in self.overlapping(*eventSpan(ev)):
+            return True
+        return False
+
 def getAlertableVolunteers(dbsession,nev):
-    return getUncommittedVolunteers(dbsession,nev,getAvailableVolunteers(dbsession,nev))
+    return queryAlertableVolunteers(dbsession,nev)
+
+#####################
+# Set-based volunteer matching. These functions answer the
+# same questions as getAvailableVolunteers() and
+# getUncommittedVolunteers(), but push the filtering into
+# SQL so that the number of statements issued does not
+# depend on the number of volunteers.
+#####################
+
+def getDayBounds(timestamp):
+    '''
+    Get the (start,end) Unix times of the local calendar day
+    containing timestamp. Two events fall on the same day (in
+    the sense used by overlappingEvents()) exactly when their
+    date_of_need values fall in the same [start,end) range.
+    '''
+    day = dt.datetime.fromtimestamp(timestamp).date()
+    nextDay = day + dt.timedelta(days=1)
+    start = dt.datetime(day.year,day.month,day.day).timestamp()
+    end = dt.datetime(nextDay.year,nextDay.month,nextDay.day).timestamp()
+    return start,end
+
+def availableClause(nev):
+    '''
+    An EXISTS clause that is true for users with an availability
+    window containing nev on its day of week.
+    '''
+    va = model.VolunteerAvailability
+    dow = dt.datetime.fromtimestamp(nev.date_of_need).weekday()
+    dowCol = getattr(va,DOW_COLUMNS[dow])
+    return exists().where(and_(va.user_id == model.User.user_id,
+        dowCol == 1,
+        va.start_time <= nev.time_of_need,
+        va.end_time >= nev.time_of_need+nev.duration))
+
+def permissionClause(permission_name='respond_to_need'):
+    '''
+    An EXISTS clause that is true for users holding the given
+    permission through any of their groups.
+    '''
+    return exists().where(and_(user_group_table.c.user_id == model.User.user_id,
+        group_permission_table.c.group_id == user_group_table.c.group_id,
+        model.Permission.permission_id == group_permission_table.c.permission_id,
+        model.Permission.permission_name == permission_name))
+
+def conflictClause(nev):
+    '''
+    An EXISTS clause that is true for users who have responded to
+    any event overlapping nev, using the same inclusive range checks
+    as overlappingEvents().
+    '''
+    rnev = aliased(model.NeedEvent)
+    vr = model.VolunteerResponse
+    dayStart,dayEnd = getDayBounds(nev.date_of_need)
+    start1 = nev.time_of_need
+    end1 = nev.time_of_need + nev.duration
+    start2 = rnev.time_of_need
+    end2 = rnev.time_of_need + rnev.duration
+    overlap = or_(and_(start2 <= start1, end2 >= start1),
+            and_(start2 <= end1, end2 >= end1),
+            and_(start2 >= start1, start2 <= end1),
+            and_(end2 >= start1, end2 <= end1))
+    return exists().where(and_(vr.user_id == model.User.user_id,
+        rnev.neid == vr.neid,
+        rnev.date_of_need >= dayStart,
+        rnev.date_of_need < dayEnd,
+        overlap))
+
+def queryAlertableVolunteers(dbsession,nev):
+    '''
+    Get the volunteers who are available for nev and have no
+    conflicting commitments, using a single SELECT. The result
+    is the same as
+      getUncommittedVolunteers(dbsession,nev,getAvailableVolunteers(dbsession,nev))
+    ordered by user_id.
+    '''
+    return dbsession.query(model.User).\
+            filter(permissionClause()).\
+            filter(availableClause(nev)).\
+            filter(~conflictClause(nev)).\
+            order_by(model.User.user_id).all()
+
+#####################
+# Batch matching. When many events must be checked at once,
+# sweepEvents() loads everything it needs in a fixed number of
+# queries and matches events against in-memory indexes: the
+# availability bitmap (see unter.controllers.availability) and
+# an EventIntervalIndex of commitments.
+#####################
+
+def getCommitmentIndex(dbsession):
+    '''
+    Get an EventIntervalIndex of the user_ids of all volunteer
+    commitments, under the spans of the committed events.
+    '''
+    vr = model.VolunteerResponse
+    ne = model.NeedEvent
+    rows = dbsession.query(vr.user_id,ne.date_of_need,ne.time_of_need,ne.duration).\
+            filter(ne.neid == vr.neid).all()
+    result = EventIntervalIndex()
+    for user_id,date_of_need,time_of_need,duration in rows:
+        result.addSpan(dayOf(date_of_need),time_of_need,time_of_need+duration,user_id)
+    return result
+
+def sweepEvents(dbsession,nevs):
+    '''
+    Compute the alertable volunteers for each of nevs. Return a
+    list of (event,volunteers) pairs for the events that are not
+    fully-served, with each volunteer list ordered by user_id, as
+    queryAlertableVolunteers() would order it.
+    '''
+    if len(nevs) == 0:
+        return []
+    availability = getAvailabilityBitmap(dbsession)
+    permitted = set([uid for (uid,) in \
+            dbsession.query(model.User.user_id).filter(permissionClause()).all()])
+    commitments = getCommitmentIndex(dbsession)
+    vr = model.VolunteerResponse
+    responseCounts = dict(dbsession.query(vr.neid,func.count(vr.vrid)).group_by(vr.neid).all())
+    volunteers = None
+
+    result = []
+    for nev in nevs:
+        if nev.volunteer_count <= responseCounts.get(nev.neid,0):
+            continue
+        day,start,end = eventSpan(nev)
+        userIds = (availability.availableUserIds(day.weekday(),start,end) & permitted) - \
+                set(commitments.overlapping(day,start,end))
+        if volunteers is None:
+            # Load the volunteers themselves only once, and only if
+            # some event actually needs them.
+            volunteers = dict([(u.user_id,u) for u in \
+                    dbsession.query(model.User).filter(permissionClause()).all()])
+        result.append((nev,[volunteers[uid] for uid in sorted(userIds)]))
+    return result
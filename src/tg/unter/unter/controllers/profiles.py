@@ -0,0 +1,54 @@
+'''
+Named eager-loading profiles for the queries behind each page.
+
+Templates such as event_renderer.xhtml walk an event's creator,
+responses and refusals, and the users behind those. Loaded lazily,
+each of these is a separate SELECT per row. A profile is a bundle of
+loader options that fetches everything a page will touch up front, in
+a fixed number of statements:
+
+    evs = withProfile(DBSession.query(model.NeedEvent),'event_list').all()
+'''
+from sqlalchemy.orm import Load, selectinload
+
+import unter.model as model
+
+__all__ = ['PROFILES','withProfile']
+
+def eventOptions(base=None):
+    '''
+    Loader options for everything event_renderer.xhtml and
+    toWrappedEvent() touch on a NeedEvent. base, if given, is a
+    function returning a fresh Load that leads to the events.
+    '''
+    ne = model.NeedEvent
+    if base is None:
+        base = lambda: Load(ne)
+    return [base().joinedload(ne.created_by),
+            base().selectinload(ne.responses).joinedload(model.VolunteerResponse.user),
+            base().selectinload(ne.refusers).joinedload(model.VolunteerDecommitment.user),
+            base().selectinload(ne.event_response)]
+
+def eventListProfile():
+    ''' Lists of events: /need_events, /coord_page, available events. '''
+    return eventOptions()
+
+def volunteerProfile():
+    ''' A volunteer with their groups, availability and commitments: /volunteer_info. '''
+    u = model.User
+    vr = model.VolunteerResponse
+    return [selectinload(u.groups).selectinload(model.Group.permissions),
+            selectinload(u.volunteer_availability),
+            selectinload(u.volunteer_response).joinedload(vr.need_event)] + \
+            eventOptions(lambda: Load(u).defaultload(u.volunteer_response).defaultload(vr.need_event))
+
+PROFILES = {
+        'event_list':eventListProfile,
+        'need_events':eventListProfile,
+        'coord_page':eventListProfile,
+        'volunteer_info':volunteerProfile,
+        }
+
+def withProfile(query,name):
+    ''' Apply the named loader profile to query. '''
+    return query.options(*PROFILES[name]())
@@ -0,0 +1,189 @@
+'''
+Pacing alert sends to the providers' limits.
+
+Twilio and the SMTP relay both limit how fast we may send: so many
+messages per second for the account, per second for each sending
+number, and per day. Past the limit Twilio answers 429 and the relay
+defers or refuses mail, so rather than find the limit by failing,
+each alerter waits before a send until it is within every limit that
+applies, using token buckets:
+
+  * the provider's limits, shared by every send;
+  * a sender's limits, one set of buckets per From number or address;
+  * optionally a recipient's limits, one set per To number or
+    address, so nobody gets a burst of texts.
+
+A limit is written "count/period", the period being s, m, h, d or a
+number of seconds, and a scope may have several, separated by commas,
+eg "10/s, 250000/d". Each limit is a bucket holding `count` tokens,
+refilled at count/period per second; a send takes a token from every
+bucket that applies, and waits if any is empty. Sends are paced at
+`headroom` (by default 90%) of the limits, to stay just under them.
+
+Configure the limits in the [app:main] section of the .ini file, for
+Twilio (prefix "twilio") and SMTP (prefix "smtp"):
+
+  twilio.limits = 10/s              Provider limits (default:
+                                    twilio.rate per second).
+  twilio.sender.limits = 1/s        Limits per sending number.
+  twilio.recipient.limits = 3/m     Limits per recipient (none).
+  twilio.headroom = 0.9             Fraction of the limits to use.
+
+and likewise smtp.limits, smtp.sender.limits and so on.
+
+When a provider throttles us anyway, penalize() pauses every send
+through that provider for a while, rather than only the one that was
+refused. stats() reports how many sends waited, and for how long.
+
+The alert service, which is deployed without the web app, has its own
+copy of the parsing and the buckets (alert_service.service.ratelimit);
+test_rate_limits checks that the two agree.
+'''
+import logging
+import threading
+import time
+
+__all__ = ['TokenBucket','RateLimiter','parseLimits','limiterFromConfig']
+
+def getLogger():
+    return logging.getLogger('unter.ratelimit')
+
+PERIODS = {'s':1,'m':60,'h':3600,'d':86400}
+
+# Scopes of limits, in the order their buckets are taken.
+SCOPES = ('provider','sender','recipient')
+
+def parseLimits(text):
+    '''
+    Parse "count/period, ..." into a list of (count,seconds). None or
+    an empty string means no limits.
+    '''
+    limits = []
+    if text is None:
+        return limits
+    for part in str(text).split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        count,period = part.split('/',1)
+        period = period.strip()
+        seconds = PERIODS.get(period)
+        if seconds is None:
+            seconds = float(period)
+        limits.append((float(count),seconds))
+    return limits
+
+class TokenBucket:
+    '''
+    At most `count` takes per `period` seconds, refilled continuously.
+    reserve() always takes a token, going into debt if need be, and
+    returns how long the caller must wait for it, so waiting callers
+    are served in the order they asked.
+    '''
+
+    def __init__(self,count,period,clock=time.time):
+        self.capacity = count
+        self.rate = count / period
+        self.tokens = count
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self,now=None):
+        if now is None:
+            now = self.clock()
+        self.tokens = min(self.capacity,self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self,now=None):
+        ''' Take a token. Return the seconds until it is really ours. '''
+        self.refill(now)
+        self.tokens -= 1
+        return max(0,-self.tokens / self.rate)
+
+    def full(self,now=None):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class RateLimiter:
+    '''
+    The limits for one provider. limits maps a scope in SCOPES to a
+    list of (count,seconds), as from parseLimits().
+    '''
+
+    # Drop idle sender and recipient buckets every this many sends.
+    PRUNE_EVERY = 1000
+
+    def __init__(self,limits=None,headroom=0.9,clock=time.time,sleep=time.sleep):
+        self.limits = dict([(scope,[(count * headroom,seconds) for count,seconds in specs]) \
+                for scope,specs in (limits or {}).items() if len(specs) > 0])
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.pausedUntil = 0
+        self.sends = 0
+        self.waits = 0
+        self.waited = 0.0
+        self.maxWait = 0.0
+        self.throttled = 0
+
+    def bucketsFor(self,scope,key):
+        buckets = self.buckets.get((scope,key))
+        if buckets is None:
+            buckets = [TokenBucket(count,seconds,self.clock) for count,seconds in self.limits[scope]]
+            self.buckets[(scope,key)] = buckets
+        return buckets
+
+    def reserve(self,sender=None,recipient=None):
+        ''' Take a token from every bucket that applies. Return the seconds to wait. '''
+        keys = dict(provider=None,sender=sender,recipient=recipient)
+        with self.lock:
+            now = self.clock()
+            wait = max(0,self.pausedUntil - now)
+            for scope in SCOPES:
+                if scope not in self.limits or (scope != 'provider' and keys[scope] is None):
+                    continue
+                for bucket in self.bucketsFor(scope,keys[scope]):
+                    wait = max(wait,bucket.reserve(now))
+            self.sends += 1
+            if self.sends % self.PRUNE_EVERY == 0:
+                self.prune(now)
+            if wait > 0:
+                self.waits += 1
+                self.waited += wait
+                self.maxWait = max(self.maxWait,wait)
+        return wait
+
+    def wait(self,sender=None,recipient=None):
+        ''' Wait until a send from sender to recipient is within the limits. Return the wait. '''
+        wait = self.reserve(sender,recipient)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def penalize(self,seconds):
+        ''' The provider throttled us: hold every send for seconds. '''
+        with self.lock:
+            self.throttled += 1
+            self.pausedUntil = max(self.pausedUntil,self.clock() + seconds)
+
+    def prune(self,now):
+        ''' Forget sender and recipient buckets that have refilled. Call with self.lock held. '''
+        for key,buckets in list(self.buckets.items()):
+            if key[0] != 'provider' and all([b.full(now) for b in buckets]):
+                del self.buckets[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(sends=self.sends,waits=self.waits,waited=round(self.waited,3),
+                    maxWait=round(self.maxWait,3),throttled=self.throttled)
+
+def limiterFromConfig(config,prefix,defaultLimits=None):
+    '''
+    A RateLimiter from the <prefix>.limits, <prefix>.sender.limits,
+    <prefix>.recipient.limits and <prefix>.headroom options.
+    '''
+    limits = dict(provider=parseLimits(config.get(prefix + '.limits',defaultLimits)),
+            sender=parseLimits(config.get(prefix + '.sender.limits',None)),
+            recipient=parseLimits(config.get(prefix + '.recipient.limits',None)))
+    return RateLimiter(limits,float(config.get(prefix + '.headroom',0.9)))
@@ -0,0 +1,377 @@
+'''
+Automatic re-evaluation of unfilled events.
+
+Without this, volunteers are only re-alerted when a coordinator asks
+(/check_events, /send_alert), and then every incomplete event is
+matched again. An EventReevaluator instead notes, as they commit, the
+changes that can make an event need alerting again:
+
+  * a volunteer withdraws (a volunteer_response row is deleted), or an
+    event's volunteer_count changes: that event;
+  * an availability window is added or changed: the events it
+    contains;
+  * a volunteer is added to a group (activated or promoted): the
+    events they are available for;
+  * an event's last_alert_time passes MIN_ALERT_SECONDS ago: that
+    event, so an event still short of volunteers is alerted again.
+
+Changes are collected for reevaluate.delay seconds after the first,
+so a burst of them costs one pass. A pass matches volunteers
+(unter.controllers.need.sweepEvents()) for the affected events that
+are open, still in the future and not alerted recently, and alerts
+them. Between passes the thread sleeps until the next change or the
+next last_alert_time expiry, so an idle site costs nothing.
+
+The changes are noted by SQLAlchemy event listeners, as for the
+availability bitmap (unter.controllers.availability), and handed to
+the re-evaluator only when the session commits, so rolled-back changes
+are ignored. Bulk query deletes and updates are not seen.
+
+Changes are only seen in the process that commits them, and every
+process running a re-evaluator would schedule every open event's
+expiry and alert it, so the application must run as one process
+(uWSGI's default). configureReevaluation() refuses to start the
+re-evaluator under uWSGI with more than one worker, and logs an
+error.
+
+Configure this in the [app:main] section of the .ini file:
+
+  reevaluate.enabled = true   Re-evaluate events in the background.
+  reevaluate.delay = 5        Seconds to collect changes before a pass.
+'''
+import heapq
+import logging
+import threading
+import time
+
+import transaction
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history
+
+import unter.model as model
+from unter.controllers.availability import dayMask, getAvailabilityBitmap
+from unter.controllers.util import eventStart, eventStartsAfterBound, serverProcesses
+
+__all__ = ['EventReevaluator','configureReevaluation','getReevaluator','setReevaluator']
+
+def getLogger():
+    return logging.getLogger('unter.reevaluate')
+
+# Set from the .ini file by configureReevaluation().
+DELAY = 5
+
+# The process-wide re-evaluator, if enabled.
+REEVALUATOR = None
+
+def newWork():
+    ''' What a pass has to look at: events, availability windows (mask,start,end) and users. '''
+    return dict(events=set(),windows=[],users=set())
+
+class EventReevaluator:
+    '''
+    Collects changes (markEvent(), markWindow(), markUser()) and
+    last_alert_time expiries (scheduleExpiry()), and runs
+    evaluate(work) on them, at most every delay seconds, on its
+    thread once start()ed, or when runPending() is called. clock gives
+    the time; tests pass their own.
+    '''
+
+    # Seconds between attempts to load the expiries at startup.
+    LOAD_RETRY = 10
+
+    def __init__(self,delay=5,evaluate=None,clock=time.time):
+        self.delay = delay
+        self.evaluate = evaluate if evaluate is not None else reevaluateEvents
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.work = newWork()
+        self.firstChange = None
+        self.expiries = {}
+        self.heap = []
+        self.thread = None
+        self.stopping = False
+        self.passes = 0
+        self.wakeups = 0
+
+    #####################
+    # Noting changes.
+    #####################
+    def changed(self):
+        ''' Call with self.cond held. '''
+        if self.firstChange is None:
+            self.firstChange = self.clock()
+            self.cond.notify()
+
+    def markEvent(self,neid):
+        with self.cond:
+            self.work['events'].add(neid)
+            self.changed()
+
+    def markWindow(self,mask,start,end):
+        with self.cond:
+            self.work['windows'].append((mask,start,end))
+            self.changed()
+
+    def markUser(self,user_id):
+        with self.cond:
+            self.work['users'].add(user_id)
+            self.changed()
+
+    def scheduleExpiry(self,neid,when):
+        ''' Re-evaluate event neid at when, instead of at any time scheduled before. '''
+        with self.cond:
+            self.expiries[neid] = when
+            heapq.heappush(self.heap,(when,neid))
+            if self.heap[0] == (when,neid):
+                self.cond.notify()
+
+    def nextExpiry(self):
+        ''' The earliest expiry, or None. Call with self.cond held. '''
+        while len(self.heap) > 0 and self.expiries.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def nextPass(self):
+        ''' When the next pass is due, or None if nothing is pending. Call with self.cond held. '''
+        when = self.nextExpiry()
+        if self.firstChange is not None:
+            due = self.firstChange + self.delay
+            when = due if when is None else min(when,due)
+        return when
+
+    def takeWork(self,now,force=False):
+        '''
+        Take the pending changes and the expiries due by now, if a pass
+        is due (or force). Return the work, or None.
+        '''
+        with self.cond:
+            when = self.nextPass()
+            if when is None or (when > now and not force):
+                return None
+            work = self.work
+            while True:
+                expiry = self.nextExpiry()
+                if expiry is None or expiry > now:
+                    break
+                expiry,neid = heapq.heappop(self.heap)
+                del self.expiries[neid]
+                work['events'].add(neid)
+            self.work = newWork()
+            self.firstChange = None
+            return work
+
+    def runPending(self,now=None,force=False):
+        '''
+        Run a pass if one is due by now (or force), with everything
+        pending. Return the result of evaluate(), or None.
+        '''
+        if now is None:
+            now = self.clock()
+        work = self.takeWork(now,force)
+        if work is None:
+            return None
+        self.passes += 1
+        try:
+            return self.evaluate(work)
+        except Exception as ex:
+            getLogger().error('Event re-evaluation failed: {}'.format(ex))
+
+    def loadFromDatabase(self):
+        ''' Schedule the last_alert_time expiry of every open event that has not started. '''
+        import unter.controllers.alerts as alerts
+        ev = model.NeedEvent
+        try:
+            now = self.clock()
+            rows = [row for row in model.DBSession.query(ev.neid,ev.last_alert_time,
+                        ev.date_of_need,ev.time_of_need).\
+                    filter(ev.complete == 0).filter(ev.cancelled == 0).\
+                    filter(eventStartsAfterBound(now)) if eventStart(row) > now]
+        finally:
+            model.DBSession.remove()
+        for row in rows:
+            self.scheduleExpiry(row.neid,row.last_alert_time + alerts.MIN_ALERT_SECONDS)
+        getLogger().info('Watching {} open events.'.format(len(rows)))
+
+    #####################
+    # Running in the background.
+    #####################
+    def start(self,load=True):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run,args=(load,),name='unter-reevaluate',daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self,load=True):
+        while load:
+            try:
+                self.loadFromDatabase()
+                break
+            except Exception as ex:
+                # The database may not be set up yet.
+                getLogger().error('Cannot load events to re-evaluate, retrying: {}'.format(ex))
+            with self.cond:
+                if not self.stopping:
+                    self.cond.wait(self.LOAD_RETRY)
+                if self.stopping:
+                    return
+        while True:
+            with self.cond:
+                while not self.stopping:
+                    when = self.nextPass()
+                    now = self.clock()
+                    if when is not None and when <= now:
+                        break
+                    # Sleep until a pass is due, or a change or an
+                    # earlier expiry arrives, or stop().
+                    self.cond.wait(None if when is None else when - now)
+                    self.wakeups += 1
+                if self.stopping:
+                    return
+            self.runPending()
+
+#####################
+# A pass.
+#####################
+def containsEvent(window,day,start,end):
+    mask,wstart,wend = window
+    return (mask & (1 << day.weekday())) != 0 and wstart <= start and wend >= end
+
+def reevaluateEvents(work,now=None):
+    '''
+    Alert volunteers for the open, future events affected by work
+    (see newWork()) that were not alerted recently. Schedule the
+    re-evaluation of those that were. Return the events alerted.
+    '''
+    import unter.controllers.alerts as alerts
+    import unter.controllers.need as need
+    if now is None:
+        now = time.time()
+    alerted = []
+    try:
+        with transaction.manager:
+            ev = model.NeedEvent
+            query = model.DBSession.query(ev).filter(ev.complete == 0).filter(ev.cancelled == 0).\
+                    filter(eventStartsAfterBound(now))
+            if len(work['windows']) == 0 and len(work['users']) == 0:
+                if len(work['events']) == 0:
+                    return alerted
+                query = query.filter(ev.neid.in_(work['events']))
+            bitmap = None
+            if len(work['users']) > 0:
+                bitmap = getAvailabilityBitmap(model.DBSession)
+            nevs = []
+            for nev in query.all():
+                if eventStart(nev) <= now:
+                    continue
+                day,start,end = need.eventSpan(nev)
+                if nev.neid in work['events'] or \
+                        any([containsEvent(w,day,start,end) for w in work['windows']]) or \
+                        (bitmap is not None and \
+                            len(bitmap.availableUserIds(day.weekday(),start,end) & work['users']) > 0):
+                    nevs.append(nev)
+            due = []
+            for nev in nevs:
+                if alerts.alertedRecently(nev):
+                    if REEVALUATOR is not None:
+                        REEVALUATOR.scheduleExpiry(nev.neid,nev.last_alert_time + alerts.MIN_ALERT_SECONDS)
+                else:
+                    due.append(nev)
+            for nev,vols in need.sweepEvents(model.DBSession,due):
+                getLogger().info('Re-alerting event {} to {} volunteers.'.format(nev.neid,len(vols)))
+                alerts.sendAlerts(vols,nev)
+                alerted.append(nev.neid)
+    finally:
+        model.DBSession.remove()
+    return alerted
+
+#####################
+# Noting changes as they commit.
+#####################
+PENDING_KEY = 'unter.reevaluate.pending'
+
+def recordChange(session,change):
+    if session is not None and REEVALUATOR is not None:
+        session.info.setdefault(PENDING_KEY,[]).append(change)
+
+@event.listens_for(model.VolunteerResponse,'after_delete')
+def responseDeleted(mapper,connection,vr):
+    recordChange(object_session(vr),('event',vr.neid))
+
+@event.listens_for(model.VolunteerAvailability,'after_insert')
+@event.listens_for(model.VolunteerAvailability,'after_update')
+def availabilitySaved(mapper,connection,av):
+    recordChange(object_session(av),('window',dayMask(av),av.start_time,av.end_time))
+
+@event.listens_for(model.NeedEvent,'after_insert')
+@event.listens_for(model.NeedEvent,'after_update')
+def eventSaved(mapper,connection,nev):
+    session = object_session(nev)
+    if get_history(nev,'last_alert_time').has_changes() and nev.last_alert_time:
+        recordChange(session,('alerted',nev.neid,nev.last_alert_time))
+    if get_history(nev,'volunteer_count').deleted:
+        recordChange(session,('event',nev.neid))
+
+@event.listens_for(model.Group.users,'append')
+def userAddedToGroup(group,user,initiator):
+    # A user new to the database has no availability yet.
+    if user.user_id is not None:
+        recordChange(object_session(group),('user',user.user_id))
+
+@event.listens_for(model.DBSession,'after_commit')
+def applyChanges(session):
+    import unter.controllers.alerts as alerts
+    changes = session.info.pop(PENDING_KEY,[])
+    reevaluator = REEVALUATOR
+    if reevaluator is None:
+        return
+    for change in changes:
+        if change[0] == 'event':
+            reevaluator.markEvent(change[1])
+        elif change[0] == 'window':
+            reevaluator.markWindow(*change[1:])
+        elif change[0] == 'alerted':
+            reevaluator.scheduleExpiry(change[1],change[2] + alerts.MIN_ALERT_SECONDS)
+        elif change[0] == 'user':
+            reevaluator.markUser(change[1])
+
+@event.listens_for(model.DBSession,'after_rollback')
+def discardChanges(session):
+    session.info.pop(PENDING_KEY,None)
+
+#####################
+# The process-wide re-evaluator.
+#####################
+def configureReevaluation(config):
+    ''' Read the reevaluate.* options (see the module docstring) and start the re-evaluator. '''
+    global DELAY
+    DELAY = float(config.get('reevaluate.delay',DELAY))
+    if str(config.get('reevaluate.enabled','false')).lower() not in ('true','1','yes','on'):
+        setReevaluator(None)
+        return
+    processes = serverProcesses()
+    if processes > 1:
+        getLogger().error('Not re-evaluating events: reevaluate.enabled needs one server process, '
+                'not {} (see unter.controllers.reevaluate).'.format(processes))
+        setReevaluator(None)
+        return
+    setReevaluator(EventReevaluator(DELAY).start())
+
+def getReevaluator():
+    return REEVALUATOR
+
+def setReevaluator(reevaluator):
+    ''' Install reevaluator, stopping any previous one. '''
+    global REEVALUATOR
+    old = REEVALUATOR
+    REEVALUATOR = reevaluator
+    if old is not None and old is not reevaluator:
+        old.stop()
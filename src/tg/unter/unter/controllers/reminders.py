@@ -0,0 +1,322 @@
+'''
+Reminders: the "one hour beforehand" text a confirmed volunteer is
+promised.
+
+A ReminderScheduler keeps one reminder per volunteer response to an
+upcoming event in a min-heap ordered by when it is due, reminders.lead
+seconds before the event starts. It is built from the database when
+it starts, and then kept up to date as responses are made and
+withdrawn and events are cancelled or completed (see responseAdded(),
+responseRemoved() and eventClosed(), called from
+unter.controllers.need once the transaction making the change
+commits), so nothing polls the tables. Its thread sleeps until the
+earliest reminder is due, or until an earlier one is added.
+
+Adding or moving a reminder costs O(log n). Removing one only marks
+its heap entry; marked entries are skipped when they reach the top,
+and the heap is rebuilt without them once they are half of it.
+
+A reminder is only scheduled while it is still in the future, so a
+volunteer who commits within the hour gets the confirmation alone, and
+reminders that fell due while the application was down are not sent
+late. When one is due, sendReminder() checks that the response still
+stands and the event is still on before sending it.
+
+The scheduler lives in the web application's process and hears of
+changes only from that process, so the application must run as one
+process (uWSGI's default). Each of several processes would load and
+send every reminder, so configureReminders() refuses to start it
+under uWSGI with more than one worker, and logs an error.
+
+Configure this in the [app:main] section of the .ini file:
+
+  reminders.enabled = true     Send reminders.
+  reminders.lead = 3600        Seconds before the event to send them.
+'''
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import transaction
+
+import unter.model as model
+from unter.controllers.util import eventStart, eventStartsAfterBound, serverProcesses
+
+__all__ = ['ReminderScheduler','configureReminders','getScheduler','setScheduler',
+        'responseAdded','responseRemoved','eventClosed','eventStart']
+
+def getLogger():
+    return logging.getLogger('unter.reminders')
+
+# Set from the .ini file by configureReminders().
+LEAD = 3600
+
+# The process-wide scheduler, if reminders are enabled.
+SCHEDULER = None
+
+# Heap entries are lists [due,sequence,user_id,neid,live].
+DUE, SEQ, USER_ID, NEID, LIVE = range(5)
+
+class ReminderScheduler:
+    '''
+    Reminders for (user_id,neid) responses, due lead seconds before
+    their events start. send(user_id,neid) is called for each as it
+    falls due, on the scheduler's thread once start()ed, or by
+    sendDue(). clock gives the time; tests pass their own.
+    '''
+
+    # Seconds between attempts to load the reminders at startup.
+    LOAD_RETRY = 10
+
+    def __init__(self,lead=3600,send=None,clock=time.time):
+        self.lead = lead
+        self.send = send if send is not None else sendReminder
+        self.clock = clock
+        self.heap = []
+        self.entries = {}
+        self.byEvent = {}
+        self.dead = 0
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.sent = 0
+        self.wakeups = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def makeEntry(self,user_id,neid,start):
+        entry = [start - self.lead,next(self.sequence),user_id,neid,True]
+        self.entries[(user_id,neid)] = entry
+        self.byEvent.setdefault(neid,set()).add(user_id)
+        return entry
+
+    def add(self,user_id,neid,start):
+        '''
+        Remind user_id of event neid, which starts at start, replacing
+        any reminder already scheduled. Return False if it is already
+        too late.
+        '''
+        with self.cond:
+            self.dropEntry(user_id,neid)
+            if start - self.lead <= self.clock():
+                return False
+            entry = self.makeEntry(user_id,neid,start)
+            heapq.heappush(self.heap,entry)
+            if self.heap[0] is entry:
+                self.cond.notify()
+            return True
+
+    def remove(self,user_id,neid):
+        ''' Forget the reminder for user_id and event neid, if any. '''
+        with self.cond:
+            self.dropEntry(user_id,neid)
+
+    def removeEvent(self,neid):
+        ''' Forget every reminder for event neid. '''
+        with self.cond:
+            for user_id in list(self.byEvent.get(neid,())):
+                self.dropEntry(user_id,neid)
+
+    def dropEntry(self,user_id,neid):
+        ''' Call with self.cond held. '''
+        entry = self.entries.pop((user_id,neid),None)
+        if entry is None:
+            return
+        entry[LIVE] = False
+        users = self.byEvent[neid]
+        users.discard(user_id)
+        if len(users) == 0:
+            del self.byEvent[neid]
+        self.dead += 1
+        if self.dead > len(self.heap) // 2:
+            self.heap = [e for e in self.heap if e[LIVE]]
+            heapq.heapify(self.heap)
+            self.dead = 0
+
+    def load(self,responses):
+        '''
+        Replace every reminder with those for responses, an iterable
+        of (user_id,neid,start), in O(n).
+        '''
+        with self.cond:
+            now = self.clock()
+            self.entries = {}
+            self.byEvent = {}
+            self.heap = [self.makeEntry(user_id,neid,start) for user_id,neid,start in responses \
+                    if start - self.lead > now]
+            heapq.heapify(self.heap)
+            self.dead = 0
+            self.cond.notify()
+
+    def loadFromDatabase(self):
+        ''' Rebuild from the responses to events that are neither cancelled nor complete. '''
+        ev = model.NeedEvent
+        vr = model.VolunteerResponse
+        try:
+            rows = model.DBSession.query(vr.user_id,vr.neid,ev.date_of_need,ev.time_of_need).\
+                    join(ev,vr.neid == ev.neid).\
+                    filter(ev.cancelled == 0).filter(ev.complete == 0).\
+                    filter(eventStartsAfterBound(self.clock() + self.lead)).all()
+        finally:
+            model.DBSession.remove()
+        # load() drops those that start too soon.
+        self.load([(row.user_id,row.neid,eventStart(row)) for row in rows])
+        getLogger().info('Loaded {} reminders.'.format(len(self)))
+
+    def nextDue(self):
+        ''' When the earliest reminder is due, or None if there are none. Call with self.cond held. '''
+        while len(self.heap) > 0 and not self.heap[0][LIVE]:
+            heapq.heappop(self.heap)
+            self.dead -= 1
+        if len(self.heap) == 0:
+            return None
+        return self.heap[0][DUE]
+
+    def popDue(self,now=None):
+        ''' Remove and return the (user_id,neid) of every reminder due by now. '''
+        due = []
+        with self.cond:
+            if now is None:
+                now = self.clock()
+            while True:
+                when = self.nextDue()
+                if when is None or when > now:
+                    return due
+                entry = heapq.heappop(self.heap)
+                del self.entries[(entry[USER_ID],entry[NEID])]
+                users = self.byEvent[entry[NEID]]
+                users.discard(entry[USER_ID])
+                if len(users) == 0:
+                    del self.byEvent[entry[NEID]]
+                due.append((entry[USER_ID],entry[NEID]))
+
+    def sendDue(self,now=None):
+        ''' Send every reminder due by now. Return how many were sent. '''
+        due = self.popDue(now)
+        for user_id,neid in due:
+            try:
+                self.send(user_id,neid)
+                self.sent += 1
+            except Exception as ex:
+                getLogger().error('Cannot remind user {} of event {}: {}'.format(user_id,neid,ex))
+        return len(due)
+
+    #####################
+    # Running in the background.
+    #####################
+    def start(self,load=True):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run,args=(load,),name='unter-reminders',daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self,load=True):
+        while load:
+            try:
+                self.loadFromDatabase()
+                break
+            except Exception as ex:
+                # The database may not be set up yet.
+                getLogger().error('Cannot load reminders, retrying: {}'.format(ex))
+            with self.cond:
+                if not self.stopping:
+                    self.cond.wait(self.LOAD_RETRY)
+                if self.stopping:
+                    return
+        while True:
+            with self.cond:
+                while not self.stopping:
+                    when = self.nextDue()
+                    now = self.clock()
+                    if when is not None and when <= now:
+                        break
+                    # Sleep until the next reminder, or until woken by
+                    # an earlier one or stop().
+                    self.cond.wait(None if when is None else when - now)
+                    self.wakeups += 1
+                if self.stopping:
+                    return
+            self.sendDue()
+
+#####################
+# Sending.
+#####################
+def sendReminder(user_id,neid):
+    ''' Remind user_id of event neid, if they are still going and it is still on. '''
+    import unter.controllers.alerts as alerts
+    try:
+        with transaction.manager:
+            user = model.DBSession.query(model.User).get(user_id)
+            ev = model.DBSession.query(model.NeedEvent).get(neid)
+            if user is None or ev is None or ev.cancelled or ev.complete:
+                return
+            response = model.DBSession.query(model.VolunteerResponse).\
+                    filter_by(user_id=user_id,neid=neid).first()
+            if response is None:
+                return
+            alerts.sendReminderAlert(user,ev)
+    finally:
+        model.DBSession.remove()
+
+#####################
+# The process-wide scheduler.
+#####################
+def configureReminders(config):
+    ''' Read the reminders.* options (see the module docstring) and start the scheduler. '''
+    global LEAD
+    LEAD = float(config.get('reminders.lead',LEAD))
+    if str(config.get('reminders.enabled','false')).lower() not in ('true','1','yes','on'):
+        setScheduler(None)
+        return
+    processes = serverProcesses()
+    if processes > 1:
+        getLogger().error('Not sending reminders: reminders.enabled needs one server process, '
+                'not {} (see unter.controllers.reminders).'.format(processes))
+        setScheduler(None)
+        return
+    setScheduler(ReminderScheduler(LEAD).start())
+
+def getScheduler():
+    return SCHEDULER
+
+def setScheduler(scheduler):
+    ''' Install scheduler, stopping any previous one. '''
+    global SCHEDULER
+    old = SCHEDULER
+    SCHEDULER = scheduler
+    if old is not None and old is not scheduler:
+        old.stop()
+
+def afterCommit(fn,*args):
+    ''' Call fn(*args) on the scheduler if the current transaction commits. '''
+    scheduler = SCHEDULER
+    if scheduler is None:
+        return
+    def hook(committed,*args):
+        if committed:
+            fn(scheduler,*args)
+    transaction.get().addAfterCommitHook(hook,args)
+
+def responseAdded(user,ev):
+    ''' user has committed to ev. '''
+    afterCommit(ReminderScheduler.add,user.user_id,ev.neid,eventStart(ev))
+
+def responseRemoved(user,ev):
+    ''' user has withdrawn from ev. '''
+    afterCommit(ReminderScheduler.remove,user.user_id,ev.neid)
+
+def eventClosed(ev):
+    ''' ev has been cancelled or completed. '''
+    afterCommit(ReminderScheduler.removeEvent,ev.neid)
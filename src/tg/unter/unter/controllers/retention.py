@@ -0,0 +1,270 @@
+'''
+Retention: deleting rows nobody needs any more.
+
+Every alert adds an alert_uuid row per volunteer, every password reset
+request a password_reset row and every refusal a volunteer_decommitment
+row, and nothing removed them, so the tables that sms_response and
+forgot_pwd_post search only grew. runRetention() applies a policy to
+each:
+
+  alert_uuid              Tokens for events that are complete or
+                          cancelled, or ended more than
+                          retention.alert_uuid.days ago. Their links
+                          then do nothing.
+  password_reset          Reset requests older than
+                          unter.controllers.alerts.MAX_PWD_RESET_INTERVAL,
+                          which can no longer be used.
+  volunteer_decommitment  Refusals for events that ended more than
+                          retention.decommitment.days ago.
+
+and, optionally, archives events that ended more than
+retention.archive.days ago: each event and its responses are copied
+to need_event_archive and volunteer_response_archive, and the event
+and everything referring to it deleted from the live tables.
+
+Rows are deleted in batches of retention.batch.size, each in its own
+transaction, with a pause between batches, so the job never holds a
+write lock for long and requests are served in between.
+
+Configure this in the [app:main] section of the .ini file:
+
+  retention.interval = 3600           Seconds between runs in the
+                                      background (0, the default,
+                                      for none).
+  retention.alert_uuid.days = 1
+  retention.decommitment.days = 30
+  retention.archive.days = 365        Archive old events (default:
+                                      never).
+  retention.batch.size = 500
+  retention.batch.pause = 0.1         Seconds between batches.
+
+or run it from cron with
+
+    python -m unter.controllers.retention development.ini
+'''
+import argparse
+import logging
+import os
+import threading
+import time
+
+import transaction
+from sqlalchemy import select
+
+import unter.model as model
+import unter.controllers.alerts as alerts
+from unter.controllers.util import eventEnd, MAX_DAY_SECONDS
+
+__all__ = ['runRetention','configureRetention','startRetention','stopRetention']
+
+def getLogger():
+    return logging.getLogger('unter.retention')
+
+DAY = 86400
+
+# Set from the .ini file by configureRetention().
+INTERVAL = 0
+ALERT_UUID_DAYS = 1
+DECOMMITMENT_DAYS = 30
+ARCHIVE_DAYS = None
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.1
+
+# The background thread, if any.
+RETENTION_THREAD = None
+
+def configureRetention(config,start=True):
+    ''' Read the retention.* options (see the module docstring), and start the background job. '''
+    global INTERVAL, ALERT_UUID_DAYS, DECOMMITMENT_DAYS, ARCHIVE_DAYS, BATCH_SIZE, BATCH_PAUSE
+    INTERVAL = float(config.get('retention.interval',0))
+    ALERT_UUID_DAYS = float(config.get('retention.alert_uuid.days',ALERT_UUID_DAYS))
+    DECOMMITMENT_DAYS = float(config.get('retention.decommitment.days',DECOMMITMENT_DAYS))
+    archiveDays = config.get('retention.archive.days',None)
+    ARCHIVE_DAYS = None if archiveDays in (None,'') else float(archiveDays)
+    BATCH_SIZE = int(config.get('retention.batch.size',BATCH_SIZE))
+    BATCH_PAUSE = float(config.get('retention.batch.pause',BATCH_PAUSE))
+    if start and INTERVAL > 0:
+        startRetention(INTERVAL)
+
+#####################
+# Policies.
+#####################
+def latestEnd():
+    '''
+    SQL for date_of_need plus the event's end time. date_of_need may
+    be any time on the event's day, so this is at or after the time
+    the event really ends (util.eventEnd()), and less than a day after.
+    '''
+    ev = model.NeedEvent
+    return ev.date_of_need + (ev.time_of_need + ev.duration) * 60
+
+def endedBefore(cutoff):
+    '''
+    SQL true for the events that ended before cutoff. The few whose
+    latestEnd() is within a day after cutoff are checked in Python.
+    '''
+    ev = model.NeedEvent
+    near = model.DBSession.query(ev.neid,ev.date_of_need,ev.time_of_need,ev.duration).\
+            filter(latestEnd() >= cutoff).filter(latestEnd() < cutoff + MAX_DAY_SECONDS)
+    ended = [row.neid for row in near if eventEnd(row) < cutoff]
+    if len(ended) == 0:
+        return latestEnd() < cutoff
+    return (latestEnd() < cutoff) | ev.neid.in_(ended)
+
+def eventsEndedBefore(cutoff):
+    return select([model.NeedEvent.neid]).where(endedBefore(cutoff))
+
+def finishedEvents(cutoff):
+    ''' Events that are complete or cancelled, or ended before cutoff. '''
+    ev = model.NeedEvent
+    return select([ev.neid]).where((ev.complete != 0) | (ev.cancelled != 0) | endedBefore(cutoff))
+
+def purgeBatches(cls,pk,criterion,batchSize=None,pause=None):
+    '''
+    Delete the cls rows matching criterion, batchSize at a time, each
+    batch in its own transaction. pk is cls's primary key column.
+    Return the number deleted.
+    '''
+    if batchSize is None:
+        batchSize = BATCH_SIZE
+    if pause is None:
+        pause = BATCH_PAUSE
+    total = 0
+    while True:
+        with transaction.manager:
+            ids = [row[0] for row in model.DBSession.query(pk).filter(criterion).limit(batchSize)]
+            if len(ids) > 0:
+                model.DBSession.query(cls).filter(pk.in_(ids)).delete(synchronize_session=False)
+        total += len(ids)
+        if len(ids) < batchSize:
+            return total
+        time.sleep(pause)
+
+def purgeAlertUUIDs(now=None,**kwargs):
+    if now is None:
+        now = time.time()
+    auuid = model.AlertUUID
+    return purgeBatches(auuid,auuid.auid,
+            auuid.neid.in_(finishedEvents(now - ALERT_UUID_DAYS * DAY)),**kwargs)
+
+def purgePasswordResets(now=None,**kwargs):
+    if alerts.MAX_PWD_RESET_INTERVAL is None:
+        return 0
+    if now is None:
+        now = time.time()
+    puuid = model.PasswordUUID
+    return purgeBatches(puuid,puuid.prid,
+            puuid.create_time < now - alerts.MAX_PWD_RESET_INTERVAL,**kwargs)
+
+def purgeDecommitments(now=None,**kwargs):
+    if now is None:
+        now = time.time()
+    vd = model.VolunteerDecommitment
+    return purgeBatches(vd,vd.vrid,
+            vd.neid.in_(eventsEndedBefore(now - DECOMMITMENT_DAYS * DAY)),**kwargs)
+
+def archiveEvents(days,now=None,batchSize=None,pause=None):
+    '''
+    Move events that ended more than days ago, and their responses,
+    to the archive tables, batchSize events per transaction. Return
+    the number of events archived.
+    '''
+    if now is None:
+        now = time.time()
+    if batchSize is None:
+        batchSize = BATCH_SIZE
+    if pause is None:
+        pause = BATCH_PAUSE
+    bind = model.DBSession.get_bind()
+    for cls in (model.NeedEventArchive,model.VolunteerResponseArchive):
+        cls.__table__.create(bind=bind,checkfirst=True)
+    ev = model.NeedEvent
+    total = 0
+    while True:
+        with transaction.manager:
+            ids = [row[0] for row in model.DBSession.query(ev.neid).\
+                    filter(endedBefore(now - days * DAY)).limit(batchSize)]
+            if len(ids) > 0:
+                copyRows(ev,model.NeedEventArchive,ev.neid.in_(ids))
+                copyRows(model.VolunteerResponse,model.VolunteerResponseArchive,
+                        model.VolunteerResponse.neid.in_(ids))
+                for cls in (model.AlertUUID,model.VolunteerDecommitment,model.VolunteerResponse):
+                    model.DBSession.query(cls).filter(cls.neid.in_(ids)).delete(synchronize_session=False)
+                model.DBSession.query(ev).filter(ev.neid.in_(ids)).delete(synchronize_session=False)
+        total += len(ids)
+        if len(ids) < batchSize:
+            return total
+        time.sleep(pause)
+
+def copyRows(source,archive,criterion):
+    ''' INSERT INTO archive SELECT the same columns FROM source WHERE criterion. '''
+    names = [c.name for c in archive.__table__.columns]
+    columns = [source.__table__.c[name] for name in names]
+    model.DBSession.execute(archive.__table__.insert().from_select(names,
+        select(columns).where(criterion)))
+
+def runRetention(now=None,**kwargs):
+    ''' Apply every policy. Return the number of rows removed by each. '''
+    result = dict(alert_uuid=purgeAlertUUIDs(now,**kwargs),
+            password_reset=purgePasswordResets(now,**kwargs),
+            volunteer_decommitment=purgeDecommitments(now,**kwargs))
+    if ARCHIVE_DAYS is not None:
+        result['need_event'] = archiveEvents(ARCHIVE_DAYS,now,**kwargs)
+    getLogger().info('Retention: {}'.format(', '.join(['{} {}'.format(n,table) \
+            for table,n in sorted(result.items())])))
+    return result
+
+#####################
+# Running in the background.
+#####################
+class RetentionThread(threading.Thread):
+    ''' Run runRetention() every interval seconds. '''
+
+    def __init__(self,interval):
+        super().__init__(name='unter-retention',daemon=True)
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                runRetention()
+            except Exception as ex:
+                getLogger().error('Retention run failed: {}'.format(ex))
+            finally:
+                model.DBSession.remove()
+
+def startRetention(interval):
+    global RETENTION_THREAD
+    stopRetention()
+    RETENTION_THREAD = RetentionThread(interval)
+    RETENTION_THREAD.start()
+    return RETENTION_THREAD
+
+def stopRetention():
+    global RETENTION_THREAD
+    if RETENTION_THREAD is not None:
+        RETENTION_THREAD.stopping.set()
+        RETENTION_THREAD.join()
+        RETENTION_THREAD = None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete and archive old Unter rows.')
+    parser.add_argument('config',help='The .ini file, eg development.ini.')
+    parser.add_argument('--archive-days',type=float,default=None,
+            help='Archive events that ended this many days ago (overrides retention.archive.days).')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    from paste.deploy import appconfig
+    from sqlalchemy import engine_from_config
+    config = appconfig('config:' + os.path.abspath(args.config))
+    model.init_model(engine_from_config(config,'sqlalchemy.'))
+    configureRetention(config,start=False)
+    global ARCHIVE_DAYS
+    if args.archive_days is not None:
+        ARCHIVE_DAYS = args.archive_days
+    for table,n in sorted(runRetention().items()):
+        print('{:<24} {}'.format(table,n))
+
+if __name__ == '__main__':
+    main()
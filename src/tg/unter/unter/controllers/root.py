@@ -8,7 +8,7 @@ import uuid
 import re
 
 from tg import expose, flash, require, url, lurl
-from tg import request, redirect, tmpl_context
+from tg import request, redirect, tmpl_context, abort
 from tg.i18n import ugettext as _, lazy_ugettext as l_
 from tg.exceptions import HTTPFound
 from tg import predicates
@@ -28,7 +28,12 @@ from unter.controllers.forms import NewAcctForm,AvailabilityForm,NeedEventForm,A
 from unter.controllers.util import *
 import unter.controllers.need as need
 import unter.controllers.alerts as alerts
+import unter.controllers.reminders as reminders
 import unter.controllers.util as util
+from unter.controllers.profiles import withProfile
+from unter.controllers.alert_status import readAlertStatus
+from unter.controllers.alert_log import readAlertLog
+from unter.lib import sqlstats
 
 from sqlalchemy import or_,text
 
@@ -343,6 +348,8 @@ class RootController(BaseController):
         # At this point, we know the requesting_user is
         # either requesting their own data, or allowed to
         # view the user's data.
+        user = withProfile(model.DBSession.query(model.User),'volunteer_info').\
+                filter_by(user_id=user.user_id).one()
         availabilities = [self.toRawAvailability(av) for av in user.volunteer_availability]
         events_responded = [vr.need_event for vr in user.volunteer_response if vr.need_event.complete == 0]
         events_responded = [toWrappedEvent(ev) for ev in events_responded]
@@ -527,7 +534,8 @@ class RootController(BaseController):
         user = self.getVolunteerIdentity()
         if user is None:
             redirect(lurl('/login'))
-        events = model.DBSession.query(model.NeedEvent).filter_by(created_by=user).all()
+        events = withProfile(model.DBSession.query(model.NeedEvent),'coord_page').\
+                filter_by(created_by=user).all()
         events = [toWrappedEvent(ev) for ev in events if ev.complete == 0]
         return dict(user=user,events=events,message='')
 
@@ -584,6 +592,16 @@ class RootController(BaseController):
                 need.decommit_volunteer(model.DBSession,user=user,ev=nev)
         return 'Thank you for responding.'
 
+    @expose()
+    def a(self,uuid):
+        ''' The short "accept" link in an alert: /a/<token>. '''
+        return self.sms_response(uuid,'accept')
+
+    @expose()
+    def r(self,uuid):
+        ''' The short "refuse" link in an alert: /r/<token>. '''
+        return self.sms_response(uuid,'refuse')
+
     @expose('unter.templates.add_event_type_start')
     @require(predicates.has_permission('manage_events'))
     def add_event_type_start(self,form=None,**kwargs):
@@ -653,7 +671,8 @@ class RootController(BaseController):
     @require(predicates.not_anonymous())
     def need_events(self,completed=0,**kwargs):
         completed = int(completed)
-        evs = DBSession.query(model.NeedEvent).filter(model.NeedEvent.complete == completed).all()
+        evs = withProfile(DBSession.query(model.NeedEvent),'need_events').\
+                filter(model.NeedEvent.complete == completed).all()
         now = datetime.date.today()
         evs = [toWrappedEvent(ev,now) for ev in evs]
         evs = [ev for ev in evs if ev.ev.complete==completed]
@@ -673,6 +692,7 @@ class RootController(BaseController):
         if ev is not None:
             print("Got need event {}".format(neid))
             ev.complete = 1
+            reminders.eventClosed(ev)
         else:
             print("No such need event {}".format(neid))
         redirect(lurl("/need_events"))
@@ -697,7 +717,7 @@ class RootController(BaseController):
             checkOneEvent(DBSession,ev_id)
         else:
             now = datetime.datetime.now()
-            checkActiveEvents(DBSession,now)
+            checkValidEvents(DBSession,now)
         return dict()
 
     @expose('unter.templates.event_details')
@@ -732,6 +752,66 @@ class RootController(BaseController):
         need.checkValidEvents(model.DBSession)
         redirect(came_from)
 
+    #==================================
+    # Diagnostics.
+    #==================================
+
+    @expose('json')
+    @require(predicates.has_permission('manage'))
+    def sql_stats(self):
+        '''
+        Report how many SQL statements each page has executed:
+        requests served, total and maximum statements, and the
+        count for the most recent request.
+        '''
+        return dict(pages=sqlstats.pageStats())
+
+    @expose('json')
+    @require(predicates.Any(\
+            predicates.has_permission('manage_events'),\
+            predicates.has_permission('manage')))
+    def alert_status(self):
+        '''
+        Report the alert service's latest status: delivery counts,
+        throughput and latency per channel, queue depth and the age
+        of the oldest pending alert. rateLimits says how long this
+        process's sends have waited for the providers' rate limits.
+        '''
+        status = readAlertStatus()
+        if status is None:
+            status = dict(available=False)
+        else:
+            status['available'] = True
+        status['rateLimits'] = alerts.rateLimitStats()
+        return status
+
+    @expose('json')
+    @require(predicates.Any(\
+            predicates.has_permission('manage_events'),\
+            predicates.has_permission('manage')))
+    def alert_log(self,neid=None,user_id=None,cursor=None,limit=50):
+        '''
+        Report alert delivery attempts from the alert service's log,
+        newest first: those for event neid and/or volunteer user_id,
+        or else one page of the whole log. Pass the returned cursor
+        back to get the next page.
+        '''
+        try:
+            if neid is not None:
+                neid = int(neid)
+            if user_id is not None:
+                user_id = int(user_id)
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+            result = readAlertLog(neid,user_id,cursor,min(limit,1000))
+        except ValueError as ex:
+            abort(400,'Bad alert log query: {}'.format(ex))
+        if result is None:
+            return dict(available=False)
+        result['available'] = True
+        return result
+
     #==================================
     # TG quickstart boilerplate follows.
     #==================================
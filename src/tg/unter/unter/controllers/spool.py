@@ -0,0 +1,196 @@
+'''
+Spool alerts to the alert service's staging directory.
+
+Instead of talking to Twilio or an SMTP server, the spool alerters
+write alerts as JSON files and rename them into the staging
+directory, where the alert service (src/alert_service) picks them up.
+This is steps (a) and (b) in alert_service.txt. Configure them in the
+[app:main] section of the .ini file:
+
+  sms.alerter = unter.controllers.spool.spoolSMSAlerter
+  email.alerter = unter.controllers.spool.spoolEmailAlerter
+  spool.dir = /var/spool/unter/staging
+
+Each alert is one JSON record:
+
+  {"channel": "sms", "phone": "+19155551234", "message": "...",
+   "neid": 12, "user_id": 7}
+
+  {"channel": "email", "email": "vol@example.com", "subject": "...",
+   "message": "...", "neid": 12, "user_id": 7}
+
+Records written inside alertBatch() are collected and written as a
+single file with one record per line when the batch ends, so alerting
+a few hundred volunteers costs one fsync'd file write. Outside a
+batch each record gets a file of its own. neid, user_id and any other
+fields set with alertContext() are added to each record.
+
+The priority lane of the alerts ("transactional" or "broadcast", see
+unter.controllers.dispatch) is their "lane" field, and when every
+record in a file has the same lane it is also put in the file name,
+<stamp>.<lane>.json, so the alert service can tell a broadcast from a
+cancellation without opening the file.
+
+Files are written under a dot-prefixed temporary name in the staging
+directory itself, so the rename that publishes them is atomic, and
+the alert service never sees a partly written file.
+'''
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import tg
+
+__all__ = ['alertBatch','alertContext','spoolSMSAlerter','spoolEmailAlerter',
+        'spoolDepth','getSpool']
+
+def getLogger():
+    return logging.getLogger('unter.spool')
+
+_local = threading.local()
+
+def currentContext():
+    return getattr(_local,'context',{})
+
+@contextlib.contextmanager
+def alertContext(**fields):
+    '''
+    Add fields (eg neid, user_id) to the records of alerts spooled
+    on this thread inside the with block.
+    '''
+    old = currentContext()
+    _local.context = dict(old,**fields)
+    try:
+        yield
+    finally:
+        _local.context = old
+
+@contextlib.contextmanager
+def alertBatch(**fields):
+    '''
+    Collect the records of alerts spooled on this thread inside the
+    with block and write them as one file at the end. Batches nest;
+    the outermost one writes the file. fields are added to every
+    record, as for alertContext().
+    '''
+    outer = getattr(_local,'batch',None)
+    if outer is None:
+        _local.batch = []
+    try:
+        with alertContext(**fields):
+            yield
+        if outer is None and len(_local.batch) > 0:
+            getSpool().write(_local.batch)
+    finally:
+        if outer is None:
+            _local.batch = None
+
+class Spool:
+    ''' Writes alert batch files into a staging directory. '''
+
+    def __init__(self,dname,fsync=True):
+        self.dname = dname
+        self.fsync = fsync
+        os.makedirs(dname,exist_ok=True)
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def makeName(self,lane=None):
+        '''
+        A name that sorts in creation order, in the form the alert
+        service expects (see alert_service.service.alert_svc.makeAlertName).
+        '''
+        with self.lock:
+            seq = next(self.seq)
+        suffix = '.json' if lane is None else '.{}.json'.format(lane)
+        return '{:020d}-{}-{:06d}{}'.format(time.time_ns(),os.getpid(),seq,suffix)
+
+    def write(self,records):
+        ''' Atomically publish records as one file. Return its path. '''
+        lanes = set([r.get('lane') for r in records])
+        name = self.makeName(lanes.pop() if len(lanes) == 1 else None)
+        tmp = os.path.join(self.dname,'.' + name + '.tmp')
+        path = os.path.join(self.dname,name)
+        with open(tmp,'w') as outf:
+            for record in records:
+                outf.write(json.dumps(record))
+                outf.write('\n')
+            outf.flush()
+            if self.fsync:
+                os.fsync(outf.fileno())
+        os.rename(tmp,path)
+        if self.fsync:
+            dfd = os.open(self.dname,os.O_RDONLY)
+            try:
+                os.fsync(dfd)
+            finally:
+                os.close(dfd)
+        getLogger().debug('Spooled {} alerts to {}'.format(len(records),path))
+        return path
+
+    def add(self,record):
+        ''' Spool one record, in the current batch if there is one. '''
+        record = dict(currentContext(),**record)
+        batch = getattr(_local,'batch',None)
+        if batch is not None:
+            batch.append(record)
+        else:
+            self.write([record])
+
+    def depth(self):
+        '''
+        The number of batch files waiting in the staging directory, for
+        callers that want to slow down when the alert service falls behind.
+        '''
+        count = 0
+        with os.scandir(self.dname) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and not entry.name.startswith(('.','_')):
+                    count += 1
+        return count
+
+#####################
+# The process-wide spool, created on first use from spool.dir.
+#####################
+SPOOL = None
+SPOOL_LOCK = threading.Lock()
+
+def getSpool():
+    global SPOOL
+    with SPOOL_LOCK:
+        if SPOOL is None:
+            dname = tg.config.get('spool.dir',None)
+            if dname is None:
+                raise RuntimeError('spool.dir is not set in [app:main]')
+            fsync = str(tg.config.get('spool.fsync','true')).lower() in ('true','1','yes','on')
+            SPOOL = Spool(dname,fsync)
+        return SPOOL
+
+def spoolDepth():
+    ''' The number of alert files waiting for the alert service. '''
+    return getSpool().depth()
+
+#####################
+# Alerters. These take the same arguments as the other SMS and email
+# alerters in unter.controllers.alerts. Writing a file does not
+# block on the network, so these are never handed to the dispatcher
+# queue (see unter.controllers.dispatch); they run on the caller's
+# thread, where its alertBatch() is.
+#####################
+def spoolSMSAlerter(message,sourceNumber=None,destNumber=None):
+    record = dict(channel='sms',phone=destNumber,message=message)
+    if sourceNumber is not None:
+        record['source'] = sourceNumber
+    getSpool().add(record)
+spoolSMSAlerter.queueable = False
+
+def spoolEmailAlerter(message,toAddr,fromAddr=None,subject="Volunteer alert"):
+    record = dict(channel='email',email=toAddr,subject=subject,message=message)
+    if fromAddr is not None:
+        record['from'] = fromAddr
+    getSpool().add(record)
+spoolEmailAlerter.queueable = False
@@ -0,0 +1,133 @@
+'''
+Alert response tokens.
+
+The links in an alert carry a token standing for the volunteer and
+the event being responded to. By default the token is a short random
+code of CODE_LENGTH base62 characters (about 60 bits), and the
+AlertUUID table, indexed on it, maps it back to the volunteer and
+event. The links are then short enough that a typical alert fits in
+two SMS segments rather than three (see
+unter.controllers.messages.smsSegments()); links sent earlier, with
+36-character UUIDs, still work.
+
+With a signing secret configured, the token is instead the
+volunteer's user_id, the event's neid and an expiry time, signed with
+HMAC-SHA256:
+
+    "s" + base64url(user_id, neid, expiry (unsigned 32-bit, big-endian)
+                    + the first 12 bytes of the HMAC of those)
+
+so the response handler can check the link and fetch the user and event by
+primary key, without looking the token up. The ids are encoded, not
+encrypted: someone holding a link can read them, but cannot make a
+link for another volunteer or event. Signed tokens are still recorded
+in AlertUUID, for the audit trail, but never read back from it. A
+signed link stops working when it expires, when its event or user is
+deleted, or when the secret is changed.
+
+Configure this in the [app:main] section of the .ini file:
+
+  alerts.token.secret.file = /path/secret   The file holding the
+                                            signing secret. Without
+                                            one, tokens are UUIDs.
+  alerts.token.grace = 86400                Seconds after the event
+                                            ends that its links still
+                                            work.
+  alerts.token.length = 10                  Characters in a random
+                                            code.
+
+The secret file should NEVER be committed to version control.
+'''
+import base64
+import hashlib
+import hmac
+import logging
+import secrets
+import string
+import struct
+import time
+
+from unter.controllers.util import eventEnd
+
+__all__ = ['newToken','newCode','signToken','verifyToken','isSigned','expiryFor',
+        'configureAlertTokens']
+
+def getLogger():
+    return logging.getLogger('unter.tokens')
+
+# Set from the .ini file by configureAlertTokens().
+SECRET = None
+GRACE = 86400
+CODE_LENGTH = 10
+
+BASE62 = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+SIGNED_PREFIX = 's'
+IDS = struct.Struct('>III')
+MAC_BYTES = 12
+SIGNED_LENGTH = len(SIGNED_PREFIX) + 4 * (IDS.size + MAC_BYTES) // 3
+
+def configureAlertTokens(config):
+    ''' Read the alerts.token.* options (see the module docstring). '''
+    global SECRET, GRACE, CODE_LENGTH
+    SECRET = None
+    fname = config.get('alerts.token.secret.file',None)
+    if fname is not None:
+        try:
+            with open(fname,'r') as inf:
+                SECRET = inf.read().strip().encode('utf-8')
+        except OSError as ex:
+            getLogger().error('Cannot read alert token secret {}: {}'.format(fname,ex))
+    GRACE = int(config.get('alerts.token.grace',GRACE))
+    CODE_LENGTH = int(config.get('alerts.token.length',CODE_LENGTH))
+
+def expiryFor(nev):
+    ''' When links in alerts for need event nev stop working: GRACE seconds after it ends. '''
+    return int(eventEnd(nev) + GRACE)
+
+def mac(payload):
+    return hmac.new(SECRET,payload,hashlib.sha256).digest()[:MAC_BYTES]
+
+def signToken(user_id,neid,expiry):
+    ''' A signed token for user_id and neid, good until expiry. '''
+    payload = IDS.pack(user_id,neid,expiry)
+    return SIGNED_PREFIX + base64.urlsafe_b64encode(payload + mac(payload)).decode('ascii')
+
+def isSigned(token):
+    ''' True if token is a signed token rather than a random code or UUID. '''
+    return token is not None and len(token) == SIGNED_LENGTH and token.startswith(SIGNED_PREFIX)
+
+def verifyToken(token,now=None):
+    '''
+    Check a signed token. Return (user_id,neid), or None if it is
+    malformed, forged or expired, or there is no secret to check it.
+    '''
+    if SECRET is None or not isSigned(token):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token[len(SIGNED_PREFIX):].encode('ascii'))
+    except (ValueError,UnicodeEncodeError):
+        return None
+    if len(raw) != IDS.size + MAC_BYTES:
+        return None
+    payload = raw[:IDS.size]
+    if not hmac.compare_digest(mac(payload),raw[IDS.size:]):
+        return None
+    user_id,neid,expiry = IDS.unpack(payload)
+    if now is None:
+        now = time.time()
+    if now > expiry:
+        return None
+    return user_id,neid
+
+def newCode(length=None):
+    ''' A random base62 code of length (by default CODE_LENGTH) characters. '''
+    if length is None:
+        length = CODE_LENGTH
+    return ''.join([secrets.choice(BASE62) for i in range(length)])
+
+def newToken(user_id,neid,expiry):
+    ''' A token for an alert link: signed if there is a secret, else a random code. '''
+    if SECRET is not None:
+        return signToken(user_id,neid,expiry)
+    return newCode()
@@ -10,8 +10,7 @@ def debugTest(msg):
     logging.getLogger('unter.test').debug(msg)
 
 def getEventTypes():
-    ets = model.DBSession.query(model.EventType).all()
-    return [(et.name,et.description) for et in ets]
+    return [(et.name,et.description) for et in model.EventType.all_types()]
 
 def isUserManager(user):
     perms = [p.permission_name for p in user.permissions]
@@ -21,7 +20,7 @@ def evTypeToString(evt):
     #return {0:"take people to the airport",
     #        1:"take people to the bus station",
     #        2:"interpeter services"}[evt]
-    et = model.EventType.et_by_id(evt)
+    et = model.EventType.info_by_id(evt)
     if et is not None:
         return et.description
     return '?'
@@ -36,6 +35,46 @@ def minutesPastMidnightToTimeString(mpm):
     mins = mpm % 60
     return "{}:{:02d}".format(hour,mins)
 
+# The longest a local day can be: 25 hours, when the clocks go back.
+MAX_DAY_SECONDS = 25 * 3600
+
+def eventDayStart(nev):
+    '''
+    The Unix time of local midnight on need event nev's day.
+    date_of_need may be any time on that day: the web form stores
+    noon, other code the time it was called.
+    '''
+    day = dt.date.fromtimestamp(nev.date_of_need)
+    return dt.datetime(day.year,day.month,day.day).timestamp()
+
+def eventStart(nev):
+    ''' The Unix time need event nev starts. '''
+    return eventDayStart(nev) + nev.time_of_need * 60
+
+def eventEnd(nev):
+    ''' The Unix time need event nev ends. '''
+    return eventStart(nev) + nev.duration * 60
+
+def eventStartsAfterBound(when):
+    '''
+    SQL true for every event starting after when, and for some that
+    start up to a day before: date_of_need is at or after its day's
+    midnight. Check the rows it selects with eventStart().
+    '''
+    ev = model.NeedEvent
+    return ev.date_of_need + ev.time_of_need * 60 > when
+
+def serverProcesses():
+    '''
+    How many processes serve the application: the number of uWSGI
+    workers (--processes) when running under uWSGI, otherwise 1.
+    '''
+    try:
+        import uwsgi
+    except ImportError:
+        return 1
+    return getattr(uwsgi,'numproc',1)
+
 class Thing(object):
     ''' A generic ocntainer in which to unpack form data. '''
 
@@ -55,7 +94,7 @@ def toWrappedEvent(ev,now=None):
             ev.complete = 1
     thing.date_str = "{:02d}/{:02d}/{:04d}".format(date.month,date.day,date.year)
     thing.time_str = minutesPastMidnightToTimeString(ev.time_of_need)
-    thing.ev_str = evTypeToString(ev.event_type.name)
+    thing.ev_str = evTypeToString(ev.etid)
     thing.complete = {1:'Yes',0:'No'}[ev.complete]
     thing.last_alert_time = dt.datetime.fromtimestamp(ev.last_alert_time).ctime()
     return thing
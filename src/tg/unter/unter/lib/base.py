@@ -4,10 +4,30 @@
 from tg import TGController, tmpl_context
 from tg import request
 
+from unter.lib import sqlstats
+
 
 __all__ = ['BaseController']
 
 
+def routeOf(environ):
+    """
+    The controller path and action a request was dispatched to,
+    without its arguments: /a/<token> is "/a". Requests that were
+    not dispatched to an action are all "(unrouted)".
+    """
+    try:
+        state = request.dispatch_state
+    except Exception:
+        state = None
+    action = getattr(state, 'action', None)
+    if action is None:
+        return '(unrouted)'
+    locations = [location for location, controller in state.controller_path
+                 if location not in ('', '/')]
+    return '/' + '/'.join(locations + [action.__name__])
+
+
 class BaseController(TGController):
     """
     Base class for the controllers in the application.
@@ -24,4 +44,15 @@ class BaseController(TGController):
 
         tmpl_context.identity = request.identity
 
-        return TGController.__call__(self, environ, context)
+        # Count the SQL statements each page executes, including
+        # those issued while rendering its template.
+        sqlstats.startCounting()
+        response = None
+        try:
+            response = TGController.__call__(self, environ, context)
+        finally:
+            count = sqlstats.stopCounting()
+            sqlstats.recordPage(routeOf(environ), count)
+            if hasattr(response, 'headers'):
+                response.headers['X-SQL-Statements'] = str(count)
+        return response
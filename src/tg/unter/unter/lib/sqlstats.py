@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Per-page SQL statement counts.
+
+Every statement executed by any engine is counted against the request
+being handled on the current thread. BaseController records the count
+for each page, logs it, and returns it in the X-SQL-Statements response
+header; pageStats() summarizes the counts seen so far, so an N+1 query
+regression shows up as a page whose statement count grows with its data.
+
+Pages are keyed by route (see unter.lib.base.routeOf()), not by URL, and
+at most MAX_PAGES are kept; requests for any others are counted under
+OTHER_PAGES.
+"""
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+__all__ = ['startCounting', 'stopCounting', 'currentCount', 'recordPage', 'pageStats']
+
+_local = threading.local()
+_statsLock = threading.Lock()
+_pageStats = {}
+
+# The most pages counted separately.
+MAX_PAGES = 200
+OTHER_PAGES = '(other)'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _countStatement(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'count', None) is not None:
+        _local.count += 1
+
+
+def startCounting():
+    """Start counting statements executed on this thread."""
+    _local.count = 0
+
+
+def stopCounting():
+    """Stop counting on this thread and return the count."""
+    result = currentCount()
+    _local.count = None
+    return result
+
+
+def currentCount():
+    """The number of statements executed on this thread since startCounting()."""
+    return getattr(_local, 'count', None) or 0
+
+
+def recordPage(page, count):
+    """Add one request for page that executed count statements."""
+    with _statsLock:
+        if page not in _pageStats and len(_pageStats) >= MAX_PAGES:
+            page = OTHER_PAGES
+        stats = _pageStats.setdefault(page, dict(requests=0, statements=0, max=0, last=0))
+        stats['requests'] += 1
+        stats['statements'] += count
+        stats['max'] = max(stats['max'], count)
+        stats['last'] = count
+    logging.getLogger('unter.sqlstats').debug('{} executed {} SQL statements'.format(page, count))
+
+
+def pageStats():
+    """Get a copy of the per-page statement counts."""
+    with _statsLock:
+        return dict([(page, dict(stats)) for page, stats in _pageStats.items()])
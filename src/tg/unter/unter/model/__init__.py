@@ -60,7 +60,9 @@ def init_model(engine):
 # Import your model modules here.
 from unter.model.auth import User, Group, Permission
 
-from unter.model.app_model import EventType, VolunteerAvailability, NeedEvent, VolunteerResponse, VolunteerDecommitment, AlertUUID, PasswordUUID
+from unter.model.app_model import EventType, VolunteerAvailability, NeedEvent, VolunteerResponse, VolunteerDecommitment, AlertUUID, PasswordUUID, \
+        NeedEventArchive, VolunteerResponseArchive
 
 __all__ = ('User', 'Group', 'Permission', 'VolunteerAvailability', 'NeedEvent', 'VolunteerResponse',
-        'VolunteerDecommitment','AlertUUID','PasswordUUID','EventType')
+        'VolunteerDecommitment','AlertUUID','PasswordUUID','EventType','NeedEventArchive',
+        'VolunteerResponseArchive')
@@ -3,12 +3,16 @@
 from sqlalchemy import *
 from sqlalchemy import Table, ForeignKey, Column
 from sqlalchemy.types import Integer, Unicode, DateTime, LargeBinary
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy import event
+from collections import namedtuple
+import threading
+import time
 
 from unter.model import DeclarativeBase, metadata, DBSession
 
 __all__ = ['EventType','VolunteerAvailability','NeedEvent','VolunteerResponse','VolunteerDecommitment',
-        'AlertUUID','PasswordUUID']
+        'AlertUUID','PasswordUUID','NeedEventArchive','VolunteerResponseArchive']
 
 class VolunteerAvailability(DeclarativeBase):
     __tablename__ = 'volunteer_availability'
@@ -46,15 +50,106 @@ class EventType(DeclarativeBase):
     name = Column(Unicode(128),nullable=False,default='NO NAME')
     description = Column(Unicode(2048),nullable=False,default='')
 
+    # Names and descriptions are served from EVENT_TYPE_REGISTRY
+    # (below). et_by_id() and et_by_name() return mapped instances,
+    # but consult the registry first, so unknown types cost no SQL
+    # and known ones are a primary-key get() that the session's
+    # identity map usually answers without a query.
     @staticmethod
     def et_by_id(etid):
-        et = DBSession.query(EventType).filter_by(etid=etid).first()
-        return et
+        info = EVENT_TYPE_REGISTRY.by_id(etid)
+        if info is None:
+            return None
+        return DBSession.query(EventType).get(info.etid)
 
     @staticmethod
     def et_by_name(name):
-        et = DBSession.query(EventType).filter_by(name=name).first()
-        return et
+        info = EVENT_TYPE_REGISTRY.by_name(name)
+        if info is None:
+            return None
+        return DBSession.query(EventType).get(info.etid)
+
+    @staticmethod
+    def info_by_id(etid):
+        ''' A read-only EventTypeInfo for etid, or None. Never issues SQL once loaded. '''
+        return EVENT_TYPE_REGISTRY.by_id(etid)
+
+    @staticmethod
+    def all_types():
+        ''' Read-only EventTypeInfo for all event types, ordered by etid. '''
+        return EVENT_TYPE_REGISTRY.all()
+
+    @staticmethod
+    def invalidate_cache():
+        EVENT_TYPE_REGISTRY.invalidate()
+
+EventTypeInfo = namedtuple('EventTypeInfo',['etid','name','description'])
+
+class EventTypeRegistry(object):
+    '''
+    A process-wide, read-only copy of the event_type table. It is
+    loaded on first use and discarded whenever an EventType row is
+    inserted, updated or deleted through the ORM in this process
+    (add_event_type_post, the admin controller), and again when
+    that transaction commits or rolls back. It also expires after
+    MAX_AGE seconds, to pick up changes made by other processes.
+    '''
+    MAX_AGE = 600
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.types = None
+        self.loadTime = 0
+
+    def snapshot(self):
+        with self.lock:
+            if self.types is None or time.time() - self.loadTime > self.MAX_AGE:
+                rows = DBSession.query(EventType.etid,EventType.name,EventType.description).\
+                        order_by(EventType.etid).all()
+                types = [EventTypeInfo(*row) for row in rows]
+                self.byId = dict([(et.etid,et) for et in types])
+                self.byName = {}
+                for et in types:
+                    self.byName.setdefault(et.name,et)
+                self.types = types
+                self.loadTime = time.time()
+            return self.types,self.byId,self.byName
+
+    def all(self):
+        return list(self.snapshot()[0])
+
+    def by_id(self,etid):
+        try:
+            etid = int(etid)
+        except (TypeError,ValueError):
+            return None
+        return self.snapshot()[1].get(etid)
+
+    def by_name(self,name):
+        return self.snapshot()[2].get(name)
+
+    def invalidate(self):
+        with self.lock:
+            self.types = None
+
+EVENT_TYPE_REGISTRY = EventTypeRegistry()
+
+EVENT_TYPE_CHANGED = 'unter.event_type.changed'
+
+@event.listens_for(EventType,'after_insert')
+@event.listens_for(EventType,'after_update')
+@event.listens_for(EventType,'after_delete')
+def eventTypeChanged(mapper,connection,target):
+    EVENT_TYPE_REGISTRY.invalidate()
+    session = object_session(target)
+    if session is not None:
+        session.info[EVENT_TYPE_CHANGED] = True
+
+@event.listens_for(DBSession,'after_commit')
+@event.listens_for(DBSession,'after_rollback')
+def eventTypeTransactionEnded(session):
+    if session.info.pop(EVENT_TYPE_CHANGED,False):
+        EVENT_TYPE_REGISTRY.invalidate()
 
 class NeedEvent(DeclarativeBase):
     '''
@@ -212,4 +307,35 @@ class PasswordUUID(DeclarativeBase):
 
     create_time = Column(Integer,nullable=False)
 
+class NeedEventArchive(DeclarativeBase):
+    '''
+    A finished NeedEvent moved out of need_event by the retention
+    job (see unter.controllers.retention), so the live table stays
+    small. The columns are need_event's, without foreign keys, since
+    the creating user may later be deleted.
+    '''
+    __tablename__ = "need_event_archive"
+
+    neid = Column(Integer,primary_key=True,autoincrement=False)
+    etid = Column(Integer,nullable=False)
+    date_of_need = Column(Integer,nullable=False,index=True)
+    time_of_need = Column(Integer,nullable=False)
+    duration = Column(Integer,nullable=False)
+    volunteer_count = Column(Integer,nullable=False)
+    affected_persons = Column(Integer,nullable=False)
+    location = Column(Unicode(255),nullable=False)
+    notes = Column(Unicode(2048),nullable=False)
+    cancelled = Column(Integer,nullable=False)
+    complete = Column(Integer,nullable=False)
+    last_alert_time = Column(Integer,nullable=False)
+    created_by_id = Column(Integer,nullable=False)
+
+class VolunteerResponseArchive(DeclarativeBase):
+    '''
+    A VolunteerResponse for an archived event: who served it.
+    '''
+    __tablename__ = "volunteer_response_archive"
 
+    vrid = Column(Integer,primary_key=True,autoincrement=False)
+    user_id = Column(Integer,nullable=False,index=True)
+    neid = Column(Integer,nullable=False,index=True)
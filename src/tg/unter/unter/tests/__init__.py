@@ -45,6 +45,7 @@ def teardown_db():
 
 # Alerter stub that captures alert information for tests.
 import unter.controllers.alerts as alerts
+import unter.controllers.availability as availability
 TEST_ALERT_OUTPUT = StringIO()
 
 def setupSMSStub():
@@ -94,6 +95,10 @@ class TestController(object):
         setupSMSStub()
         setupEmailStub()
 
+        # Each test starts with a fresh DB, so discard cached state.
+        availability.invalidate()
+        model.EventType.invalidate_cache()
+
     def tearDown(self):
         """Tear down test fixture for each functional test method."""
         model.DBSession.remove()
@@ -0,0 +1,185 @@
+'''
+Test asynchronous alert dispatch: queued alerts return at once,
+are delivered by the workers with bounded per-channel concurrency,
+and are all delivered when the dispatcher drains.
+'''
+import transaction
+import logging
+import os
+import sys
+import threading
+import time
+
+import unter.controllers.dispatch as dispatch
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+# The alert service lives beside the web service, in src/.
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),*(['..'] * 5)))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
+
+import alert_service.service.lanes as serviceLanes
+
+class SlowAlerter:
+    ''' An alerter that takes a while and records its peak concurrency. '''
+
+    def __init__(self,delay=0.05):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.messages = []
+
+    def __call__(self,message,*args,**kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak,self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            self.messages.append(message)
+
+class TestAlertDispatch(TestController):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            self.createAvailabilities()
+            self.createEvents()
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestAlertDispatch: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+
+    def tearDown(self):
+        dispatch.setDispatcher(None)
+        super().tearDown()
+
+    def test_0_submitDoesNotBlock(self):
+        ''' Queued alerts return immediately and are delivered on drain. '''
+        slow = SlowAlerter()
+        d = dispatch.AlertDispatcher(workers={'sms':2},queueSize=100)
+        start = time.time()
+        for i in range(10):
+            d.submit('sms',slow,'msg {}'.format(i))
+        ok_(time.time() - start < slow.delay,'submit blocked')
+        d.drain()
+        eq_(10,len(slow.messages))
+        eq_(10,d.delivered)
+        ok_(slow.peak <= 2,'peak concurrency {}'.format(slow.peak))
+
+    def test_1_failuresAreContained(self):
+        ''' An alerter that raises does not kill its worker, and one returning False has failed. '''
+        def broken(message):
+            raise RuntimeError('no service')
+        slow = SlowAlerter(delay=0)
+        d = dispatch.AlertDispatcher(workers={'email':1})
+        d.submit('email',broken,'a')
+        d.submit('email',slow,'b')
+        d.submit('email',lambda message: False,'c')
+        d.drain()
+        eq_(2,d.failed)
+        eq_(1,d.delivered)
+        eq_(['b'],slow.messages)
+
+    def test_2_fullQueueDeliversInline(self):
+        ''' When the queue stays full, the alert is delivered by the caller. '''
+        gate = threading.Event()
+        def blocked(message):
+            gate.wait()
+        slow = SlowAlerter(delay=0)
+        d = dispatch.AlertDispatcher(workers={'sms':1},queueSize=1,queueTimeout=0.01)
+        d.submit('sms',blocked,'occupies the worker')
+        time.sleep(0.05)
+        d.submit('sms',slow,'fills the queue')
+        d.submit('sms',slow,'overflows')
+        eq_(['overflows'],slow.messages)
+        gate.set()
+        d.drain()
+        eq_(['overflows','fills the queue'],slow.messages)
+
+    def test_3_checkNeedEventsQueuesAlerts(self):
+        ''' With a dispatcher installed, alerts from a page are queued and later delivered. '''
+        d = dispatch.AlertDispatcher(workers={'sms':2,'email':2})
+        dispatch.setDispatcher(d)
+        env = {'REMOTE_USER':'carla'}
+        self.app.get('/check_need_events',extra_environ=env,status=200)
+        d.join()
+        alertLog = self.getAlertLog()
+        ok_('Veronica or Velma airport location' in alertLog,alertLog)
+        ok_(d.delivered > 0)
+        eq_(0,d.failed)
+
+    def test_4_transactionalAheadOfBroadcast(self):
+        ''' A cancellation queued behind a large broadcast is delivered promptly. '''
+        from unter.controllers.spool import alertContext
+        slow = SlowAlerter(delay=0.01)
+        d = dispatch.AlertDispatcher(workers={'sms':2})
+        with alertContext(lane=dispatch.BROADCAST):
+            for i in range(200):
+                d.submit('sms',slow,'broadcast {}'.format(i))
+        with alertContext(lane=dispatch.TRANSACTIONAL):
+            d.submit('sms',slow,'cancelled')
+        d.drain()
+        eq_(201,len(slow.messages))
+        ok_(slow.messages.index('cancelled') < 10,slow.messages.index('cancelled'))
+        ok_(d.maxWait[dispatch.TRANSACTIONAL] < 0.5,d.maxWait)
+
+    def test_5_broadcastCannotTakeEveryWorker(self):
+        ''' Broadcasts leave a worker free for transactional alerts. '''
+        from unter.controllers.spool import alertContext
+        gate = threading.Event()
+        def blocked(message):
+            gate.wait()
+        slow = SlowAlerter(delay=0)
+        d = dispatch.AlertDispatcher(workers={'sms':2})
+        try:
+            with alertContext(lane=dispatch.BROADCAST):
+                for i in range(5):
+                    d.submit('sms',blocked,'broadcast {}'.format(i))
+            d.submit('sms',slow,'confirmed')
+            ok_(self.waitFor(lambda: slow.messages == ['confirmed']),slow.messages)
+            eq_(4,d.depth('sms',dispatch.BROADCAST))
+        finally:
+            gate.set()
+            d.drain()
+
+    def waitFor(self,condition,timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline and not condition():
+            time.sleep(0.01)
+        return condition()
+
+class TestSameAsAlertService:
+    '''
+    The alert service (src/alert_service) has its own LaneQueue; check
+    the two still serve lanes in the same order.
+    '''
+
+    def test_0_laneOrder(self):
+        weights = {dispatch.TRANSACTIONAL:3,dispatch.BROADCAST:1}
+        limits = {dispatch.BROADCAST:2}
+        ours = dispatch.LaneQueue(weights=weights,limits=limits)
+        theirs = serviceLanes.LaneQueue(weights,limits)
+        for i in range(20):
+            lane = dispatch.BROADCAST if i % 3 else dispatch.TRANSACTIONAL
+            ours.put(i,lane=lane)
+            theirs.put(lane,i)
+        held = []
+        for i in range(20):
+            got = ours.get()
+            eq_(got,theirs.get())
+            held.append(got[0])
+            # Finish every other item, so the broadcast limit applies.
+            if i % 2 == 1:
+                for lane in held:
+                    ours.task_done(lane)
+                    theirs.done(lane)
+                held = []
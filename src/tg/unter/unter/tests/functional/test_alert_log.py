@@ -0,0 +1,77 @@
+'''
+Test /alert_log, which pages and searches the alert service's
+activity log.
+'''
+import os
+import shutil
+import sys
+import tempfile
+
+import unter.controllers.alert_log as alert_log
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+# The alert service lives beside the web service, in src/.
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),*(['..'] * 5)))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
+
+from alert_service.service.alertlog import AlertLog
+
+class TestAlertLog(TestController):
+
+    def setUp(self):
+        super().setUp()
+        self.logDir = tempfile.mkdtemp(prefix='unter_alert_log_')
+        log = AlertLog(self.logDir,maxBytes=2000)
+        for n in range(60):
+            log.write(dict(ts=1000.0 + n,neid=n % 6,user_id=n % 5,channel='sms',ok=n != 7,n=n))
+        log.close()
+        alert_log.LOG_DIR = self.logDir
+        self.env = {'REMOTE_USER':'manager'}
+
+    def tearDown(self):
+        alert_log.LOG_DIR = None
+        shutil.rmtree(self.logDir)
+        super().tearDown()
+
+    def test_0_unavailable(self):
+        ''' With no log configured, the log is reported unavailable. '''
+        alert_log.LOG_DIR = None
+        resp = self.app.get('/alert_log',extra_environ=self.env,status=200)
+        eq_(False,resp.json['available'])
+
+    def test_1_paging(self):
+        ''' The log is paged newest first, following the cursor. '''
+        seen = []
+        params = dict(limit=25)
+        while True:
+            resp = self.app.get('/alert_log',params=params,extra_environ=self.env,status=200)
+            ok_(resp.json['available'])
+            seen.extend([r['n'] for r in resp.json['records']])
+            if resp.json['cursor'] is None:
+                break
+            params['cursor'] = resp.json['cursor']
+        eq_(list(range(59,-1,-1)),seen)
+
+    def test_2_didVolunteerGetAlert(self):
+        ''' Attempts are found by event and volunteer. '''
+        resp = self.app.get('/alert_log',params=dict(neid=1,user_id=2),
+                extra_environ=self.env,status=200)
+        eq_([37,7],[r['n'] for r in resp.json['records']])
+        eq_([True,False],[r['ok'] for r in resp.json['records']])
+
+    def test_3_volunteersRefused(self):
+        ''' Volunteers cannot read the alert log. '''
+        self.createVolunteers()
+        import transaction
+        transaction.commit()
+        self.app.get('/alert_log',extra_environ={'REMOTE_USER':'veronica'},status=403)
+
+    def test_4_badQueries(self):
+        ''' Malformed limits, cursors and ids are refused with 400. '''
+        for params in (dict(limit='many'),dict(limit=0),dict(cursor='garbage'),
+                dict(cursor='alerts-1-2:x'),dict(neid='one')):
+            self.app.get('/alert_log',params=params,extra_environ=self.env,status=400)
@@ -0,0 +1,105 @@
+'''
+Test the spool alerters: a sendAlerts() fan-out is written to the
+staging directory as one batch file, one record per alert, and
+single alerts get a file each.
+'''
+import json
+import os
+import shutil
+import tempfile
+import transaction
+import logging
+
+import unter.model as model
+import unter.controllers.alerts as alerts
+import unter.controllers.spool as spool
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class TestAlertSpool(TestController):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            self.createAvailabilities()
+            self.createEvents()
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestAlertSpool: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+        self.spoolDir = tempfile.mkdtemp(prefix='unter_spool_')
+        spool.SPOOL = spool.Spool(self.spoolDir)
+        alerts.setSMSAlerter(spool.spoolSMSAlerter)
+        alerts.setEmailAlerter(spool.spoolEmailAlerter)
+
+    def tearDown(self):
+        transaction.abort()
+        spool.SPOOL = None
+        shutil.rmtree(self.spoolDir)
+        super().tearDown()
+
+    def spooledFiles(self):
+        return sorted([n for n in os.listdir(self.spoolDir) if n.endswith('.json')])
+
+    def readRecords(self,name):
+        with open(os.path.join(self.spoolDir,name)) as inf:
+            return [json.loads(line) for line in inf]
+
+    def test_0_fanOutIsOneBatch(self):
+        ''' All the alerts for one event go into a single batch file. '''
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Veronica or Velma airport').first()
+        vols = [self.getUser(model.DBSession,name) for name in ('veronica','velma')]
+        alerts.sendAlerts(vols,nev,honorLastAlertTime=False)
+        files = self.spooledFiles()
+        eq_(1,len(files),files)
+        ok_(files[0].endswith('.broadcast.json'),files)
+        records = self.readRecords(files[0])
+        eq_(['broadcast'],list(set([r['lane'] for r in records])))
+        eq_(set([v.user_id for v in vols]),set([r['user_id'] for r in records]))
+        for r in records:
+            eq_(nev.neid,r['neid'])
+            ok_(r['channel'] in ('sms','email'),r)
+            ok_(nev.location in r['message'],r)
+        emails = [r for r in records if r['channel'] == 'email']
+        eq_(2,len(emails))
+        eq_(set([v.email_address for v in vols]),set([r['email'] for r in emails]))
+        eq_(1,spool.spoolDepth())
+
+    def test_1_singleAlertsGetAFileEach(self):
+        ''' Confirmations written outside a batch each get their own file. '''
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Veronica or Velma airport').first()
+        vol = self.getUser(model.DBSession,'veronica')
+        alerts.sendConfirmationAlert(vol,nev)
+        alerts.sendConfirmationAlert(vol,nev)
+        files = self.spooledFiles()
+        eq_(2,len(files))
+        records = self.readRecords(files[0])
+        eq_([vol.user_id] * len(records),[r['user_id'] for r in records])
+        eq_(2,spool.spoolDepth())
+
+    def test_2_noPartialFiles(self):
+        ''' Nothing but complete batch files is left in the spool. '''
+        env = {'REMOTE_USER':'carla'}
+        self.app.get('/check_need_events',extra_environ=env,status=200)
+        names = os.listdir(self.spoolDir)
+        ok_(len(names) > 0)
+        for name in names:
+            ok_(name.endswith('.json') and not name.startswith('.'),name)
+            for r in self.readRecords(name):
+                ok_('neid' in r and 'user_id' in r,r)
+
+    def test_3_notQueued(self):
+        ''' Spool alerters run on the caller's thread even when dispatch is asynchronous. '''
+        import unter.controllers.dispatch as dispatch
+        dispatch.setDispatcher(dispatch.AlertDispatcher(workers={'sms':1,'email':1}))
+        try:
+            ok_(alerts.getSMSAlerter() is spool.spoolSMSAlerter)
+            ok_(alerts.getEmailAlerter() is spool.spoolEmailAlerter)
+        finally:
+            dispatch.setDispatcher(None)
@@ -0,0 +1,73 @@
+'''
+Test /alert_status, which reports the alert service's status from
+its shared memory segment or its status file.
+'''
+import json
+import os
+import struct
+import tempfile
+import uuid
+from multiprocessing import shared_memory
+
+import unter.controllers.alert_status as alert_status
+
+from unter.tests import TestController
+
+from nose.tools import eq_
+
+class TestAlertStatus(TestController):
+
+    def setUp(self):
+        super().setUp()
+        alert_status.STATUS_SHM = None
+        alert_status.STATUS_FILE = None
+        self.env = {'REMOTE_USER':'manager'}
+
+    def tearDown(self):
+        alert_status.STATUS_SHM = None
+        alert_status.STATUS_FILE = None
+        super().tearDown()
+
+    def test_0_unavailable(self):
+        ''' With nothing configured, the status is reported unavailable. '''
+        resp = self.app.get('/alert_status',extra_environ=self.env,status=200)
+        eq_(False,resp.json['available'])
+
+    def test_1_fromFile(self):
+        ''' The status file is read when there is no segment. '''
+        with tempfile.NamedTemporaryFile('w',suffix='.json',delete=False) as outf:
+            json.dump(dict(successfulAlertCount=12,failedAlertCount=1,queueDepth=3),outf)
+        try:
+            alert_status.STATUS_FILE = outf.name
+            alert_status.STATUS_SHM = 'unter_test_missing_{}'.format(uuid.uuid4().hex[:8])
+            resp = self.app.get('/alert_status',extra_environ=self.env,status=200)
+            eq_(12,resp.json['successfulAlertCount'])
+            eq_('file',resp.json['source'])
+        finally:
+            os.unlink(outf.name)
+
+    def test_2_fromSharedMemory(self):
+        ''' A snapshot in shared memory is preferred to the file. '''
+        name = 'unter_test_{}'.format(uuid.uuid4().hex[:8])
+        data = json.dumps(dict(successfulAlertCount=40,failedAlertCount=0,
+            channels=dict(sms=dict(sent=40,latency=dict(p99=0.5))))).encode('utf-8')
+        header = struct.Struct('<QI')
+        shm = shared_memory.SharedMemory(name=name,create=True,size=4096)
+        try:
+            header.pack_into(shm.buf,0,2,len(data))
+            shm.buf[header.size:header.size+len(data)] = data
+            alert_status.STATUS_SHM = name
+            resp = self.app.get('/alert_status',extra_environ=self.env,status=200)
+            eq_(40,resp.json['successfulAlertCount'])
+            eq_('shm',resp.json['source'])
+            eq_(0.5,resp.json['channels']['sms']['latency']['p99'])
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_3_volunteersRefused(self):
+        ''' Volunteers cannot read the alert status. '''
+        self.createVolunteers()
+        import transaction
+        transaction.commit()
+        self.app.get('/alert_status',extra_environ={'REMOTE_USER':'veronica'},status=403)
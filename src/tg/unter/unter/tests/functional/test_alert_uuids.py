@@ -32,6 +32,8 @@ import logging
 import unter.model as model
 import unter.controllers.alerts as alerts
 import unter.controllers.need as need
+import unter.controllers.tokens as tokens
+from unter.lib import sqlstats
 
 class TestAlertUUIDs(TestController):
     '''
@@ -56,6 +58,11 @@ class TestAlertUUIDs(TestController):
         # Avoid creating UUIDs for emails.
         alerts.EMAIL_ENABLED = False
 
+    def tearDown(self):
+        tokens.SECRET = None
+        alerts.EMAIL_ENABLED = True
+        super().tearDown()
+
     def createAvailabilities(self):
         ''' Simplified vs super: only one availability for Veronica. '''
         self.createAvailability(user=self.getUser(model.DBSession,'veronica'),
@@ -138,7 +145,7 @@ class TestAlertUUIDs(TestController):
            transaction.commit()
         alerts = self.getAlertLog()
         auuid = model.DBSession.query(model.AlertUUID).first()
-        ok_('uuid={}'.format(auuid.uuid) in alerts,"Missing UUID in alert log")
+        ok_('/a/{}'.format(auuid.uuid) in alerts,"Missing UUID in alert log")
         ok_('user_id' not in alerts,"User ID should not be present in alert log.")
         ok_('neid' not in alerts,"Event ID should not be present in alert log.")
 
@@ -157,11 +164,11 @@ class TestAlertUUIDs(TestController):
         eq_(len(vresps),0,"VolunteerResponse objects exist.")
 
         alerts = self.getAlertLog()
-        m = re.search('to commit: (http(s?)://.+&action=accept)',alerts)
+        m = re.search('to commit: (http(s?)://[^ ]+/a/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         acceptLink = m.groups()[0]
         eq_(acceptLink[:4],'http',acceptLink)
-        eq_(acceptLink[-14:],"&action=accept",acceptLink)
+        eq_(acceptLink.split('/')[-2],'a',acceptLink)
 
         resp = self.app.get(acceptLink,status=200)
 
@@ -184,11 +191,11 @@ class TestAlertUUIDs(TestController):
         eq_(len(vresps),0,"VolunteerDecommitment objects exist.")
 
         alerts = self.getAlertLog()
-        m = re.search('to ignore: (http(s?)://.+&action=refuse)',alerts)
+        m = re.search('to ignore: (http(s?)://[^ ]+/r/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         decommitLink = m.groups()[0]
         eq_(decommitLink[:4],'http',decommitLink)
-        eq_(decommitLink[-14:],"&action=refuse",decommitLink)
+        eq_(decommitLink.split('/')[-2],'r',decommitLink)
 
         resp = self.app.get(decommitLink,status=200)
 
@@ -211,11 +218,11 @@ class TestAlertUUIDs(TestController):
         eq_(len(vresps),0,"VolunteerResponse objects exist.")
 
         alerts = self.getAlertLog()
-        m = re.search('to commit: (http(s?)://.+&action=accept)',alerts)
+        m = re.search('to commit: (http(s?)://[^ ]+/a/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         acceptLink = m.groups()[0]
         eq_(acceptLink[:4],'http',acceptLink)
-        eq_(acceptLink[-14:],"&action=accept",acceptLink)
+        eq_(acceptLink.split('/')[-2],'a',acceptLink)
 
         resp = self.app.get(acceptLink,status=200)
 
@@ -244,11 +251,11 @@ class TestAlertUUIDs(TestController):
         eq_(len(vresps),0,"VolunteerDecommitment objects exist.")
 
         alerts = self.getAlertLog()
-        m = re.search('to ignore: (http(s?)://.+&action=refuse)',alerts)
+        m = re.search('to ignore: (http(s?)://[^ ]+/r/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         decommitLink = m.groups()[0]
         eq_(decommitLink[:4],'http',decommitLink)
-        eq_(decommitLink[-14:],"&action=refuse",decommitLink)
+        eq_(decommitLink.split('/')[-2],'r',decommitLink)
 
         resp = self.app.get(decommitLink,status=200)
 
@@ -279,17 +286,17 @@ class TestAlertUUIDs(TestController):
         alerts = self.getAlertLog()
 
         # Get the links.
-        m = re.search('to ignore: (http(s?)://.+&action=refuse)',alerts)
+        m = re.search('to ignore: (http(s?)://[^ ]+/r/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         decommitLink = m.groups()[0]
         eq_(decommitLink[:4],'http',decommitLink)
-        eq_(decommitLink[-14:],"&action=refuse",decommitLink)
+        eq_(decommitLink.split('/')[-2],'r',decommitLink)
 
-        m = re.search('to commit: (http(s?)://.+&action=accept)',alerts)
+        m = re.search('to commit: (http(s?)://[^ ]+/a/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         acceptLink = m.groups()[0]
         eq_(acceptLink[:4],'http',acceptLink)
-        eq_(acceptLink[-14:],"&action=accept",acceptLink)
+        eq_(acceptLink.split('/')[-2],'a',acceptLink)
 
         # Accept the event.
         resp = self.app.get(acceptLink,status=200)
@@ -326,17 +333,17 @@ class TestAlertUUIDs(TestController):
         alerts = self.getAlertLog()
 
         # Get the links.
-        m = re.search('to ignore: (http(s?)://.+&action=refuse)',alerts)
+        m = re.search('to ignore: (http(s?)://[^ ]+/r/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         decommitLink = m.groups()[0]
         eq_(decommitLink[:4],'http',decommitLink)
-        eq_(decommitLink[-14:],"&action=refuse",decommitLink)
+        eq_(decommitLink.split('/')[-2],'r',decommitLink)
 
-        m = re.search('to commit: (http(s?)://.+&action=accept)',alerts)
+        m = re.search('to commit: (http(s?)://[^ ]+/a/[\\w=-]+)',alerts)
         ok_(m is not None,"No commit link in alert:\n{}".format(alerts))
         acceptLink = m.groups()[0]
         eq_(acceptLink[:4],'http',acceptLink)
-        eq_(acceptLink[-14:],"&action=accept",acceptLink)
+        eq_(acceptLink.split('/')[-2],'a',acceptLink)
 
         # Decommit from the event.
         resp = self.app.get(decommitLink,status=200)
@@ -356,3 +363,87 @@ class TestAlertUUIDs(TestController):
         vresps = model.DBSession.query(model.VolunteerDecommitment).all()
         eq_(len(vresps),0,"VolunteerDecommitment objects exist.")
 
+
+    def getLink(self,action):
+        m = re.search('(http(s?)://[^ ]+/{}/[\\w=-]+)'.format(action[0]),self.getAlertLog())
+        ok_(m is not None,"No {} link in alert:\n{}".format(action,self.getAlertLog()))
+        return m.groups()[0]
+
+    def test_9_oneTokenPerVolunteer(self):
+        ''' A volunteer alerted by SMS and email gets one token, used in both. '''
+        alerts.EMAIL_ENABLED = True
+        try:
+            self.sendAlert()
+        except:
+            transaction.abort()
+            self.logAbortMessage('test_9_oneTokenPerVolunteer')
+        else:
+            transaction.commit()
+        auuids = model.DBSession.query(model.AlertUUID).all()
+        eq_(1,len(auuids))
+        link = '/a/{}'.format(auuids[0].uuid)
+        ok_(link in self.getAlertLog(),self.getAlertLog())
+        ok_(link in self.getEmailLog(),self.getEmailLog())
+
+    def test_10_tokensInsertedTogether(self):
+        ''' Tokens for a whole fan-out are inserted with one statement. '''
+        try:
+            ev = model.DBSession.query(model.NeedEvent).filter_by(neid=self.ev.neid).first()
+            vols = model.DBSession.query(model.User).all()
+            ok_(len(vols) > 3)
+            model.DBSession.flush()
+            sqlstats.startCounting()
+            tokenFor = alerts.makeUUIDsForAlerts(ev,vols)
+            eq_(1,sqlstats.stopCounting())
+            eq_(len(vols),len(set(tokenFor.values())))
+            eq_(len(vols),model.DBSession.query(model.AlertUUID).count())
+        finally:
+            sqlstats.stopCounting()
+            transaction.abort()
+
+    def test_11_signedTokens(self):
+        ''' With a secret, links carry signed tokens that work without the token table. '''
+        tokens.SECRET = b'test secret'
+        try:
+            self.sendAlert()
+        except:
+            transaction.abort()
+            self.logAbortMessage('test_11_signedTokens')
+        else:
+            transaction.commit()
+        acceptLink = self.getLink('accept')
+        token = acceptLink.split('/')[-1]
+        ok_(tokens.isSigned(token),token)
+        user = self.getUser(model.DBSession,'veronica')
+        eq_((user.user_id,self.ev.neid),tokens.verifyToken(token))
+        # Audit rows are still written, but never read.
+        model.DBSession.query(model.AlertUUID).delete()
+        transaction.commit()
+        self.app.get(acceptLink,status=200)
+        eq_(1,model.DBSession.query(model.VolunteerResponse).count())
+
+    def test_12_badSignedTokensRejected(self):
+        ''' Forged, tampered and expired signed tokens do nothing. '''
+        tokens.SECRET = b'test secret'
+        user = self.getUser(model.DBSession,'veronica')
+        expiry = int(dt.datetime.now().timestamp()) + 3600
+        good = tokens.signToken(user.user_id,self.ev.neid,expiry)
+        eq_((user.user_id,self.ev.neid),tokens.verifyToken(good))
+        forged = tokens.signToken(user.user_id + 1,self.ev.neid,expiry)[:17] + good[17:]
+        eq_(None,tokens.verifyToken(forged))
+        eq_(None,tokens.verifyToken(good,now=expiry + 1))
+        eq_(None,tokens.verifyToken('s!!not base64'))
+        tokens.SECRET = b'another secret'
+        eq_(None,tokens.verifyToken(good))
+        self.app.get('/sms_response?uuid={}&action=accept'.format(forged),status=200)
+        eq_(0,model.DBSession.query(model.VolunteerResponse).count())
+
+    def test_13_tokensLastUntilAfterTheEvent(self):
+        ''' Signed links work until GRACE seconds after the event ends, whatever time of day date_of_need holds. '''
+        ev = model.NeedEvent(date_of_need=int(dt.datetime(2030,5,6,12,0).timestamp()),
+                time_of_need=10*60,duration=120)
+        end = dt.datetime(2030,5,6,12,0).timestamp()
+        eq_(end,tokens.eventEnd(ev))
+        eq_(int(end) + tokens.GRACE,tokens.expiryFor(ev))
+        ev.date_of_need = int(dt.datetime(2030,5,6,23,59).timestamp())
+        eq_(int(end) + tokens.GRACE,tokens.expiryFor(ev))
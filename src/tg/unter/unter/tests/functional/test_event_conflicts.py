@@ -0,0 +1,58 @@
+'''
+Test that EventIntervalIndex finds exactly the conflicts that
+pairwise overlappingEvents() comparisons find.
+'''
+import random
+import datetime as dt
+
+import unter.controllers.need as need
+from unter.controllers.util import Thing
+
+from nose.tools import ok_, eq_
+
+def makeEvent(neid,day,time_of_need,duration):
+    ev = Thing()
+    ev.neid = neid
+    ev.date_of_need = int(dt.datetime(2019,3,day,12).timestamp())
+    ev.time_of_need = time_of_need
+    ev.duration = duration
+    return ev
+
+def pairwiseOverlaps(ev1,ev2):
+    ''' The original pairwise definition of overlapping events. '''
+    d1 = dt.datetime.fromtimestamp(ev1.date_of_need)
+    d2 = dt.datetime.fromtimestamp(ev2.date_of_need)
+    if (d1.year,d1.month,d1.day) != (d2.year,d2.month,d2.day):
+        return False
+    s1,e1 = ev1.time_of_need,ev1.time_of_need+ev1.duration
+    s2,e2 = ev2.time_of_need,ev2.time_of_need+ev2.duration
+    return (s2 <= s1 <= e2) or (s2 <= e1 <= e2) or (s1 <= s2 <= e1) or (s1 <= e2 <= e1)
+
+class TestEventConflicts:
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.evs = [makeEvent(i,rand.randint(1,4),rand.randint(0,23*60),rand.randint(0,180))
+                for i in range(300)]
+
+    def test_0_conflictsMatchPairwise(self):
+        ''' The index reports the same conflicts as pairwise comparison. '''
+        index = need.EventIntervalIndex(self.evs)
+        for ev in self.evs:
+            expected = sorted([ev2.neid for ev2 in self.evs if pairwiseOverlaps(ev,ev2)])
+            found = sorted([ev2.neid for ev2 in index.conflicts(ev)])
+            eq_(expected,found,'Event {}'.format(ev.neid))
+            eq_(len(expected) > 0,index.conflictsAny(ev))
+
+    def test_1_touchingEventsConflict(self):
+        ''' Events that share an end point conflict; events on different days do not. '''
+        index = need.EventIntervalIndex([makeEvent(1,5,10*60,60)])
+        ok_(index.conflictsAny(makeEvent(2,5,11*60,30)))
+        ok_(not index.conflictsAny(makeEvent(3,5,11*60+1,30)))
+        ok_(not index.conflictsAny(makeEvent(4,6,10*60,60)))
+
+    def test_2_overlapsAny(self):
+        ''' overlapsAny() agrees with pairwise comparison. '''
+        for ev in self.evs[:30]:
+            eq_(any([pairwiseOverlaps(ev,ev2) for ev2 in self.evs[30:]]),
+                    need.overlapsAny(ev,self.evs[30:]))
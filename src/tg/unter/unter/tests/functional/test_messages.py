@@ -0,0 +1,160 @@
+'''
+Test alert message templates: each message is compiled once per
+event, rendering it gives the same text the alerts always had, and
+its short response links keep a typical SMS alert to two segments.
+'''
+import transaction
+import logging
+import datetime as dt
+import uuid
+
+import unter.model as model
+import unter.controllers.alerts as alerts
+import unter.controllers.messages as messages
+import unter.controllers.need as need
+import unter.controllers.tokens as tokens
+from unter.controllers.util import minutesPastMidnightToTimeString, evTypeToString
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class TestMessages(TestController):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            self.createEvent(created_by=self.getUser(model.DBSession,'carla'),
+                    notes='event',location='{The} Bus Station')
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestMessages: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+        messages.clearTemplates()
+
+    def getEvent(self):
+        return model.DBSession.query(model.NeedEvent).filter_by(notes='event').first()
+
+    def getVolunteers(self):
+        return [self.getUser(model.DBSession,name) for name in ('veronica','velma','vaughn')]
+
+    def test_0_sameText(self):
+        ''' A rendered event message has the text built for each volunteer before, with short links. '''
+        ev = self.getEvent()
+        vol = self.getVolunteers()[0]
+        msg = alerts.makeMessageForEvent(ev,vol,token='TOKEN')
+        link = "{}/a/TOKEN".format(alerts.MVCA_SITE)
+        dlink = "{}/r/TOKEN".format(alerts.MVCA_SITE)
+        eq_(("This is MVCA. We have a need for {} volunteer(s) at {} {}. Purpose: {}. "
+            "Location: {}. Can you help? Call {} {} or click link to commit: {}. "
+            "Or click to ignore: {}").format(ev.volunteer_count,
+                minutesPastMidnightToTimeString(ev.time_of_need),dt.date.fromtimestamp(ev.date_of_need),
+                evTypeToString(ev.etid),ev.location,ev.created_by.display_name,ev.created_by.phone,
+                link,dlink),msg)
+        eq_(['token','token'],messages.eventMessage(ev,site=alerts.MVCA_SITE).slots)
+
+    def test_1_compiledOncePerEvent(self):
+        ''' Alerting many volunteers by SMS and email compiles the message once. '''
+        ev = self.getEvent()
+        vols = self.getVolunteers()
+        for vol in vols:
+            vol.text_alerts_ok = 1
+        alerts.sendAlerts(vols,ev,honorLastAlertTime=False)
+        eq_(1,messages.templateStats()['misses'])
+        log = self.getAlertLog()
+        for vol in vols:
+            token = model.DBSession.query(model.AlertUUID).filter_by(user_id=vol.user_id).one().uuid
+            ok_('/a/{}. '.format(token) in log,'No link for {}'.format(vol.user_name))
+            ok_('/a/{}. '.format(token) in self.getEmailLog())
+        transaction.abort()
+
+    def test_2_editedEvent(self):
+        ''' Changing an event gives a new template, not a stale one. '''
+        ev = self.getEvent()
+        vol = self.getVolunteers()[0]
+        ok_('Location: {The} Bus Station.' in alerts.makeMessageForEvent(ev,vol,token='T'))
+        ev.location = 'The Airport'
+        ev.volunteer_count = 3
+        msg = alerts.makeMessageForEvent(ev,vol,token='T')
+        ok_('Location: The Airport.' in msg,msg)
+        ok_('need for 3 volunteer(s)' in msg,msg)
+        eq_(2,messages.templateStats()['misses'])
+        # So does editing its event type's description.
+        et = model.EventType.et_by_id(ev.etid)
+        et.description = 'Take people to the ferry'
+        transaction.commit()
+        ev = self.getEvent()
+        msg = alerts.makeMessageForEvent(ev,self.getVolunteers()[0],token='T')
+        ok_('Purpose: Take people to the ferry.' in msg,msg)
+        transaction.abort()
+
+    def test_3_cancellation(self):
+        ''' Cancelling an event compiles its message once for all its volunteers. '''
+        for name in ('veronica','velma','vaughn'):
+            self.createResponse(name,'event')
+        ev = self.getEvent()
+        self.resetEmailLog()
+        need.cancelEvent(model.DBSession,ev)
+        eq_(dict(hits=2,misses=1,size=1),messages.templateStats())
+        expected = 'An event you committed to has been cancelled. ' + \
+                'You do not need to go to {} at {} on {}. '.format(ev.location,
+                        dt.date.fromtimestamp(ev.date_of_need),minutesPastMidnightToTimeString(ev.time_of_need)) + \
+                'Thank you for being willing to help!'
+        eq_(3,self.getEmailLog().count(expected))
+        transaction.abort()
+
+    def test_4_confirmation(self):
+        ''' Confirmations fill in each volunteer's name. '''
+        ev = self.getEvent()
+        veronica,velma,vaughn = self.getVolunteers()
+        velma.display_name = 'Velma {Dinkley}'
+        for vol in (veronica,velma):
+            msg = alerts.makeConfirmationMsgForEvent(vol,ev,True)
+            ok_(msg.startswith('Thank you for responding, {}. Please go to {} at '.format(
+                vol.display_name,ev.location)),msg)
+        msg = alerts.makeConfirmationMsgForEvent(vaughn,ev,False)
+        ok_(msg.startswith('Thank you for responding, {}. Enough volunteers'.format(vaughn.display_name)),msg)
+        eq_(dict(hits=1,misses=2,size=2),messages.templateStats())
+        transaction.abort()
+
+    def test_5_smsSegments(self):
+        ''' A typical alert, with short links, fits in two SMS segments rather than three. '''
+        eq_(1,messages.smsSegments('x' * 160))
+        eq_(2,messages.smsSegments('x' * 161))
+        eq_(2,messages.smsSegments('[' * 81))
+        eq_(1,messages.smsSegments('ñ' * 160))
+        eq_(2,messages.smsSegments('ć' * 71))
+        ev = self.getEvent()
+        ev.location = 'Greyhound Station'
+        vol = self.getVolunteers()[0]
+        site = 'https://mvca.example.org'
+        token = tokens.newCode()
+        msg = messages.eventMessage(ev,site=site).render(token=token)
+        ok_(site + '/a/' + token in msg,msg)
+        eq_(2,messages.smsSegments(msg),msg)
+        legacy = msg.replace('/a/' + token,'/sms_response?uuid={}&action=accept'.format(uuid.uuid4())).\
+                replace('/r/' + token,'/sms_response?uuid={}&action=refuse'.format(uuid.uuid4()))
+        eq_(3,messages.smsSegments(legacy),legacy)
+        transaction.abort()
+
+    def test_6_shortLinks(self):
+        ''' Short links resolve to the volunteer and event, and old links still work. '''
+        ev = self.getEvent()
+        vol = self.getVolunteers()[0]
+        ev.volunteer_count = 2
+        code = alerts.makeUUIDForAlert(ev,vol)
+        eq_(tokens.CODE_LENGTH,len(code))
+        ok_(not tokens.isSigned(code))
+        legacy = str(uuid.uuid4())
+        model.DBSession.add(model.AlertUUID(user_id=self.getVolunteers()[1].user_id,neid=ev.neid,uuid=legacy))
+        transaction.commit()
+        self.app.get('/a/{}'.format(code),status=200)
+        self.app.get('/sms_response?uuid={}&action=accept'.format(legacy),status=200)
+        eq_(2,model.DBSession.query(model.VolunteerResponse).count())
+        self.app.get('/r/{}'.format(code),status=200)
+        eq_(['velma'],[r.user.user_name for r in model.DBSession.query(model.VolunteerResponse)])
+        eq_(1,model.DBSession.query(model.VolunteerDecommitment).count())
@@ -76,7 +76,7 @@ class TestNeedEventsPage(TestController):
                 # There should be a UUID for this event and it should
                 # appear in the alert texts.
                 uuid = getUuidForEventFromUUIDTable(ev.neid)
-                ok_('?uuid={}'.format(uuid) in alertLog,alertLog)
+                ok_('/a/{}'.format(uuid) in alertLog,alertLog)
 
     def setupDB(self):
         self.createCoordinatorCarla()
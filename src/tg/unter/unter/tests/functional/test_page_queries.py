@@ -0,0 +1,113 @@
+'''
+Test that the event list pages load their data with a number of
+SQL statements that does not grow with the number of events shown.
+'''
+import transaction
+import logging
+import datetime as dt
+
+import unter.model as model
+
+from unter.lib import sqlstats
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class TestPageQueries(TestController):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            self.createAvailabilities()
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestPageQueries: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+
+    def addEvents(self,count):
+        ''' Add count events, each with one response and one decommitment. '''
+        try:
+            carla = self.getUser(model.DBSession,'carla')
+            veronica = self.getUser(model.DBSession,'veronica')
+            velma = self.getUser(model.DBSession,'velma')
+            first = model.DBSession.query(model.NeedEvent).count()
+            for i in range(first,first+count):
+                nev = self.createEvent(created_by=carla,volunteer_count=2,
+                        ev_type=[model.NeedEvent.EV_TYPE_BUS,model.NeedEvent.EV_TYPE_AIRPORT][i%2],
+                        date_of_need=dt.datetime.now()+dt.timedelta(days=1+i),
+                        time_of_need=12*60+30,duration=20,notes='event {}'.format(i))
+                vr = model.VolunteerResponse()
+                vr.user = velma
+                vr.need_event = nev
+                model.DBSession.add(vr)
+                vd = model.VolunteerDecommitment()
+                vd.user = veronica
+                vd.need_event = nev
+                model.DBSession.add(vd)
+        except:
+            transaction.abort()
+            raise
+        else:
+            transaction.commit()
+
+    def statementCount(self,url,user):
+        resp = self.app.get(url,extra_environ={'REMOTE_USER':user},status=200)
+        return int(resp.headers['X-SQL-Statements'])
+
+    def checkPage(self,url,user):
+        self.addEvents(3)
+        # Warm up process-wide caches such as the event type registry.
+        self.statementCount(url,user)
+        few = self.statementCount(url,user)
+        self.addEvents(30)
+        many = self.statementCount(url,user)
+        eq_(few,many,'{}: {} statements with 3 events, {} with 33'.format(url,few,many))
+        return many
+
+    def test_0_needEvents(self):
+        ''' /need_events issues the same number of statements for 3 or 33 events. '''
+        count = self.checkPage('/need_events?complete=0','carla')
+        ok_(count < 20,count)
+
+    def test_1_coordPage(self):
+        ''' /coord_page issues the same number of statements for 3 or 33 events. '''
+        self.checkPage('/coord_page','carla')
+
+    def test_2_volunteerInfo(self):
+        ''' /volunteer_info issues the same number of statements for 3 or 33 events. '''
+        self.checkPage('/volunteer_info','velma')
+        self.checkPage('/volunteer_info','veronica')
+
+    def test_3_eventTypeShown(self):
+        ''' Event lists show the event type description. '''
+        self.addEvents(2)
+        resp = self.app.get('/need_events?complete=0',extra_environ={'REMOTE_USER':'carla'},status=200)
+        ok_('Take people to the bus station' in resp.text,resp.text)
+        ok_('Take people to the airport' in resp.text,resp.text)
+
+    def test_4_sqlStats(self):
+        ''' Managers can read per-page statement counts. '''
+        self.statementCount('/need_events?complete=0','carla')
+        resp = self.app.get('/sql_stats',extra_environ={'REMOTE_USER':'manager'},status=200)
+        ok_('/need_events' in resp.json['pages'],resp.json)
+
+    def test_5_sqlStatsByRoute(self):
+        ''' Pages with arguments in their path are counted once per route, and the pages kept are capped. '''
+        before = sqlstats.pageStats().get('/a',dict(requests=0))['requests']
+        for token in ('abc123','def456','ghi789'):
+            self.app.get('/a/{}'.format(token))
+        pages = self.app.get('/sql_stats',extra_environ={'REMOTE_USER':'manager'},status=200).json['pages']
+        eq_(before + 3,pages['/a']['requests'])
+        eq_([],[p for p in pages if 'abc123' in p])
+        saved = sqlstats.MAX_PAGES
+        try:
+            sqlstats.MAX_PAGES = len(pages)
+            sqlstats.recordPage('/new_page',1)
+            ok_('/new_page' not in sqlstats.pageStats())
+            eq_(1,sqlstats.pageStats()[sqlstats.OTHER_PAGES]['requests'])
+        finally:
+            sqlstats.MAX_PAGES = saved
@@ -0,0 +1,135 @@
+'''
+Test the token-bucket rate limits that pace sends to the providers.
+'''
+import os
+import sys
+
+from unter.controllers.ratelimit import RateLimiter, TokenBucket, parseLimits, limiterFromConfig
+
+from nose.tools import ok_, eq_
+
+# The alert service lives beside the web service, in src/.
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),*(['..'] * 5)))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
+
+import alert_service.service.ratelimit as serviceRatelimit
+
+class FakeClock:
+    ''' A clock that only moves when something sleeps. '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self,seconds):
+        self.now += seconds
+
+class TestRateLimits:
+
+    def limiter(self,headroom=1.0,**limits):
+        self.clock = FakeClock()
+        return RateLimiter(dict([(scope,parseLimits(spec)) for scope,spec in limits.items()]),
+                headroom,self.clock,self.clock.sleep)
+
+    def test_0_parseLimits(self):
+        eq_([(10,1),(250000,86400)],parseLimits('10/s, 250000/d'))
+        eq_([(3,60),(5,30)],parseLimits('3/m,5/30'))
+        eq_([],parseLimits(None))
+        eq_([],parseLimits(''))
+
+    def test_1_bucketReservesInOrder(self):
+        ''' An empty bucket tells each caller how long to wait for its token. '''
+        clock = FakeClock()
+        bucket = TokenBucket(2,1,clock)
+        eq_(0,bucket.reserve())
+        eq_(0,bucket.reserve())
+        eq_(0.5,bucket.reserve())
+        eq_(1.0,bucket.reserve())
+        clock.sleep(1.5)
+        eq_(0,bucket.reserve())
+
+    def test_2_providerRate(self):
+        ''' After the burst, sends are paced at the provider's rate. '''
+        limiter = self.limiter(provider='10/s')
+        start = self.clock()
+        for i in range(30):
+            limiter.wait('+15550000000','+15550000001')
+        # 10 at once, then 20 more at 10 a second.
+        ok_(abs(self.clock() - start - 2.0) < 1e-6,self.clock() - start)
+        stats = limiter.stats()
+        eq_(30,stats['sends'])
+        eq_(20,stats['waits'])
+
+    def test_3_senderAndRecipientLimits(self):
+        ''' Each sender and recipient has its own buckets. '''
+        limiter = self.limiter(sender='1/s',recipient='2/m')
+        eq_(0,limiter.wait('A','x'))
+        eq_(0,limiter.wait('B','y'))
+        eq_(1.0,limiter.wait('A','z'))
+        eq_(0,limiter.wait('B','x'))
+        # x has had its two this minute.
+        ok_(limiter.wait('C','x') > 20)
+
+    def test_4_dailyLimit(self):
+        ''' A daily limit holds sends back once the day's allowance is used. '''
+        limiter = self.limiter(provider='100/s, 50/d')
+        for i in range(50):
+            limiter.wait()
+        eq_(0,limiter.stats()['waits'])
+        ok_(limiter.reserve() > 1000)
+
+    def test_5_headroom(self):
+        ''' By default sends are paced just under the limits. '''
+        limiter = self.limiter(headroom=0.9,provider='10/s')
+        start = self.clock()
+        for i in range(9 + 90):
+            limiter.wait()
+        ok_(abs(self.clock() - start - 10.0) < 1e-6,self.clock() - start)
+
+    def test_6_penalize(self):
+        ''' After a provider throttles us, every send waits. '''
+        limiter = self.limiter()
+        eq_(0,limiter.wait('A'))
+        limiter.penalize(2)
+        eq_(2,limiter.wait('B'))
+        eq_(1,limiter.stats()['throttled'])
+
+    def test_7_idleBucketsPruned(self):
+        ''' Buckets for recipients that have refilled are forgotten. '''
+        limiter = self.limiter(recipient='1/s')
+        limiter.PRUNE_EVERY = 10
+        for i in range(9):
+            limiter.wait(None,'r{}'.format(i))
+        eq_(9,len(limiter.buckets))
+        self.clock.sleep(5)
+        limiter.wait(None,'last')
+        eq_([('recipient','last')],list(limiter.buckets))
+
+    def test_8_fromConfig(self):
+        config = {'twilio.limits':'20/s','twilio.sender.limits':'1/s','twilio.headroom':'1'}
+        limiter = limiterFromConfig(config,'twilio','10/s')
+        eq_([(20,1)],limiter.limits['provider'])
+        eq_([(1,1)],limiter.limits['sender'])
+        ok_('recipient' not in limiter.limits)
+        eq_([(9,1)],limiterFromConfig({},'twilio','10/s').limits['provider'])
+
+class TestSameAsAlertService:
+    '''
+    The alert service (src/alert_service) has its own copy of the
+    limit parsing and token buckets; check the two still agree.
+    '''
+
+    def test_0_parseLimits(self):
+        for spec in ('10/s, 250000/d','3/m,5/30','1/h',None,''):
+            eq_(parseLimits(spec),serviceRatelimit.parseLimits(spec),spec)
+
+    def test_1_tokenBuckets(self):
+        clock = FakeClock()
+        ours = TokenBucket(3,2,clock)
+        theirs = serviceRatelimit.TokenBucket(3,2,clock)
+        for step in (0,0,0,0,0.1,0.5,0,2,0,0,0,0,0,7):
+            clock.sleep(step)
+            eq_(ours.reserve(),theirs.reserve())
@@ -0,0 +1,221 @@
+'''
+Test automatic re-evaluation: changes that can make an event need
+alerting mark it, bursts of them are coalesced into one pass, and a
+pass alerts only the affected events.
+'''
+import transaction
+import logging
+import datetime as dt
+import sys
+import time
+import types
+
+import unter.model as model
+import unter.controllers.alerts as alerts
+import unter.controllers.need as need
+import unter.controllers.reevaluate as reevaluate
+from unter.controllers.reevaluate import EventReevaluator
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class FakeClock:
+    ''' A clock that only moves when told to. '''
+
+    def __init__(self,now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class TestEventReevaluator:
+    ''' The re-evaluator alone, without the database. '''
+
+    def reevaluator(self,delay=5):
+        self.clock = FakeClock()
+        self.passes = []
+        return EventReevaluator(delay,evaluate=self.passes.append,clock=self.clock)
+
+    def test_0_coalesce(self):
+        ''' A burst of changes is evaluated in one pass, delay seconds after the first. '''
+        rev = self.reevaluator()
+        eq_(None,rev.runPending())
+        rev.markEvent(1)
+        self.clock.now += 3
+        rev.markEvent(2)
+        rev.markWindow(0b1111111,600,900)
+        rev.markUser(7)
+        eq_(None,rev.runPending())
+        self.clock.now += 2
+        rev.runPending()
+        eq_([dict(events=set([1,2]),windows=[(0b1111111,600,900)],users=set([7]))],self.passes)
+        eq_(None,rev.runPending())
+        eq_(1,rev.passes)
+
+    def test_1_expiries(self):
+        ''' An event is re-evaluated when its last alert expires, at the latest time scheduled. '''
+        rev = self.reevaluator()
+        rev.scheduleExpiry(5,1100)
+        rev.scheduleExpiry(6,1150)
+        rev.scheduleExpiry(5,1200)
+        self.clock.now = 1100
+        eq_(None,rev.runPending())
+        self.clock.now = 1150
+        rev.runPending()
+        eq_(set([6]),self.passes[-1]['events'])
+        self.clock.now = 1200
+        rev.markEvent(8)
+        rev.runPending()
+        eq_(set([5,8]),self.passes[-1]['events'])
+        self.clock.now = 5000
+        eq_(None,rev.runPending())
+        eq_(0,len(rev.heap))
+
+    def test_2_idleThread(self):
+        ''' The thread sleeps while nothing changes, and runs a pass after a change. '''
+        passes = []
+        rev = EventReevaluator(0.2,evaluate=passes.append)
+        rev.start(load=False)
+        try:
+            time.sleep(0.3)
+            eq_(0,rev.wakeups)
+            began = time.time()
+            rev.markEvent(3)
+            rev.markEvent(4)
+            deadline = time.time() + 5
+            while len(passes) == 0 and time.time() < deadline:
+                time.sleep(0.05)
+            eq_([set([3,4])],[p['events'] for p in passes])
+            ok_(time.time() - began >= 0.2)
+        finally:
+            rev.stop()
+
+    def test_3_oneProcessOnly(self):
+        ''' The re-evaluator is not started under uWSGI with several worker processes. '''
+        uwsgi = types.ModuleType('uwsgi')
+        uwsgi.numproc = 4
+        sys.modules['uwsgi'] = uwsgi
+        try:
+            reevaluate.configureReevaluation({'reevaluate.enabled':'true'})
+            eq_(None,reevaluate.getReevaluator())
+            uwsgi.numproc = 1
+            reevaluate.configureReevaluation({'reevaluate.enabled':'true'})
+            ok_(reevaluate.getReevaluator() is not None)
+        finally:
+            del sys.modules['uwsgi']
+            reevaluate.setReevaluator(None)
+
+class TestReevaluation(TestController):
+    ''' Changes committed through the ORM mark events, and passes alert them. '''
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            self.createAvailabilities()
+            self.createEvent(created_by=self.getUser(model.DBSession,'carla'),
+                    time_of_need=12*60+30,volunteer_count=3,notes='lunch')
+            self.createEvent(created_by=self.getUser(model.DBSession,'carla'),
+                    time_of_need=20*60,notes='evening')
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestReevaluation: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+        self.rev = EventReevaluator(delay=0)
+        reevaluate.setReevaluator(self.rev)
+
+    def tearDown(self):
+        reevaluate.setReevaluator(None)
+        super().tearDown()
+
+    def getEvent(self,notes):
+        return model.DBSession.query(model.NeedEvent).filter_by(notes=notes).first()
+
+    def alertedUsers(self):
+        return sorted([a.user.user_name for a in model.DBSession.query(model.AlertUUID)])
+
+    def test_0_decommit(self):
+        ''' A volunteer withdrawing marks the event, and a pass alerts the others. '''
+        need.commit_volunteer(model.DBSession,self.getUser(model.DBSession,'veronica'),self.getEvent('lunch'))
+        transaction.commit()
+        eq_(set(),self.rev.work['events'])
+        lunch = self.getEvent('lunch').neid
+        need.decommit_volunteer(model.DBSession,user=self.getUser(model.DBSession,'veronica'),
+                ev=self.getEvent('lunch'))
+        transaction.abort()
+        eq_(set(),self.rev.work['events'],'Rolled back changes are ignored')
+        need.decommit_volunteer(model.DBSession,user=self.getUser(model.DBSession,'veronica'),
+                ev=self.getEvent('lunch'))
+        transaction.commit()
+        eq_(set([lunch]),self.rev.work['events'])
+        eq_([lunch],self.rev.runPending())
+        eq_(['velma','veronica'],self.alertedUsers())
+        # The alert is re-evaluated once it expires.
+        ev = self.getEvent('lunch')
+        ok_(ev.last_alert_time > 0)
+        eq_(ev.last_alert_time + alerts.MIN_ALERT_SECONDS,self.rev.expiries[lunch])
+
+    def test_1_newAvailability(self):
+        ''' A new availability window alerts the events it contains, and no others. '''
+        vaughn = self.getUser(model.DBSession,'vaughn')
+        self.createAvailability(user=vaughn,start_time=19*60,end_time=23*60)
+        transaction.commit()
+        eq_(1,len(self.rev.work['windows']))
+        eq_([self.getEvent('evening').neid],self.rev.runPending())
+        eq_(['vaughn'],self.alertedUsers())
+
+    def test_2_activation(self):
+        ''' A volunteer added to a group has the events they are available for re-evaluated. '''
+        group = model.DBSession.query(model.Group).filter_by(group_name='volunteers').first()
+        velma = self.getUser(model.DBSession,'velma')
+        group.users.remove(velma)
+        transaction.commit()
+        eq_(None,self.rev.runPending())
+        group = model.DBSession.query(model.Group).filter_by(group_name='volunteers').first()
+        velma = self.getUser(model.DBSession,'velma')
+        velmaId = velma.user_id
+        group.users.append(velma)
+        transaction.commit()
+        eq_(set([velmaId]),self.rev.work['users'])
+        eq_([self.getEvent('lunch').neid],self.rev.runPending())
+        eq_(['velma','veronica'],self.alertedUsers())
+
+    def test_3_alertedRecently(self):
+        ''' An event alerted recently is not alerted again before its alert expires. '''
+        lunch = self.getEvent('lunch')
+        need.checkOneEvent(model.DBSession,lunch.neid)
+        transaction.commit()
+        lunch = self.getEvent('lunch')
+        expiry = lunch.last_alert_time + alerts.MIN_ALERT_SECONDS
+        eq_(expiry,self.rev.expiries[lunch.neid])
+        eq_(2,len(self.alertedUsers()))
+        self.rev.markEvent(lunch.neid)
+        eq_([],self.rev.runPending())
+        eq_(2,len(self.alertedUsers()))
+        # Once the alert expires, the event is alerted again.
+        lunch = self.getEvent('lunch')
+        lunch.last_alert_time -= alerts.MIN_ALERT_SECONDS
+        transaction.commit()
+        eq_([self.getEvent('lunch').neid],self.rev.runPending(now=expiry))
+        eq_(4,len(self.alertedUsers()))
+
+    def test_4_startedEvent(self):
+        ''' An event that has started is not re-alerted, though date_of_need is noon on its day. '''
+        day = dt.date.today() + dt.timedelta(days=1)
+        lunch = self.getEvent('lunch')
+        lunch.date_of_need = dt.datetime(day.year,day.month,day.day,12).timestamp()
+        neid = lunch.neid
+        transaction.commit()
+        started = dt.datetime(day.year,day.month,day.day,13).timestamp()
+        eq_([],reevaluate.reevaluateEvents(dict(events=set([neid]),windows=[],users=set()),now=started))
+        eq_([],self.alertedUsers())
+        rev = EventReevaluator(clock=FakeClock(started))
+        rev.loadFromDatabase()
+        ok_(neid not in rev.expiries)
+        before = dt.datetime(day.year,day.month,day.day,12).timestamp()
+        eq_([neid],reevaluate.reevaluateEvents(dict(events=set([neid]),windows=[],users=set()),now=before))
+        eq_(['velma','veronica'],self.alertedUsers())
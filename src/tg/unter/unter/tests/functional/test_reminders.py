@@ -0,0 +1,236 @@
+'''
+Test the reminder scheduler: reminders are kept in order of when they
+are due, follow commitments, withdrawals and cancellations, are
+rebuilt from the database, and are sent when due.
+'''
+import transaction
+import logging
+import datetime as dt
+import random
+import sys
+import time
+import types
+
+import unter.model as model
+import unter.controllers.need as need
+import unter.controllers.reminders as reminders
+from unter.controllers.reminders import ReminderScheduler, eventStart
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class FakeClock:
+    ''' A clock that only moves when told to. '''
+
+    def __init__(self,now=None):
+        self.now = time.time() if now is None else now
+
+    def __call__(self):
+        return self.now
+
+class TestReminderScheduler:
+    ''' The scheduler alone, without the database. '''
+
+    def scheduler(self):
+        self.clock = FakeClock(1000.0)
+        self.sent = []
+        return ReminderScheduler(lead=60,send=lambda user_id,neid: self.sent.append((user_id,neid)),
+                clock=self.clock)
+
+    def test_0_dueInOrder(self):
+        ''' Reminders are sent in the order they fall due, lead seconds before the event. '''
+        sch = self.scheduler()
+        ok_(sch.add(1,10,2000))
+        ok_(sch.add(2,10,2000))
+        ok_(sch.add(3,11,1500))
+        ok_(not sch.add(4,12,1050),'Too late to remind')
+        eq_(3,len(sch))
+        eq_(0,sch.sendDue())
+        self.clock.now = 1440
+        eq_(1,sch.sendDue())
+        eq_([(3,11)],self.sent)
+        self.clock.now = 1940
+        eq_(2,sch.sendDue())
+        eq_([(3,11),(1,10),(2,10)],self.sent)
+        eq_(0,len(sch))
+
+    def test_1_updates(self):
+        ''' Reminders can be moved, removed singly or for a whole event. '''
+        sch = self.scheduler()
+        for user_id in range(5):
+            sch.add(user_id,10,2000)
+        sch.add(9,11,3000)
+        sch.add(9,11,1500)
+        sch.remove(0,10)
+        sch.remove(0,10)
+        sch.remove(7,99)
+        eq_(5,len(sch))
+        self.clock.now = 1440
+        eq_([(9,11)],sch.popDue())
+        sch.removeEvent(10)
+        eq_(0,len(sch))
+        self.clock.now = 5000
+        eq_([],sch.popDue())
+        eq_(0,len(sch.heap))
+
+    def test_2_manyReminders(self):
+        ''' Tens of thousands of reminders are loaded, updated and sent in order quickly. '''
+        sch = self.scheduler()
+        rnd = random.Random(7)
+        n = 50000
+        began = time.time()
+        sch.load([(user_id,user_id % 500,1100 + rnd.random() * 100000) for user_id in range(n)])
+        eq_(n,len(sch))
+        for user_id in range(0,n,5):
+            sch.remove(user_id,user_id % 500)
+        for user_id in range(1,n,5):
+            sch.add(user_id,user_id % 500,1100 + rnd.random() * 100000)
+        ok_(len(sch.heap) < 2 * n,'Removed entries are compacted away')
+        self.clock.now = 200000
+        due = []
+        sch.send = lambda user_id,neid: due.append(user_id)
+        eq_(n - n // 5,sch.sendDue())
+        ok_(time.time() - began < 5,'Took {:.1f}s'.format(time.time() - began))
+        eq_(0,len(sch))
+
+    def test_3_sleepsUntilDue(self):
+        ''' The scheduler thread sleeps until a reminder is due, and wakes for an earlier one. '''
+        sent = []
+        sch = ReminderScheduler(lead=0,send=lambda user_id,neid: sent.append((user_id,neid)))
+        sch.start(load=False)
+        try:
+            now = time.time()
+            sch.add(1,10,now + 60)
+            time.sleep(0.1)
+            eq_([],sent)
+            sch.add(2,10,now + 0.3)
+            deadline = time.time() + 5
+            while len(sent) == 0 and time.time() < deadline:
+                time.sleep(0.05)
+            eq_([(2,10)],sent)
+            ok_(time.time() - now >= 0.3)
+            ok_(sch.wakeups <= 3,'Woke {} times'.format(sch.wakeups))
+        finally:
+            sch.stop()
+        eq_(1,len(sch))
+
+    def test_4_oneProcessOnly(self):
+        ''' Reminders are not started under uWSGI with several worker processes. '''
+        uwsgi = types.ModuleType('uwsgi')
+        uwsgi.numproc = 2
+        sys.modules['uwsgi'] = uwsgi
+        try:
+            reminders.configureReminders({'reminders.enabled':'true'})
+            eq_(None,reminders.getScheduler())
+            uwsgi.numproc = 1
+            reminders.configureReminders({'reminders.enabled':'true'})
+            ok_(reminders.getScheduler() is not None)
+        finally:
+            del sys.modules['uwsgi']
+            reminders.setScheduler(None)
+
+class TestReminders(TestController):
+    ''' The scheduler kept up to date by commitments, and sending reminders. '''
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            carla = self.getUser(model.DBSession,'carla')
+            now = dt.datetime.now()
+            self.createEvent(created_by=carla,notes='tomorrow',volunteer_count=3,location='Bus station')
+            self.createEvent(created_by=carla,notes='next week',date_of_need=now + dt.timedelta(days=7))
+            self.createEvent(created_by=carla,notes='yesterday',date_of_need=now - dt.timedelta(days=1))
+            model.DBSession.flush()
+            self.createResponse('veronica','tomorrow')
+            self.createResponse('velma','next week')
+            self.createResponse('vaughn','yesterday')
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestReminders: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+        self.clock = FakeClock()
+        self.sent = []
+        self.sch = ReminderScheduler(lead=3600,send=lambda user_id,neid: self.sent.append((user_id,neid)),
+                clock=self.clock)
+        reminders.setScheduler(self.sch)
+
+    def tearDown(self):
+        reminders.setScheduler(None)
+        super().tearDown()
+
+    def getEvent(self,notes):
+        return model.DBSession.query(model.NeedEvent).filter_by(notes=notes).first()
+
+    def remindersFor(self):
+        return sorted([(self.getEvent(notes).notes,user_name) for user_name in ('veronica','velma','vaughn') \
+                for notes in ('tomorrow','next week','yesterday') \
+                if (self.getUser(model.DBSession,user_name).user_id,self.getEvent(notes).neid) in self.sch.entries])
+
+    def test_0_loadFromDatabase(self):
+        ''' On startup, reminders are built for responses to upcoming events. '''
+        self.getEvent('next week').cancelled = 1
+        transaction.commit()
+        self.sch.loadFromDatabase()
+        eq_([('tomorrow','veronica')],self.remindersFor())
+        ev = self.getEvent('tomorrow')
+        eq_(eventStart(ev) - 3600,self.sch.nextDue())
+
+    def test_1_followsCommitments(self):
+        ''' Committing, withdrawing and cancelling update the scheduler when they commit. '''
+        self.sch.loadFromDatabase()
+        need.commit_volunteer(model.DBSession,self.getUser(model.DBSession,'velma'),self.getEvent('tomorrow'))
+        eq_([('next week','velma'),('tomorrow','veronica')],self.remindersFor())
+        transaction.commit()
+        eq_([('next week','velma'),('tomorrow','velma'),('tomorrow','veronica')],self.remindersFor())
+        # Changes that are rolled back are not applied.
+        need.decommit_volunteer(model.DBSession,user=self.getUser(model.DBSession,'velma'),
+                ev=self.getEvent('next week'))
+        transaction.abort()
+        eq_(3,len(self.sch))
+        need.decommit_volunteer(model.DBSession,user=self.getUser(model.DBSession,'velma'),
+                ev=self.getEvent('next week'))
+        transaction.commit()
+        eq_([('tomorrow','velma'),('tomorrow','veronica')],self.remindersFor())
+        need.cancelEvent(model.DBSession,self.getEvent('tomorrow'))
+        transaction.commit()
+        eq_([],self.remindersFor())
+
+    def test_2_sendReminders(self):
+        ''' Due reminders are sent to volunteers still going to events still on. '''
+        self.sch.send = reminders.sendReminder
+        self.sch.loadFromDatabase()
+        need.commit_volunteer(model.DBSession,self.getUser(model.DBSession,'velma'),self.getEvent('tomorrow'))
+        transaction.commit()
+        # Withdrawn behind the scheduler's back.
+        velma = self.getUser(model.DBSession,'velma')
+        model.DBSession.query(model.VolunteerResponse).filter_by(user_id=velma.user_id,
+                neid=self.getEvent('tomorrow').neid).delete()
+        transaction.commit()
+        self.resetAlertLog()
+        self.resetEmailLog()
+        ev = self.getEvent('tomorrow')
+        self.clock.now = eventStart(ev) - 3600
+        eq_(2,self.sch.sendDue())
+        veronica = self.getUser(model.DBSession,'veronica')
+        log = self.getEmailLog()
+        eq_(1,log.count('Reminder, '),log)
+        ok_('Reminder, {}: please go to Bus station at 10:19'.format(veronica.display_name) in log,log)
+        eq_([('next week','velma')],self.remindersFor())
+
+    def test_3_noonDateOfNeed(self):
+        ''' An event stored, as the web form stores it, at noon on its day is reminded of lead before it starts. '''
+        day = dt.date.today() + dt.timedelta(days=2)
+        self.createEvent(created_by=self.getUser(model.DBSession,'carla'),notes='form',
+                date_of_need=dt.datetime(day.year,day.month,day.day,12),time_of_need=9*60)
+        transaction.commit()
+        due = dt.datetime(day.year,day.month,day.day,8).timestamp()
+        need.commit_volunteer(model.DBSession,self.getUser(model.DBSession,'velma'),self.getEvent('form'))
+        transaction.commit()
+        eq_(due,self.sch.entries[(self.getUser(model.DBSession,'velma').user_id,self.getEvent('form').neid)][0])
+        self.sch.loadFromDatabase()
+        eq_(due,self.sch.entries[(self.getUser(model.DBSession,'velma').user_id,self.getEvent('form').neid)][0])
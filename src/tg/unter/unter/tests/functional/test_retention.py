@@ -0,0 +1,125 @@
+'''
+Test the retention job: alert tokens, password resets and refusals
+that are no longer needed are deleted in batches, and old events can
+be archived.
+'''
+import transaction
+import logging
+import datetime as dt
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import unter.model as model
+import unter.controllers.retention as retention
+import unter.controllers.alerts as alerts
+
+from unter.tests import TestController
+
+from nose.tools import eq_
+
+class TestRetention(TestController):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            carla = self.getUser(model.DBSession,'carla')
+            now = dt.datetime.now()
+            self.createEvent(created_by=carla,date_of_need=now - dt.timedelta(days=40),notes='old')
+            self.createEvent(created_by=carla,date_of_need=now - dt.timedelta(days=3),notes='recent')
+            self.createEvent(created_by=carla,date_of_need=now + dt.timedelta(days=1),notes='done',
+                    complete=1)
+            self.createEvent(created_by=carla,date_of_need=now + dt.timedelta(days=1),notes='upcoming')
+            model.DBSession.flush()
+            for notes in ('old','recent','done','upcoming'):
+                ev = model.DBSession.query(model.NeedEvent).filter_by(notes=notes).first()
+                for vol in ('veronica','velma','vaughn'):
+                    user = self.getUser(model.DBSession,vol)
+                    model.DBSession.add(model.AlertUUID(user_id=user.user_id,neid=ev.neid,
+                        uuid='{}-{}'.format(notes,vol)))
+                self.createResponse('veronica',notes)
+                self.createDecommitment('velma',notes)
+            veronica = self.getUser(model.DBSession,'veronica')
+            for age in (10,7200,86400):
+                model.DBSession.add(model.PasswordUUID(user_id=veronica.user_id,
+                    uuid='reset-{}'.format(age),create_time=int(time.time()) - age))
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestRetention: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+        self.saved = (retention.ALERT_UUID_DAYS,retention.DECOMMITMENT_DAYS,retention.ARCHIVE_DAYS,
+                alerts.MAX_PWD_RESET_INTERVAL)
+        alerts.MAX_PWD_RESET_INTERVAL = 3600
+
+    def tearDown(self):
+        retention.ALERT_UUID_DAYS,retention.DECOMMITMENT_DAYS,retention.ARCHIVE_DAYS, \
+                alerts.MAX_PWD_RESET_INTERVAL = self.saved
+        super().tearDown()
+
+    def tokensFor(self):
+        return sorted(set([a.uuid.split('-')[0] for a in model.DBSession.query(model.AlertUUID)]))
+
+    def test_0_policies(self):
+        ''' Each table keeps only the rows still needed. '''
+        result = retention.runRetention(batchSize=2,pause=0)
+        eq_(dict(alert_uuid=9,password_reset=2,volunteer_decommitment=1),result)
+        eq_(['upcoming'],self.tokensFor())
+        eq_(['reset-10'],[p.uuid for p in model.DBSession.query(model.PasswordUUID)])
+        eq_(['done','recent','upcoming'],sorted([d.need_event.notes \
+                for d in model.DBSession.query(model.VolunteerDecommitment)]))
+        # Responses and events are kept.
+        eq_(4,model.DBSession.query(model.VolunteerResponse).count())
+        eq_(4,model.DBSession.query(model.NeedEvent).count())
+        # Nothing left to do.
+        eq_(dict(alert_uuid=0,password_reset=0,volunteer_decommitment=0),
+                retention.runRetention(batchSize=2,pause=0))
+
+    def test_1_batches(self):
+        ''' Rows are deleted in bounded batches. '''
+        deletes = []
+        def countDeletes(conn,cursor,statement,parameters,context,executemany):
+            if statement.startswith('DELETE'):
+                deletes.append(statement.count('?'))
+        event.listen(Engine,'before_cursor_execute',countDeletes)
+        try:
+            eq_(9,retention.purgeAlertUUIDs(batchSize=4,pause=0))
+        finally:
+            event.remove(Engine,'before_cursor_execute',countDeletes)
+        eq_([4,4,1],deletes)
+
+    def test_2_archive(self):
+        ''' Old events and their responses move to the archive tables. '''
+        retention.ARCHIVE_DAYS = 30
+        result = retention.runRetention(batchSize=2,pause=0)
+        eq_(1,result['need_event'])
+        eq_(['done','recent','upcoming'],sorted([e.notes for e in model.DBSession.query(model.NeedEvent)]))
+        archived = model.DBSession.query(model.NeedEventArchive).all()
+        eq_(['old'],[e.notes for e in archived])
+        responses = model.DBSession.query(model.VolunteerResponseArchive).all()
+        eq_([archived[0].neid],[r.neid for r in responses])
+        eq_(self.getUser(model.DBSession,'veronica').user_id,responses[0].user_id)
+        eq_(3,model.DBSession.query(model.VolunteerResponse).count())
+
+    def test_3_endedFromMidnight(self):
+        ''' An event ends time_of_need + duration after midnight of its day, though date_of_need is noon. '''
+        day = dt.date.today() - dt.timedelta(days=5)
+        carla = self.getUser(model.DBSession,'carla')
+        self.createEvent(created_by=carla,date_of_need=dt.datetime(day.year,day.month,day.day,12),
+                time_of_need=9*60,duration=60,notes='form')
+        transaction.commit()
+        ev = model.NeedEvent
+        def ended(hour):
+            cutoff = dt.datetime(day.year,day.month,day.day,hour).timestamp()
+            return sorted([e.notes for e in model.DBSession.query(ev).filter(retention.endedBefore(cutoff))])
+        eq_(['old'],ended(9))
+        eq_(['form','old'],ended(11))
+        # Its refusals go 30 days after it ended, not a day late.
+        self.createDecommitment('velma','form')
+        transaction.commit()
+        eq_(2,retention.purgeDecommitments(now=dt.datetime(day.year,day.month,day.day,11).timestamp() + 30 * 86400,
+                pause=0))
@@ -0,0 +1,190 @@
+'''
+Test SMTPAlerter's connection pool against a minimal in-process
+SMTP server: connections are reused across messages and batches,
+stale and idle connections are replaced, and a dropped connection
+is reconnected transparently. A batch sends every message it can
+and reports each one's result.
+'''
+import socketserver
+import threading
+import time
+
+import unter.controllers.alerts as alerts
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    ''' Just enough SMTP for smtplib.sendmail(). '''
+
+    def reply(self,line):
+        self.wfile.write((line+'\r\n').encode('ascii'))
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.sockets.append(self.connection)
+        self.reply('220 stub ready')
+        mail = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode('ascii').strip()
+            verb = cmd.split(' ')[0].upper()
+            if verb in ('EHLO','HELO'):
+                self.reply('250 stub')
+            elif verb == 'MAIL':
+                mail = dict(rcpts=[])
+                if 'blocked' in cmd:
+                    self.reply('553 sender not allowed')
+                else:
+                    self.reply('250 ok')
+            elif verb == 'RCPT':
+                if 'hangup' in cmd:
+                    return
+                elif 'refused' in cmd:
+                    self.reply('550 no such user')
+                else:
+                    mail['rcpts'].append(cmd.split(':',1)[1].strip('<> '))
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                body = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b'.\r\n',b''):
+                        break
+                    body.append(data.decode('ascii'))
+                mail['body'] = ''.join(body)
+                with server.lock:
+                    server.messages.append(mail)
+                self.reply('250 queued')
+            elif verb in ('NOOP','RSET'):
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1',0),StubSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.sockets = []
+        self.messages = []
+
+    def dropAll(self):
+        ''' Disconnect every client, as a server restart would. '''
+        import socket
+        with self.lock:
+            for sock in self.sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.sockets = []
+
+class TestSMTPPool(TestController):
+
+    def setUp(self):
+        super().setUp()
+        self.server = StubSMTPServer()
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.alerter = alerts.SMTPAlerter()
+        self.alerter.ready = True
+        self.alerter.user = None
+        self.alerter.starttls = False
+        self.alerter.smtpServer = '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.alerter.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_0_connectionReused(self):
+        ''' Consecutive messages share one SMTP connection. '''
+        for i in range(5):
+            self.alerter.send_email('message {}'.format(i),'vol{}@example.com'.format(i),subject='Test')
+        eq_(5,len(self.server.messages))
+        eq_(1,self.server.connections)
+        eq_(['vol3@example.com'],self.server.messages[3]['rcpts'])
+        ok_('subject:Test' in self.server.messages[3]['body'])
+
+    def test_1_batchOneConnection(self):
+        ''' A batch is sent over one connection, skipping refused recipients. '''
+        batch = [dict(message='m{}'.format(i),toAddr='vol{}@example.com'.format(i)) for i in range(10)]
+        batch[4]['toAddr'] = 'refused@example.com'
+        results = self.alerter.send_batch(batch)
+        eq_([True] * 4 + [False] + [True] * 5,results)
+        eq_(9,len(self.server.messages))
+        eq_(1,self.server.connections)
+
+    def test_2_reconnectAfterDrop(self):
+        ''' A connection dropped by the server is replaced without losing the message. '''
+        self.alerter.pool.noopInterval = 3600
+        self.alerter.send_email('before','a@example.com')
+        self.server.dropAll()
+        time.sleep(0.05)
+        self.alerter.send_email('after','b@example.com')
+        eq_(2,len(self.server.messages))
+        eq_(2,self.server.connections)
+
+    def test_3_staleCheckedWithNoop(self):
+        ''' An idle connection is checked with NOOP and replaced if dead. '''
+        self.alerter.pool.noopInterval = 0
+        self.alerter.send_email('one','a@example.com')
+        self.alerter.send_email('two','a@example.com')
+        eq_(1,self.server.connections)
+        self.server.dropAll()
+        time.sleep(0.05)
+        self.alerter.send_email('three','a@example.com')
+        eq_(3,len(self.server.messages))
+        eq_(2,self.server.connections)
+
+    def test_4_idleTimeout(self):
+        ''' Connections idle for longer than the idle timeout are closed, not reused. '''
+        self.alerter.pool.idleTimeout = 0.05
+        self.alerter.send_email('one','a@example.com')
+        time.sleep(0.1)
+        self.alerter.send_email('two','a@example.com')
+        eq_(2,self.server.connections)
+
+    def test_5_poolBoundsConcurrency(self):
+        ''' Concurrent senders share at most pool.size connections. '''
+        def send(i):
+            self.alerter.send_email('m{}'.format(i),'vol{}@example.com'.format(i))
+        threads = [threading.Thread(target=send,args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(20,len(self.server.messages))
+        ok_(self.server.connections <= self.alerter.pool.size,self.server.connections)
+
+    def test_6_batchCarriesOn(self):
+        ''' A message the server refuses doesn't stop the rest of the batch. '''
+        batch = [dict(message='m{}'.format(i),toAddr='vol{}@example.com'.format(i)) for i in range(5)]
+        batch[1]['fromAddr'] = 'blocked@example.com'
+        eq_([True,False,True,True,True],self.alerter.send_batch(batch))
+        eq_(['m0','m2','m3','m4'],[m['body'].strip() for m in self.server.messages])
+        eq_(1,self.server.connections)
+
+    def test_7_connectionLost(self):
+        ''' A batch stops when the connection is lost twice, and reports what was not tried. '''
+        batch = [dict(message='m{}'.format(i),toAddr='vol{}@example.com'.format(i)) for i in range(5)]
+        batch[2]['toAddr'] = 'hangup@example.com'
+        eq_([True,True,None,None,None],self.alerter.send_batch(batch))
+        eq_(2,len(self.server.messages))
+        eq_(2,self.server.connections)
+        ok_(not self.alerter.send_email('m','hangup@example.com'))
+        ok_(self.alerter.send_email('after','a@example.com'))
@@ -0,0 +1,163 @@
+'''
+Test TwilioSMSAlerter against a local stand-in for Twilio's
+Messages endpoint: one client is reused, batches are sent
+concurrently within the rate limit, and 429 responses are retried.
+'''
+import json
+import os
+import tempfile
+import threading
+import time
+import http.server
+
+import tg
+
+import unter.controllers.alerts as alerts
+from unter.controllers.ratelimit import RateLimiter, parseLimits
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class StubMessagesHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,*args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length',0))
+        self.rfile.read(length)
+        with server.lock:
+            server.requests += 1
+            throttle = server.throttle > 0
+            if throttle:
+                server.throttle -= 1
+            else:
+                server.sent += 1
+                sid = 'SM{:032d}'.format(server.sent)
+            server.active += 1
+            server.peak = max(server.peak,server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        if throttle:
+            status,body = 429,dict(code=20429,message='Too Many Requests',status=429)
+        else:
+            status,body = 201,dict(sid=sid,status='queued')
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class StubTwilio(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,delay=0.05):
+        super().__init__(('127.0.0.1',0),StubMessagesHandler)
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.throttle = 0
+        self.requests = 0
+        self.sent = 0
+        self.active = 0
+        self.peak = 0
+
+class TestTwilioBatch(TestController):
+
+    def setUp(self):
+        super().setUp()
+        self.server = StubTwilio()
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.savedConfig = {}
+        opts = {'twilio.sid.filename':'ACtest','twilio.auth.filename':'secret'}
+        for opt,value in opts.items():
+            fname = os.path.join(self.tmpdir.name,opt)
+            with open(fname,'w') as outf:
+                outf.write(value)
+            opts[opt] = fname
+        opts['twilio.api.url'] = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        opts['twilio.rate'] = '0'
+        opts['twilio.backoff'] = '0.01'
+        for opt,value in opts.items():
+            self.savedConfig[opt] = tg.config.get(opt)
+            tg.config[opt] = value
+        self.alerter = alerts.TwilioSMSAlerter()
+
+    def tearDown(self):
+        for opt,value in self.savedConfig.items():
+            if value is None:
+                tg.config.pop(opt,None)
+            else:
+                tg.config[opt] = value
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def batch(self,n):
+        return [dict(message='alert {}'.format(i),sourceNumber='+15550000000',
+            destNumber='+1555000{:04d}'.format(i)) for i in range(n)]
+
+    def test_0_clientReused(self):
+        ''' Every message goes through the same client. '''
+        self.alerter('one','+15550000000','+15550000001')
+        client = self.alerter.client
+        ok_(client is not None)
+        self.alerter('two','+15550000000','+15550000002')
+        ok_(self.alerter.client is client)
+        eq_(2,self.server.sent)
+
+    def test_1_batchIsConcurrent(self):
+        ''' A batch is submitted concurrently and returns SIDs in order. '''
+        self.alerter.workers = 8
+        start = time.time()
+        sids = self.alerter.send_batch(self.batch(40))
+        elapsed = time.time() - start
+        eq_(40,len(sids))
+        ok_(None not in sids,sids)
+        eq_(40,len(set(sids)))
+        ok_(self.server.peak > 1,self.server.peak)
+        ok_(self.server.peak <= 8,self.server.peak)
+        # Serially this would take 40 * 0.05 = 2 seconds.
+        ok_(elapsed < 1.5,elapsed)
+
+    def test_2_throttledMessagesRetried(self):
+        ''' Messages answered with 429 are retried with backoff. '''
+        self.server.throttle = 3
+        sids = self.alerter.send_batch(self.batch(5))
+        ok_(None not in sids,sids)
+        eq_(5,self.server.sent)
+        eq_(8,self.server.requests)
+
+    def test_3_retriesBounded(self):
+        ''' A message still throttled after all retries is reported as not sent. '''
+        self.alerter.retries = 2
+        self.server.throttle = 100
+        eq_(None,self.alerter.send('x','+15550000000','+15550000001'))
+        eq_(3,self.server.requests)
+
+    def test_4_rateLimit(self):
+        ''' Past the burst, the rate limit spaces submissions out. '''
+        self.alerter.limiter = RateLimiter(dict(provider=parseLimits('20/s')),headroom=1.0)
+        self.server.delay = 0
+        start = time.time()
+        self.alerter.send_batch(self.batch(40))
+        ok_(time.time() - start >= 0.95,time.time() - start)
+        eq_(40,self.server.sent)
+        ok_(self.alerter.limiter.stats()['waits'] > 0,self.alerter.limiter.stats())
+
+    def test_5_throttlingPausesEverySend(self):
+        ''' A 429 holds up the other sends too, and is counted. '''
+        self.alerter.backoff = 0.2
+        self.server.throttle = 1
+        self.server.delay = 0
+        start = time.time()
+        sids = self.alerter.send_batch(self.batch(4))
+        ok_(None not in sids,sids)
+        ok_(time.time() - start >= 0.19,time.time() - start)
+        eq_(1,self.alerter.limiter.stats()['throttled'])
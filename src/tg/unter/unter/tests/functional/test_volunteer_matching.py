@@ -0,0 +1,201 @@
+'''
+Test that the set-based (SQL) volunteer matching engine finds
+exactly the same volunteers as the original Python implementation
+in getAvailableVolunteers() and getUncommittedVolunteers(), and that
+it does so with a constant number of SQL statements.
+'''
+import transaction
+import logging
+import datetime as dt
+import threading
+
+from sqlalchemy import event
+from tg import config
+
+import unter.model as model
+import unter.controllers.need as need
+import unter.controllers.availability as availability
+
+from unter.tests import TestController
+
+from nose.tools import ok_, eq_
+
+class TestVolunteerMatching(TestController):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            self.createVolunteers()
+            self.createCoordinatorCarla()
+            self.createAvailabilities()
+            self.createEvents()
+            model.DBSession.flush()
+
+            # Velma has a second, early-morning window on Mondays only.
+            self.createAvailability(user='velma',days=['m'],
+                    start_time=6*60,end_time=8*60)
+
+            # Vaughn is a volunteer with no availability at all.
+
+            # Veronica has committed to bus 1, which overlaps bus 2.
+            self.createResponse('veronica','Veronica only bus 1')
+        except:
+            import sys
+            logging.getLogger('unter.test').error("ABORTING TRANSACTION in TestVolunteerMatching: {}".format(sys.exc_info()))
+            transaction.abort()
+        else:
+            transaction.commit()
+
+    def pythonAlertable(self,nev):
+        vols = need.getAvailableVolunteers(model.DBSession,nev)
+        vols = need.getUncommittedVolunteers(model.DBSession,nev,vols)
+        return sorted([v.user_id for v in vols])
+
+    def sqlAlertable(self,nev):
+        return [v.user_id for v in need.queryAlertableVolunteers(model.DBSession,nev)]
+
+    def test_0_matchesPythonForAllEvents(self):
+        ''' The SQL matching engine agrees with the Python implementation for every event. '''
+        nevs = model.DBSession.query(model.NeedEvent).all()
+        ok_(len(nevs) > 0)
+        for nev in nevs:
+            expected = self.pythonAlertable(nev)
+            found = self.sqlAlertable(nev)
+            eq_(expected,found,'Event {}: expected {}, found {}'.format(nev.notes,expected,found))
+
+    def test_1_overlappingCommitmentExcluded(self):
+        ''' A volunteer committed to an overlapping event is not alertable. '''
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Veronica only bus 2').first()
+        names = [v.user_name for v in need.queryAlertableVolunteers(model.DBSession,nev)]
+        ok_('veronica' not in names,names)
+
+    def test_2_boundaryTimes(self):
+        ''' Events touching the edges of availability windows match identically. '''
+        carla = self.getUser(model.DBSession,'carla')
+        when = dt.datetime.now() + dt.timedelta(days=3)
+        try:
+            # Starts exactly at the start of Veronica's window.
+            self.createEvent(created_by=carla,date_of_need=when,
+                    time_of_need=10*60,duration=30,notes='edge start')
+            # Ends exactly at the end of Velma's window.
+            self.createEvent(created_by=carla,date_of_need=when,
+                    time_of_need=14*60+30,duration=30,notes='edge end')
+            # Ends one minute after the end of Velma's window.
+            self.createEvent(created_by=carla,date_of_need=when,
+                    time_of_need=14*60+31,duration=30,notes='edge past')
+        except:
+            transaction.abort()
+            raise
+        else:
+            transaction.commit()
+        for notes in ('edge start','edge end','edge past'):
+            nev = model.DBSession.query(model.NeedEvent).filter_by(notes=notes).first()
+            eq_(self.pythonAlertable(nev),self.sqlAlertable(nev),notes)
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='edge past').first()
+        eq_([],self.sqlAlertable(nev))
+
+    def test_3_constantStatementCount(self):
+        ''' Matching an event takes one SQL statement regardless of volunteer count. '''
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Veronica or Velma airport').first()
+        statements = []
+        def countStatement(conn,cursor,statement,parameters,context,executemany):
+            statements.append(statement)
+        engine = config['tg.app_globals'].sa_engine
+        event.listen(engine,'before_cursor_execute',countStatement)
+        try:
+            vols = need.queryAlertableVolunteers(model.DBSession,nev)
+        finally:
+            event.remove(engine,'before_cursor_execute',countStatement)
+        eq_(1,len(statements),statements)
+        eq_(['veronica','velma'],[v.user_name for v in vols])
+
+    def test_4_sweepMatchesQuery(self):
+        ''' The batch sweep finds the same volunteers as the per-event query. '''
+        nevs = model.DBSession.query(model.NeedEvent).filter_by(complete=0).all()
+        swept = dict([(nev.neid,[v.user_id for v in vols]) for nev,vols in \
+                need.sweepEvents(model.DBSession,nevs)])
+        for nev in nevs:
+            if need.isFullyServed(model.DBSession,nev):
+                ok_(nev.neid not in swept,nev.notes)
+            else:
+                eq_(self.sqlAlertable(nev),swept[nev.neid],nev.notes)
+
+    def test_5_sweepStatementCount(self):
+        ''' The batch sweep issues a fixed number of statements for any number of events. '''
+        nevs = model.DBSession.query(model.NeedEvent).filter_by(complete=0).all()
+        statements = []
+        def countStatement(conn,cursor,statement,parameters,context,executemany):
+            statements.append(statement)
+        engine = config['tg.app_globals'].sa_engine
+        event.listen(engine,'before_cursor_execute',countStatement)
+        try:
+            need.sweepEvents(model.DBSession,nevs)
+        finally:
+            event.remove(engine,'before_cursor_execute',countStatement)
+        ok_(len(statements) <= 5,statements)
+
+    def test_6_checkAllEvents(self):
+        ''' Checking all need events alerts every volunteer the sweep finds. '''
+        env = {'REMOTE_USER':'carla'}
+        self.app.get('/check_need_events',extra_environ=env,status=200)
+        alerts = self.getAlertLog()
+        ok_('Veronica or Velma airport location' in alerts,alerts)
+        ok_('Velma only bus location' in alerts,alerts)
+
+    def bitmapUserIds(self,nev):
+        bitmap = availability.getAvailabilityBitmap(model.DBSession)
+        day,start,end = need.eventSpan(nev)
+        return bitmap.availableUserIds(day.weekday(),start,end)
+
+    def test_7_bitmapMatchesRows(self):
+        ''' The availability bitmap agrees with the availability rows for every event. '''
+        for nev in model.DBSession.query(model.NeedEvent).all():
+            expected = set([v.user_id for v in need.getAvailableVolunteers(model.DBSession,nev)])
+            eq_(expected,self.bitmapUserIds(nev),nev.notes)
+
+    def test_8_bitmapFollowsAddAndRemove(self):
+        ''' Adding and removing availability through the web updates the bitmap. '''
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Velma only bus').first()
+        vaughn = self.getUser(model.DBSession,'vaughn')
+        vaughnId = vaughn.user_id
+        ok_(vaughnId not in self.bitmapUserIds(nev))
+
+        env = {'REMOTE_USER':'vaughn'}
+        self.app.post('/add_availability_post',params={'user_id':str(vaughnId),
+                'start_time':'13:00','end_time':'16:00',
+                'dow_sunday':'y','dow_monday':'y','dow_tuesday':'y','dow_wednesday':'y',
+                'dow_thursday':'y','dow_friday':'y','dow_saturday':'y'},
+                extra_environ=env,status=302)
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Velma only bus').first()
+        ok_(vaughnId in self.bitmapUserIds(nev))
+
+        av = model.DBSession.query(model.VolunteerAvailability).filter_by(user_id=vaughnId).first()
+        self.app.get('/remove_availability?vaid={}'.format(av.vaid),extra_environ=env,status=302)
+        nev = model.DBSession.query(model.NeedEvent).filter_by(notes='Velma only bus').first()
+        ok_(vaughnId not in self.bitmapUserIds(nev))
+
+    def test_9_bitmapConsistentWhileChanging(self):
+        ''' Matching never sees half of a set of changes being applied. '''
+        bitmap = availability.AvailabilityBitmap(capacity=1)
+        bitmap.set(1,7,0b1111111,600,660)
+        for vaid in range(100,200):
+            bitmap.set(vaid,vaid,0b1111111,0,1)
+        stop = threading.Event()
+        def churn():
+            vaid = 1
+            while not stop.is_set():
+                with bitmap.lock:
+                    bitmap.remove(vaid)
+                    vaid = 3 - vaid
+                    bitmap.set(vaid,7,0b1111111,600,660)
+        writer = threading.Thread(target=churn)
+        writer.start()
+        try:
+            misses = 0
+            for i in range(2000):
+                if 7 not in bitmap.availableUserIds(2,610,650):
+                    misses += 1
+        finally:
+            stop.set()
+            writer.join()
+        eq_(0,misses)
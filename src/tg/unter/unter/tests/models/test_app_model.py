@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 from nose.tools import eq_,ok_
 
 from unter import model
+from unter.model import DBSession
 from unter.tests.models import ModelTest
 
 
@@ -32,3 +33,28 @@ class TestEventType(ModelTest):
     def test_et_from_id(self):
         et = model.EventType.et_by_id(1)
         ok_(et is not None,'Failed to find event by ID')
+
+    def test_et_cached(self):
+        ''' EventType lookups after the first are served without SQL. '''
+        from sqlalchemy import event
+        from tg import config
+        model.EventType.et_by_id(1)
+        statements = []
+        def countStatement(conn,cursor,statement,parameters,context,executemany):
+            statements.append(statement)
+        engine = config['tg.app_globals'].sa_engine
+        event.listen(engine,'before_cursor_execute',countStatement)
+        try:
+            et = model.EventType.et_by_name('Test Event Type')
+            ok_(et is not None)
+            eq_('Test event type description',model.EventType.et_by_id(et.etid).description)
+        finally:
+            event.remove(engine,'before_cursor_execute',countStatement)
+        eq_([],statements)
+
+    def test_et_invalidated_on_insert(self):
+        ''' Adding an EventType makes it visible to lookups. '''
+        model.EventType.et_by_id(1)
+        DBSession.add(model.EventType(name='Another Type',description='Another'))
+        DBSession.flush()
+        ok_(model.EventType.et_by_name('Another Type') is not None)